@@ -0,0 +1,51 @@
+"""
+Startup time benchmark: import of main.py and registration of the tasks of a configuration, each in a fresh
+interpreter so nothing is cached between runs.
+
+    python benchmarks/startup.py [config_file] [runs]
+"""
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT = 'import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)'
+CONFIGURE = 'import time; t = time.perf_counter(); import main; main.MyApp(); print(time.perf_counter() - t)'
+
+
+def measure(code: str, runs: int, env: dict) -> [float]:
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env, check=True, stdout=subprocess.PIPE,
+                             universal_newlines=True).stdout
+        samples.append(float(out.strip().splitlines()[-1]))
+    return samples
+
+
+def slowest_imports(env: dict, top: int = 10) -> [tuple]:
+    """ Cumulative import time of the slowest top level packages, from python -X importtime """
+    err = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'], cwd=ROOT, env=env, check=True,
+                         stderr=subprocess.PIPE, universal_newlines=True).stderr
+    packages = {}
+    for line in err.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = [column.strip() for column in line[len('import time:'):].split('|')]
+        if cumulative.isdigit() and '.' not in name:
+            packages[name] = max(packages.get(name, 0), int(cumulative))
+    return sorted(packages.items(), key=lambda item: -item[1])[:top]
+
+
+if __name__ == '__main__':
+    config = os.path.abspath(sys.argv[1]) if len(sys.argv) > 1 else os.path.join(ROOT, 'config-example.json')
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    env = dict(os.environ, EW_LINK_CONFIG=config)
+    for label, code in (('import main', IMPORT), ('register tasks', CONFIGURE)):
+        samples = measure(code, runs, env)
+        print(f'{label:>16}: median {statistics.median(samples):.3f}s  min {min(samples):.3f}s  '
+              f'max {max(samples):.3f}s  ({runs} runs)')
+    print('Slowest imports of main:')
+    for name, micros in slowest_imports(env):
+        print(f'{name:>24}: {micros / 1e6:.3f}s')
@@ -0,0 +1,65 @@
+"""
+Memory held by the charging stations state: stations after boot with their connectors, the closed transactions kept
+by the ElasticSync retention with their meter curves, and a few tags. Each measure runs in a fresh interpreter and
+reads its peak resident set size, tracemalloc is too slow for large fleets (Linux only).
+
+    python benchmarks/station_memory.py [stations] [transactions per station] [curve points per transaction]
+"""
+import datetime
+import os
+import resource
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tasks.ocpp16.protocol import ChargingStation, MeterCurve  # noqa: E402
+
+BOOT = {'chargePointVendor': 'Bender GmbH Co. KG', 'chargePointModel': 'CC612_1M3PR', 'chargePointSerialNumber': 'Not Set',
+        'chargeBoxSerialNumber': '1702502754/B94060001', 'firmwareVersion': '4.32-4932', 'iccid': '42:EB:EE:8E:85:3A',
+        'imsi': 'usb0', 'meterType': 'eHz/EDL40'}
+
+
+def station(index: int, transactions: int, points: int) -> ChargingStation:
+    cs = ChargingStation('10.0.%d.%d' % (index // 250, index % 250), 40000 + index, f'10.0.0.{index}:{40000 + index}')
+    serial_number = '0901454d48%010d' % index
+    cs._handle_charging_station(serial_number, dict(BOOT, meterSerialNumber=serial_number))
+    for connector in (1, 2):
+        cs._handle_connector(connector, 'Available', '1234567', 'Wh')
+    start = datetime.datetime(2019, 5, 1)
+    for tx_id in range(1, transactions + 1):
+        time_start = start + datetime.timedelta(hours=tx_id)
+        tx = ChargingStation.Transaction(tx_id, str(tx_id % 5), 1, time_start, 1000 * tx_id,
+                                         time_start + datetime.timedelta(minutes=points), 1000 * tx_id + 900,
+                                         serial_number)
+        tx.meter_curve = MeterCurve([1556668800 + 3600 * tx_id + 60 * p, 1000. * tx_id + 15 * p] for p in range(points))
+        tx.reg_id = f'{serial_number}-{tx_id}'
+        cs.transactions[tx_id] = tx
+    for tag in range(5):
+        cs._authorize_tag(str(tag))
+    return cs
+
+
+def resident_kib() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(count: int, transactions: int, points: int) -> int:
+    """ Bytes the stations take, measured in a fresh interpreter """
+    code = (f'import benchmarks.station_memory as b; start = b.resident_kib(); '
+            f'stations = [b.station(i, {transactions}, {points}) for i in range({count})]; '
+            f'print(b.resident_kib() - start)')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.run([sys.executable, '-c', code], cwd=root, check=True, stdout=subprocess.PIPE,
+                         universal_newlines=True).stdout
+    return int(out.strip().splitlines()[-1]) * 1024
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    transactions = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    points = int(sys.argv[3]) if len(sys.argv) > 3 else 60
+    for label, size in (('without history', measure(count, 0, 0)),
+                        (f'with {transactions} transactions of {points} curve points',
+                         measure(count, transactions, points))):
+        print(f'{count} stations {label}: {size / 2 ** 20:.1f} MiB, {size / count / 1024:.2f} KiB per station')
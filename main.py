@@ -1,15 +1,23 @@
+import asyncio
 import datetime
+import functools
 import json
 import os
 import time
 
+START_TIME = time.time()
+
 import energyweb
 
-from tasks.database.memorydao import MemoryDAOFactory
-from tasks.ellisten import DbListenTask
-from tasks.origin import CooProducerTask, CooConsumerTask
-from tasks.chargepoint import Ocpp16ServerTask
-from tasks.elsync import ElasticSyncTask
+from tasks import metrics
+from tasks.backpressure import BoundedQueue
+from tasks.configwatch import FileWatcher, wait_for_file
+from tasks.scheduling import schedule_ticks
+
+# Task modules are imported by the register functions of the configured sections only, importing elasticsearch,
+# websockets and the contract clients takes seconds on small devices.
+CONFIG_PATH = os.environ.get('EW_LINK_CONFIG', '/etc/elocity/ew-link.config')
+STARTUP_SECONDS = metrics.REGISTRY.gauge('app_startup_seconds', 'Time from process start to all tasks registered.')
 
 
 class MyApp(energyweb.dispatcher.App):
@@ -17,7 +25,136 @@ class MyApp(energyweb.dispatcher.App):
     def _handle_exception(self, e: Exception):
         print(f'App failed because {e.with_traceback(e.__traceback__)}\nExiting.')
 
+    def _register_task(self, task: energyweb.Task, *args):
+        super()._register_task(schedule_ticks(metrics.time_ticks(task)), *args)
+
+    def _register_queue(self, queue_id: str, max_size: int = 0, overflow: str = 'block'):
+        self.queue[queue_id] = BoundedQueue(queue_id, max_size, overflow)
+
+    def _reloadable_tasks(self, app_config: dict) -> dict:
+        """
+        Tasks that can be added, removed or replaced while the app runs. The Ocpp16 server, iot layer, metrics and
+        loop monitor tasks are not, so the chargers sessions survive a configuration change.
+        :return: {key: (configuration the task is built from, factory)}
+        """
+        tasks = {}
+        # Task kind -> tasks.scheduling.AdaptiveSchedule options
+        scheduling = app_config.get('scheduling', {})
+
+        def fingerprint(section) -> str:
+            return json.dumps(section, sort_keys=True, default=str)
+
+        def origin_task(kind: str, item: dict):
+            from tasks.origin import CooProducerTask, CooConsumerTask
+            interval = datetime.timedelta(minutes=2)
+            origin_config = energyweb.config.parse_coo_v1({'producers': [], 'consumers': [], kind: [item]})
+            # Tasks sharing a wallet share its client, its options are read once
+            wallet_options = app_config.get('wallets')
+            if kind == 'producers':
+                return CooProducerTask(origin_config.production[0], interval, self.queue, store='/tmp/origin/produce',
+                                       wallet_options=wallet_options, schedule_config=scheduling.get('origin'))
+            return CooConsumerTask(origin_config.consumption[0], interval, self.queue, store='/tmp/origin/consume',
+                                   wallet_options=wallet_options, schedule_config=scheduling.get('origin'))
+
+        def db_sync_task(sync_config: dict):
+            from tasks.elsync import ElasticSyncTask
+            interval = datetime.timedelta(seconds=2)
+            retention = sync_config.get('retention', {})
+            return ElasticSyncTask(self.queue, interval, sync_config['service_urls'], retention.get('transactions', 20),
+                                   retention.get('tags', 50), scheduling.get('elastic-sync'))
+
+        def db_listener_task(sync_config: dict):
+            from tasks.ellisten import DbListenTask
+            interval = datetime.timedelta(seconds=2)
+            return DbListenTask(self.queue, interval, sync_config['service_urls'], scheduling.get('db-listener'))
+
+        if 'consumers' not in app_config and 'producers' not in app_config:
+            raise energyweb.config.ConfigurationFileError('Configuration file missing producers or consumers.')
+        if not isinstance(app_config.get('ocpp16-server'), dict):
+            raise energyweb.config.ConfigurationFileError('Configuration file missing Ocpp 1.6 configuration.')
+        for kind in ('producers', 'consumers'):
+            for item in app_config.get(kind, []):
+                if 'name' not in item:
+                    raise energyweb.config.ConfigurationFileError(f'Configuration file missing name in {kind}.')
+                tasks[f'{kind}:{item["name"]}'] = (fingerprint([item, scheduling.get('origin')]),
+                                                   functools.partial(origin_task, kind, item))
+
+        if 'elastic-sync' not in app_config \
+                or not {'service_urls'}.issubset(dict(app_config['elastic-sync']).keys()):
+            raise energyweb.config.ConfigurationFileError('Configuration file missing ElasticSync configuration.')
+        sync_config = app_config['elastic-sync']
+        if app_config['ocpp16-server'].get('workers', 1) == 1:
+            # Otherwise each Ocpp16 worker process syncs the stations it owns
+            tasks['elastic-sync'] = (fingerprint([sync_config, scheduling.get('elastic-sync')]),
+                                     functools.partial(db_sync_task, sync_config))
+        tasks['db-listener'] = (fingerprint([sync_config['service_urls'], scheduling.get('db-listener')]),
+                                functools.partial(db_listener_task, sync_config))
+        return tasks
+
+    def _reconfigure(self, app_config: dict):
+        """
+        Diff the reloadable tasks against the configuration: stop the removed and changed ones, build the new ones.
+        They are started by run, or right away once the app runs.
+        """
+        desired = self._reloadable_tasks(app_config)
+        built = {}
+        for key, (fingerprint, factory) in desired.items():
+            if key in self._reloadable and self._reloadable[key][0] == fingerprint:
+                continue
+            try:
+                built[key] = [fingerprint, schedule_ticks(metrics.time_ticks(factory())), None]
+            except Exception as e:
+                if self._app_config is None:
+                    raise energyweb.config.ConfigurationFileError(f'Task {key} cannot be built: {e}')
+                # The running task is kept, it is built again on the next configuration change
+                print(f'Task {key} not replaced because {e.with_traceback(e.__traceback__)}')
+        for key, (fingerprint, task, future) in list(self._reloadable.items()):
+            if key in desired and key not in built:
+                continue
+            # Task.run restarts itself unless run_forever is off
+            task.run_forever = False
+            if future:
+                future.cancel()
+            del self._reloadable[key]
+            print(f'Task {key} stopped.')
+        self._reloadable.update(built)
+        if self.loop.is_running():
+            self._start_reloadable()
+        for section in ('ocpp16-server', 'queues', 'metrics', 'iot-layer', 'wallets', 'loop-monitor'):
+            if self._app_config is not None and self._app_config.get(section) != app_config.get(section):
+                print(f'Configuration of {section} changed, it applies after a restart.')
+        self._app_config = app_config
+
+    def _start_reloadable(self):
+        for key, entry in self._reloadable.items():
+            if not entry[2]:
+                entry[2] = asyncio.ensure_future(entry[1].run(), loop=self.loop)
+                print(f'Task {key} started.')
+
+    async def _watch_config(self):
+        watcher = FileWatcher(CONFIG_PATH)
+        while True:
+            await watcher.wait_async()
+            # Let the writer finish, editors save in several writes
+            await asyncio.sleep(1)
+            watcher.changed()
+            try:
+                self._reconfigure(json.load(open(CONFIG_PATH)))
+            except (energyweb.config.ConfigurationFileError, ValueError) as e:
+                print(f'Configuration change ignored, the file is invalid: {e}')
+            except Exception as e:
+                self._handle_exception(e)
+
+    def run(self):
+        if not self.loop.is_closed():
+            self._start_reloadable()
+            asyncio.ensure_future(self._watch_config(), loop=self.loop)
+        super().run()
+
     def _configure(self):
+        # key -> [configuration fingerprint, task, future]
+        self._reloadable = {}
+        self._app_config = None
 
         def parse_config_file(path):
             if not os.path.isfile(path):
@@ -27,48 +164,129 @@ class MyApp(energyweb.dispatcher.App):
             except Exception:
                 raise energyweb.config.ConfigurationFileError('Malformed json.')
 
+        def register_queue(queue_id: str, max_size: int, overflow: str):
+            queue_config = app_config.get('queues', {}).get(queue_id, {})
+            self._register_queue(queue_id, queue_config.get('max_size', max_size), queue_config.get('overflow', overflow))
+
+        def register_authorization(auth_config: dict, service_urls: tuple):
+            from tasks.ocpp16.authorization import AuthorizationCache
+            from tasks.ocpp16.protocol import ChargingStation
+            try:
+                authorization = AuthorizationCache.from_config(auth_config, service_urls)
+            except TypeError as e:
+                raise energyweb.config.ConfigurationFileError(f'Ocpp 1.6 authorization configuration is invalid: {e}')
+            if not authorization:
+                return
+            try:
+                authorization.prefetch()
+            except Exception as e:
+                # Tags are then looked up one by one as chargers present them
+                energyweb.Logger('Ocpp16Server').console.warning(f'Authorization prefetch failed: {e}')
+            ChargingStation.authorization = authorization
+
+        def register_spool(spool_config: dict):
+            from tasks.database.elasticdao import ElasticSearchDAO
+            from tasks.database.spool import WriteSpool
+            try:
+                ElasticSearchDAO.spool = WriteSpool.from_config(spool_config)
+            except (TypeError, KeyError) as e:
+                raise energyweb.config.ConfigurationFileError(f'ElasticSync spool configuration is invalid: {e}')
+
+        def register_cache(cache_config: dict):
+            from tasks.database.cache import DocumentCache
+            from tasks.database.elasticdao import ElasticSearchDAO
+            try:
+                ElasticSearchDAO.cache = DocumentCache.from_config(cache_config)
+            except TypeError as e:
+                raise energyweb.config.ConfigurationFileError(f'ElasticSync cache configuration is invalid: {e}')
+
         def register_ocpp_server():
             interval = datetime.timedelta(minutes=1)
-            self._register_queue('ev_charger_command')
-            self._register_queue('ev_chargers_available', 1)
+            register_queue('ev_charger_command', 1000, 'block')
+            register_queue('ev_chargers_available', 1, 'drop_oldest')
             if 'ocpp16-server' not in app_config \
                     or not {'host', 'port'}.issubset(dict(app_config['ocpp16-server']).keys()):
                 raise energyweb.config.ConfigurationFileError('Configuration file missing Ocpp 1.6 configuration.')
-            host, port = app_config['ocpp16-server']['host'], app_config['ocpp16-server']['port']
-            self._register_task(Ocpp16ServerTask(self.queue, MemoryDAOFactory(), interval, host, port))
-
-        def register_origin():
-            interval = datetime.timedelta(minutes=2)
-            origin_config: energyweb.config.CooV1Configuration = energyweb.config.parse_coo_v1(app_config)
-            for producer in origin_config.production:
-                self._register_task(CooProducerTask(producer, interval, self.queue, store='/tmp/origin/produce'))
-            for consumer in origin_config.consumption:
-                self._register_task(CooConsumerTask(consumer, interval, self.queue, store='/tmp/origin/consume'))
-
-        def register_db_sync():
-            interval = datetime.timedelta(seconds=10)
-            if 'elastic-sync' not in app_config \
-                    or not {'service_urls'}.issubset(dict(app_config['elastic-sync']).keys()):
-                raise energyweb.config.ConfigurationFileError('Configuration file missing ElasticSync configuration.')
-            self._register_task(ElasticSyncTask(self.queue, interval, app_config['elastic-sync']['service_urls']))
+            server_config = app_config['ocpp16-server']
+            host, port = server_config['host'], server_config['port']
+            server_options = {k: server_config[k] for k in ('call_timeout', 'call_retries', 'validate', 'compression')
+                              if k in server_config}
+            from tasks.ocpp16.wire import compression_options
+            try:
+                compression_options(server_options.get('compression'))
+            except (TypeError, ValueError) as e:
+                raise energyweb.config.ConfigurationFileError(f'Ocpp 1.6 compression configuration is invalid: {e}')
+            service_urls = app_config.get('elastic-sync', {}).get('service_urls')
+            if server_config.get('workers', 1) > 1:
+                from tasks.chargepoint import Ocpp16ShardedServerTask
+                self._register_task(Ocpp16ShardedServerTask(self.queue, datetime.timedelta(seconds=1), host, port,
+                                                            server_config['workers'], server_config.get('trace'),
+                                                            server_config.get('codec'), service_urls,
+                                                            server_config.get('rate_limits'), server_options,
+                                                            server_config.get('authorization'),
+                                                            server_config.get('rollups'),
+                                                            app_config.get('elastic-sync', {}).get('spool'),
+                                                            app_config.get('metrics'),
+                                                            app_config.get('elastic-sync', {}).get('retention'),
+                                                            app_config.get('scheduling', {}).get('elastic-sync'),
+                                                            app_config.get('elastic-sync', {}).get('cache')))
+                return
+            if server_config.get('rollups') is not None:
+                from tasks.ocpp16.protocol import ChargingStation
+                from tasks.ocpp16.rollups import EnergyRollups
+                ChargingStation.rollups = EnergyRollups.from_config(server_config['rollups'])
+                ChargingStation.rollups.expose()
+            from tasks.backpressure import RateLimiter
+            from tasks.chargepoint import Ocpp16ServerTask
+            from tasks.database.actordao import ActorDAOFactory
+            from tasks.ocpp16.codec import get_codec
+            from tasks.ocpp16.trace import ProtocolTracer
+            register_authorization(server_config.get('authorization'), service_urls)
+            tracer = ProtocolTracer.from_config(server_config.get('trace'))
+            codec = get_codec(server_config.get('codec'))
+            limiter = RateLimiter.from_config(server_config.get('rate_limits'))
+            self._register_task(Ocpp16ServerTask(self.queue, ActorDAOFactory(), interval, host, port, tracer, codec,
+                                                 limiter, **server_options))
 
         def register_iot_layer():
-            pass
+            if 'iot-layer' not in app_config:
+                return
+            iot_config = dict(app_config['iot-layer'])
+            if not {'client_url', 'contract_add', 'device_id'}.issubset(iot_config.keys()):
+                raise energyweb.config.ConfigurationFileError('Configuration file missing IoT Layer configuration.')
+            from tasks.iotlayer import IotLayerEventsTask
+            interval = datetime.timedelta(seconds=iot_config.pop('interval', 5))
+            try:
+                self._register_task(IotLayerEventsTask(self.queue, interval, **iot_config))
+            except TypeError as e:
+                raise energyweb.config.ConfigurationFileError(f'IoT Layer configuration is invalid: {e}')
+
+        def register_metrics():
+            interval = datetime.timedelta(minutes=1)
+            if 'metrics' not in app_config:
+                return
+            if not {'host', 'port'}.issubset(dict(app_config['metrics']).keys()):
+                raise energyweb.config.ConfigurationFileError('Configuration file missing Metrics configuration.')
+            from tasks.monitoring import MetricsServerTask
+            host, port = app_config['metrics']['host'], app_config['metrics']['port']
+            self._register_task(MetricsServerTask(self.queue, interval, host, port))
 
-        def register_db_listener():
-            interval = datetime.timedelta(seconds=5)
-            if 'elastic-sync' not in app_config \
-                    or not {'service_urls'}.issubset(dict(app_config['elastic-sync']).keys()):
-                raise energyweb.config.ConfigurationFileError('Configuration file missing ElasticSync configuration.')
-            self._register_task(DbListenTask(self.queue, interval, app_config['elastic-sync']['service_urls']))
+        def register_loop_monitor():
+            if 'loop-monitor' not in app_config:
+                return
+            from tasks.loopmonitor import LoopMonitorTask
+            try:
+                self._register_task(LoopMonitorTask(self.queue, **app_config['loop-monitor']))
+            except TypeError as e:
+                raise energyweb.config.ConfigurationFileError(f'Loop monitor configuration is invalid: {e}')
 
-        config_path = '/etc/elocity/ew-link.config'
+        config_path = CONFIG_PATH
         # config_path = './config-test-ebee.json'
 
         try:
-            while not os.path.exists(config_path):
+            if not os.path.exists(config_path):
                 print(f'App is waiting for config file')
-                time.sleep(3)
+                wait_for_file(config_path)
         except KeyboardInterrupt:
             self.loop.close()
             quit()
@@ -78,11 +296,14 @@ class MyApp(energyweb.dispatcher.App):
 
         try:
             app_config: dict = parse_config_file(config_path)
+            register_spool(app_config.get('elastic-sync', {}).get('spool'))
+            register_cache(app_config.get('elastic-sync', {}).get('cache'))
             register_ocpp_server()
-            register_db_sync()
             register_iot_layer()
-            register_db_listener()
-            register_origin()
+            register_metrics()
+            register_loop_monitor()
+            self._reconfigure(app_config)
+            STARTUP_SECONDS.set(time.time() - START_TIME)
         except energyweb.config.ConfigurationFileError as e:
             print(f'Error in configuration file: {e.with_traceback(e.__traceback__)}\nExiting.')
             self.loop.close()
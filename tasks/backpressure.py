@@ -0,0 +1,93 @@
+"""
+Bounded app queues with overflow policies and token bucket rate limiting
+"""
+import asyncio
+import time
+
+from tasks.metrics import REGISTRY
+
+QUEUE_SHED = REGISTRY.counter('queue_shed_total', 'Items dropped because an app queue was full.', ('queue', 'policy'))
+RATE_LIMITED = REGISTRY.counter('ocpp16_rate_limited_total', 'Inbound frames refused by the rate limiter.', ('action',))
+
+
+class BoundedQueue(asyncio.Queue):
+    """
+    asyncio.Queue with an explicit policy for when it is full:
+        block: producers wait, put_nowait raises QueueFull (asyncio default)
+        drop_newest: the item being put is discarded
+        drop_oldest: the oldest item is discarded to make room, i.e. latest-value queues of size 1
+    """
+    POLICIES = ('block', 'drop_newest', 'drop_oldest')
+
+    def __init__(self, name: str, maxsize: int = 0, overflow: str = 'block'):
+        if overflow not in self.POLICIES:
+            raise ValueError(f'Queue {name} overflow must be one of {self.POLICIES}.')
+        self.name = name
+        self.overflow = overflow
+        super().__init__(maxsize)
+
+    def put_nowait(self, item):
+        if self.full() and self.overflow != 'block':
+            QUEUE_SHED.inc(queue=self.name, policy=self.overflow)
+            if self.overflow == 'drop_newest':
+                return
+            self.get_nowait()
+        super().put_nowait(item)
+
+    async def put(self, item):
+        if self.overflow == 'block':
+            return await super().put(item)
+        self.put_nowait(item)
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, burst: float):
+        """
+        :param rate: Tokens added per second
+        :param burst: Bucket capacity
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def consume(self, tokens: float = 1) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+
+class RateLimiter:
+    """ One token bucket per station and action. Actions without their own limit use the '*' limit if any. """
+
+    def __init__(self, limits: dict):
+        """
+        :param limits: {action or '*': {'rate': tokens per second, 'burst': capacity}}
+        """
+        self.limits = limits
+        self._buckets = {}
+
+    @staticmethod
+    def from_config(limits: dict):
+        return RateLimiter(limits) if limits else None
+
+    def allow(self, station: str, action: str) -> bool:
+        key = (station, action)
+        if key not in self._buckets:
+            limit = self.limits.get(action, self.limits.get('*'))
+            if not limit:
+                return True
+            self._buckets[key] = TokenBucket(limit['rate'], limit['burst'])
+        if self._buckets[key].consume():
+            return True
+        RATE_LIMITED.inc(action=action)
+        return False
+
+    def forget(self, station: str):
+        """ Drop the buckets of a disconnected station """
+        self._buckets = {k: v for k, v in self._buckets.items() if k[0] != station}
@@ -0,0 +1,136 @@
+"""
+Time weighted CO2 accounting: transaction meter curves integrated against a carbon intensity series
+"""
+import calendar
+import datetime
+
+import energyweb
+import numpy
+import requests
+
+from energyweb.carbonemission import WattimeV1
+
+
+class EmissionSeries:
+    """ Carbon intensity in kg/Wh as a step function, every point holds until the next one """
+
+    def __init__(self, epochs, intensities):
+        """
+        :param epochs: Measurement times in epoch seconds
+        :param intensities: kg of CO2 per Wh
+        """
+        order = numpy.argsort(epochs)
+        self.epochs = numpy.asarray(epochs, dtype=float)[order]
+        self.intensities = numpy.asarray(intensities, dtype=float)[order]
+        # Integral of the step function from the first point to each point
+        self._integral = numpy.concatenate(([0.], numpy.cumsum(numpy.diff(self.epochs) * self.intensities[:-1])))
+
+    @staticmethod
+    def constant(intensity: float):
+        return EmissionSeries([0.], [intensity])
+
+    def _segment(self, epochs: numpy.ndarray) -> numpy.ndarray:
+        return numpy.clip(numpy.searchsorted(self.epochs, epochs, side='right') - 1, 0, len(self.epochs) - 1)
+
+    def at(self, epochs) -> numpy.ndarray:
+        return self.intensities[self._segment(numpy.asarray(epochs, dtype=float))]
+
+    def integral(self, epochs) -> numpy.ndarray:
+        """ Integral of the intensity up to each epoch, the first and last intensities extend outside the series """
+        epochs = numpy.asarray(epochs, dtype=float)
+        segment = self._segment(epochs)
+        return self._integral[segment] + (epochs - self.epochs[segment]) * self.intensities[segment]
+
+
+def epoch(moment: datetime.datetime) -> float:
+    return float(calendar.timegm(moment.timetuple()))
+
+
+def meter_curve(tx) -> numpy.ndarray:
+    """
+    :param tx: Closed Ocpp16.Transaction
+    :return: (n, 2) array of [epoch seconds, Wh] from start to stop, including the samples sent in between
+    """
+    samples = getattr(tx.meter_curve, 'values', None)
+    if samples is not None:
+        # Packed MeterCurve, read in place
+        samples = numpy.frombuffer(samples, dtype=float).reshape(-1, 2)
+    else:
+        samples = numpy.array([point for point in (tx.meter_curve or []) if len(point) == 2], dtype=float)
+    curve = numpy.concatenate([[[epoch(tx.time_start), float(tx.meter_start)]], samples.reshape(-1, 2),
+                               [[epoch(tx.time_stop), float(tx.meter_stop)]]])
+    return curve[numpy.argsort(curve[:, 0], kind='stable')]
+
+
+def co2_of_curves(curves: [numpy.ndarray], series: EmissionSeries) -> numpy.ndarray:
+    """
+    Every interval between two meter samples gets its energy times the mean intensity over that interval, the
+    energy being drawn evenly in between. All the intervals of all curves are computed at once.
+    :param curves: One (n, 2) array of [epoch seconds, Wh] per transaction, sorted by time
+    :param series: Carbon intensity
+    :return: kg of CO2 per curve
+    """
+    if not curves:
+        return numpy.zeros(0)
+    points = numpy.concatenate(curves)
+    owner = numpy.repeat(numpy.arange(len(curves)), [len(curve) for curve in curves])
+    epochs, wh = points[:, 0], points[:, 1]
+    duration = numpy.diff(epochs)
+    energy = numpy.clip(numpy.diff(wh), 0, None)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        intensity = numpy.where(duration > 0, numpy.diff(series.integral(epochs)) / duration, series.at(epochs[:-1]))
+    # Intervals between the last point of a curve and the first of the next do not count
+    co2 = numpy.where(owner[1:] == owner[:-1], energy * intensity, 0.)
+    return numpy.bincount(owner[:-1], weights=co2, minlength=len(curves))
+
+
+def co2_of_transactions(transactions: list, series: EmissionSeries) -> numpy.ndarray:
+    """ kg of CO2 per closed transaction """
+    return co2_of_curves([meter_curve(tx) for tx in transactions], series)
+
+
+def emission_series(carbon_data: energyweb.CarbonEmissionData) -> EmissionSeries or None:
+    """
+    :param carbon_data: Read from any carbon emission source, a series if it carries one
+    """
+    if carbon_data is None:
+        return None
+    if isinstance(carbon_data.raw, dict) and carbon_data.raw.get('series'):
+        epochs, intensities = zip(*carbon_data.raw['series'])
+        return EmissionSeries(epochs, intensities)
+    return EmissionSeries.constant(carbon_data.accumulated_co2)
+
+
+class WattimeSeriesV1(WattimeV1):
+    """
+    WattimeV1 returning every marginal emission point of the last hours_from_now hours instead of the first one.
+    The points are in raw['series'] as [epoch seconds, kg/Wh], accumulated_co2 is the latest point as before.
+    """
+
+    def __init__(self, usr: str, pwd: str, ba: str, hours_from_now: int = 24, page_size: int = 1000):
+        self.page_size = page_size
+        super().__init__(usr, pwd, ba, hours_from_now)
+
+    def read_state(self) -> energyweb.CarbonEmissionData:
+        auth_token = self._WattimeV1__get_auth_token()
+        now = datetime.datetime.utcnow()
+        query = {
+            'ba': self.ba,
+            'start_at': (now - datetime.timedelta(hours=self.hours_from_now)).strftime("%Y-%m-%dT%H:00:00"),
+            'end_at': now.strftime("%Y-%m-%dT%H:%M:%S"),
+            'page_size': self.page_size,
+            'market': 'RTHR'
+        }
+        ans = requests.get(self.api_url + 'marginal/', headers={'Authorization': 'Token ' + auth_token},
+                           params=query).json()
+        if not ans.get('results'):
+            raise AttributeError('Empty response from api.')
+        # lb/MWh to kg/Wh
+        series = [[epoch(datetime.datetime.strptime(point['timestamp'], "%Y-%m-%dT%H:%M:%SZ")),
+                   point['marginal_carbon']['value'] * 0.453592 * pow(10, -6)]
+                  for point in ans['results'] if point.get('marginal_carbon', {}).get('value') is not None]
+        if not series:
+            raise AttributeError('Empty response from api.')
+        series.sort()
+        raw = {'series': series, 'ba': self.ba}
+        return energyweb.CarbonEmissionData(epoch(now), raw, series[-1][1], int(series[-1][0]))
@@ -1,13 +1,92 @@
 import asyncio
 import calendar
 import datetime
+import queue
+import time
+import weakref
 
 import energyweb
 
+from tasks.backpressure import RateLimiter
 from tasks.database.dao import DAOFactory
 from tasks.database.elasticdao import ElasticSearchDAO
+from tasks.metrics import REGISTRY
 from tasks.ocpp16.protocol import ChargingStation, Ocpp16
+from tasks.ocpp16.codec import Codec
+from tasks.ocpp16.fanout import FleetCommand, FleetResult
 from tasks.ocpp16.server import Ocpp16Server
+from tasks.ocpp16.trace import ProtocolTracer
+from tasks.ocpp16.workers import CONTEXT, Ocpp16Worker
+from tasks.scheduling import WAKEUPS
+
+METER_READS = REGISTRY.counter('ev_meter_reads_total', 'EV charger meter reads per source of their transactions.',
+                               ('source',))
+METER_SEARCH_SIZE = REGISTRY.histogram('ev_meter_search_meters', 'Meters read by one multi search.',
+                                       buckets=(1, 2, 5, 10, 20, 50, 100, 200))
+
+
+class MeterReadings:
+    """
+    New transactions of all the EV charger meters of the process, read with one multi search. The first meter to read
+    searches for every meter, the others take their transactions from that search until it is max_age old.
+    """
+    # service_urls -> MeterReadings
+    _shared = {}
+
+    def __init__(self, service_urls: tuple, max_age: float = 30):
+        """
+        :param max_age: Seconds the transactions found for a meter wait for it to read them
+        """
+        self.service_urls = service_urls
+        self.max_age = max_age
+        self._meters = weakref.WeakSet()
+        # (serial number, connector id) -> (monotonic time searched, transactions)
+        self._found = {}
+
+    @staticmethod
+    def shared(service_urls: tuple) -> 'MeterReadings':
+        """ Readings of the meters using the same elastic search """
+        key = tuple(service_urls)
+        if key not in MeterReadings._shared:
+            MeterReadings._shared[key] = MeterReadings(key)
+        return MeterReadings._shared[key]
+
+    def register(self, meter: 'EVchargerEnergyMeter'):
+        self._meters.add(meter)
+
+    def _dao(self) -> ElasticSearchDAO:
+        return ElasticSearchDAO('transactions', ChargingStation.Transaction, *self.service_urls)
+
+    def read(self, serial_number: str, connector_id: int) -> [ChargingStation.Transaction]:
+        """
+        Transactions of a connector not read yet, each is returned once
+        :raise ElasticsearchException: The search failed
+        """
+        key = (serial_number, connector_id)
+        now = time.monotonic()
+        found = self._found.pop(key, None)
+        if found and now - found[0] < self.max_age:
+            METER_READS.inc(source='batch')
+            return found[1]
+        self._found = {k: v for k, v in self._found.items() if now - v[0] < self.max_age}
+        keys = [key] + list({(meter.serial_number, meter.connector_id) for meter in self._meters} - {key} -
+                            set(self._found))
+        dao = self._dao()
+        results = dao.multi_query([dao.filter_query({'cs_reg_id': serial, 'connector_id': connector},
+                                                    exists=('meter_start', 'meter_stop'), missing=('co2_saved',))
+                                   for serial, connector in keys])
+        METER_SEARCH_SIZE.observe(len(keys))
+        for other, result in zip(keys[1:], results[1:]):
+            if not isinstance(result, Exception):
+                self._found[other] = (now, result)
+        if isinstance(results[0], Exception):
+            raise results[0]
+        METER_READS.inc(source='search')
+        return results[0]
+
+    def mark_read(self, transactions: [ChargingStation.Transaction]):
+        """ Store the transactions with co2_saved set, in one bulk request """
+        self._dao().update_all(transactions)
 
 
 class EVchargerEnergyMeter(energyweb.EnergyDevice):
@@ -16,31 +95,42 @@ class EVchargerEnergyMeter(energyweb.EnergyDevice):
                  connector_id: int, latitude=None, longitude=None):
         self.service_urls = service_urls
         self.connector_id = connector_id
+        # tasks.carbon.EmissionSeries of the period being read, CO2 is not accounted if None
+        self.emission_series = None
         super().__init__(manufacturer, model, serial_number, energy_unit, is_accumulated, latitude, longitude)
+        self.readings = MeterReadings.shared(service_urls)
+        self.readings.register(self)
 
     def read_state(self, *args, **kwargs) -> energyweb.EnergyData:
-        els_tx_dao = ElasticSearchDAO('transactions', ChargingStation.Transaction, *self.service_urls)
-        results = els_tx_dao.query({"bool": {
-            "must_not": {"exists": {"field": 'co2_saved'}},
-            "must": [{"exists": {"field": 'meter_start'}},
-                     {"exists": {"field": 'meter_stop'}},
-                     {"match": {"cs_reg_id": self.serial_number}},
-                     {"match": {"connector_id": self.connector_id}}]
-        }})
+        """
+        Energy of the transactions closed since the last read. Their CO2 is accounted against emission_series,
+        set by the producer task from its carbon emission source, and stored in co2_saved which marks them read.
+        The transactions of all meters are searched at once, see MeterReadings.
+        """
+        from tasks.carbon import co2_of_transactions
+        results = self.readings.read(self.serial_number, self.connector_id)
+        # Read transactions whose update is still spooled come back from the spool with co2_saved set
+        results = [tx for tx in results if tx.co2_saved is None]
         now = datetime.datetime.now().astimezone()
         if len(results) < 1:
             raise AssertionError('No new transactions.')
         results.sort(key=lambda cs: cs.time_start)
-        tx: Ocpp16.Transaction = results.pop()
-        tx.co2_saved = int(tx.meter_stop) - int(tx.meter_start)
+        co2 = co2_of_transactions(results, self.emission_series) if self.emission_series else None
+        energy = 0
+        for i, tx in enumerate(results):
+            energy += int(tx.meter_stop) - int(tx.meter_start)
+            tx.co2_saved = float(co2[i]) if co2 is not None else 0.
+        raw = {'transactions': [tx.to_dict() for tx in results]}
+        if co2 is not None:
+            raw['co2_saved'] = float(co2.sum())
         energy_data = {
             "device": self,
             "access_epoch": calendar.timegm(now.timetuple()),
-            "raw": tx.to_dict(),
-            "energy": tx.co2_saved,
-            "measurement_epoch": calendar.timegm(tx.time_stop.timetuple())
+            "raw": raw,
+            "energy": energy,
+            "measurement_epoch": calendar.timegm(results[-1].time_stop.timetuple())
         }
-        els_tx_dao.update(tx)
+        self.readings.mark_read(results)
         return energyweb.EnergyData(**energy_data)
 
     def write_state(self, *args, **kwargs) -> energyweb.EnergyData:
@@ -49,10 +139,18 @@ class EVchargerEnergyMeter(energyweb.EnergyDevice):
 
 class Ocpp16ServerTask(energyweb.Task, energyweb.Logger):
 
-    def __init__(self, queue: dict, factory: DAOFactory, retry_interval: datetime.timedelta, host: str, port: int):
-        """ Use different DAOs to change storage services """
+    def __init__(self, queue: dict, factory: DAOFactory, retry_interval: datetime.timedelta, host: str, port: int,
+                 tracer: ProtocolTracer = None, codec: Codec = None, limiter: RateLimiter = None, **server_options):
+        """
+        Use different DAOs to change storage services
+        :param server_options: Passed to Ocpp16Server, i.e. call_timeout and call_retries
+        """
         self._queue = queue
         self._factory = factory
+        self._tracer = tracer
+        self._codec = codec
+        self._limiter = limiter
+        self._server_options = server_options
         self.server_address = (host, port)
         self._future = None
         energyweb.Task.__init__(self, queue, polling_interval=retry_interval, eager=True, run_forever=True)
@@ -60,12 +158,9 @@ class Ocpp16ServerTask(energyweb.Task, energyweb.Logger):
 
     class Ocpp16ServerLogger(Ocpp16Server):
 
-        def __init__(self, factory, queue, console):
+        def __init__(self, factory, queue, console, *args, **kwargs):
             self.console = console
-            super().__init__(factory, queue)
-
-        def _message_handler(self, msg):
-            self.console.debug(f'{msg.serialize()}')
+            super().__init__(factory, queue, *args, **kwargs)
 
         def _error_handler(self, text, e):
             self.console.error(f'{text}{e.with_traceback(e.__traceback__)}')
@@ -80,7 +175,8 @@ class Ocpp16ServerTask(energyweb.Task, energyweb.Logger):
 
     async def _main(self):
         if not self._future or not self._future.done():
-            server = self.Ocpp16ServerLogger(self._factory, self._queue, self.console)
+            server = self.Ocpp16ServerLogger(self._factory, self._queue, self.console, self._tracer,
+                                             self._codec, self._limiter, **self._server_options)
             self._future = asyncio.ensure_future(server.get_server(*self.server_address))
             await self._future
 
@@ -91,3 +187,137 @@ class Ocpp16ServerTask(energyweb.Task, energyweb.Logger):
             self._future.ws_server.close()
         except Exception as e:
             self._handle_exception(e)
+
+
+class Ocpp16ShardedServerTask(energyweb.Task, energyweb.Logger):
+
+    def __init__(self, queue: dict, interval: datetime.timedelta, host: str, port: int, workers: int,
+                 trace_config: dict = None, codec_name: str = None, service_urls: tuple = None,
+                 rate_limits: dict = None, server_options: dict = None, auth_config: dict = None,
+                 rollups_config: dict = None, spool_config: dict = None, metrics_config: dict = None,
+                 retention: dict = None, schedule_config: dict = None, cache_config: dict = None):
+        """
+        Spread the Ocpp 1.6 server over worker processes listening on the same port.
+        Commands are routed to the worker owning the target station and the workers station directories are merged
+        into 'ev_chargers_available'.
+        :param interval: Longest wait for a command before checking workers health and directory updates
+        :param workers: Number of worker processes, usually the number of cores
+        :param service_urls: Elastic search urls, each worker syncs the stations it owns
+        :param server_options: Passed to each worker Ocpp16Server, i.e. call_timeout and call_retries
+        :param auth_config: Authorization cache configuration, each worker keeps its own cache
+        :param rollups_config: Energy rollups configuration, each worker rolls up the stations it owns
+        :param spool_config: Elastic search write spool configuration, each worker spools to its own file
+        :param metrics_config: Metrics configuration of the app, each worker serves its metrics on the next ports
+        :param retention: ElasticSync retention, applied by the sync of each worker
+        :param schedule_config: ElasticSync scheduling options, applied by the sync of each worker
+        :param cache_config: Elastic search read cache configuration, each worker keeps its own cache
+        """
+        self.wait_interval = interval
+        self.server_address = (host, port)
+        self.worker_count = workers
+        self.worker_config = {'trace_config': trace_config, 'codec_name': codec_name, 'service_urls': service_urls,
+                              'rate_limits': rate_limits, 'server_options': server_options,
+                              'auth_config': auth_config, 'rollups_config': rollups_config,
+                              'spool_config': spool_config, 'metrics_config': metrics_config,
+                              'retention': retention, 'schedule_config': schedule_config,
+                              'cache_config': cache_config}
+        self._workers = {}
+        self._commands = {}
+        self._directory = CONTEXT.Queue()
+        self._replies = CONTEXT.Queue()
+        # command_id -> (FleetCommand, indexes of the workers yet to reply, FleetResult merged so far)
+        self._fleet_commands = {}
+        self._shards = {}
+        self._owners = {}
+        energyweb.Task.__init__(self, queue, polling_interval=None, eager=True, run_forever=True)
+        energyweb.Logger.__init__(self, 'Ocpp16Server')
+
+    def _start_worker(self, index: int):
+        self._commands[index] = CONTEXT.Queue()
+        self._shards[index] = {}
+        worker = Ocpp16Worker(index, *self.server_address, self._commands[index], self._directory, self._replies,
+                              **self.worker_config)
+        worker.start()
+        self._workers[index] = worker
+
+    def _merge_directory(self):
+        updated = False
+        # empty() of an inter-process queue may be stale, drain until get_nowait finds nothing
+        while True:
+            try:
+                index, stations = self._directory.get_nowait()
+            except queue.Empty:
+                break
+            self._shards[index] = stations
+            updated = True
+        if not updated:
+            return
+        self._owners = {cs_id: index for index, stations in self._shards.items() for cs_id in stations.values()}
+        stations = {}
+        [stations.update(shard) for shard in self._shards.values()]
+        self.queue['ev_chargers_available'].put_nowait(stations)
+        WAKEUPS.signal('stations_available')
+
+    def _broadcast(self, command: FleetCommand):
+        """ Every worker runs the fleet command on the stations it owns, their results are merged """
+        self._fleet_commands[command.command_id] = (command, set(self._workers), FleetResult(command.method))
+        [self._commands[index].put(command) for index in self._workers]
+
+    def _merge_replies(self, dead_worker: int = None):
+        replies = []
+        while True:
+            try:
+                replies.append(self._replies.get_nowait())
+            except queue.Empty:
+                break
+        for index, command_id, result in replies:
+            if command_id in self._fleet_commands:
+                self._fleet_commands[command_id][1].discard(index)
+                self._fleet_commands[command_id][2].merge(result)
+        for command_id, (command, waiting, result) in list(self._fleet_commands.items()):
+            # A worker that died will never reply, its stations are gone with it
+            waiting.discard(dead_worker)
+            if not waiting:
+                del self._fleet_commands[command_id]
+                if command.result and not command.result.done():
+                    command.result.set_result(result)
+
+    def _route(self, cs_id: str, method: str, kwargs: dict):
+        if cs_id not in self._owners:
+            self.console.warning(f'Command {method} dropped, no worker owns station {cs_id}.')
+            return
+        self._commands[self._owners[cs_id]].put((cs_id, method, kwargs))
+
+    async def _prepare(self):
+        if not {'ev_charger_command', 'ev_chargers_available'}.issubset(self.queue.keys()):
+            raise AssertionError("Please register queues 'ev_charger_command' and 'ev_chargers_available' on the app.")
+        for index in range(self.worker_count):
+            if index not in self._workers or not self._workers[index].is_alive():
+                self._start_worker(index)
+        self.console.info(f'Server running {self.worker_count} workers on '
+                          f'http://{self.server_address[0]}:{self.server_address[1]}')
+
+    async def _main(self):
+        for index, worker in self._workers.items():
+            if not worker.is_alive():
+                self.console.error(f'{worker.name} exited with code {worker.exitcode}. Restarting.')
+                self._shards[index] = {}
+                self._merge_replies(dead_worker=index)
+                self._start_worker(index)
+        self._merge_directory()
+        self._merge_replies()
+        try:
+            command = await asyncio.wait_for(self.queue['ev_charger_command'].get(),
+                                             self.wait_interval.total_seconds())
+            if isinstance(command, FleetCommand):
+                self._broadcast(command)
+            else:
+                self._route(*command)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _finish(self):
+        pass
+
+    def _handle_exception(self, e: Exception):
+        self.console.error(f'Ocpp16 Server workers failed because {e.with_traceback(e.__traceback__)}')
@@ -0,0 +1,124 @@
+"""
+Configuration file change notifications with inotify, polling where it is not available
+"""
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import select
+import time
+
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+
+def _inotify():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        return libc if hasattr(libc, 'inotify_init1') else None
+    except OSError:
+        return None
+
+
+class FileWatcher:
+    """
+    Watches the directory of a file, so files created later or replaced by a rename are seen too. A change is a new
+    modification time or size; inotify events only wake the waiter early, polling still catches anything missed.
+    """
+
+    def __init__(self, path: str, poll_interval: float = 3):
+        """
+        :param path: File to watch, it may not exist yet
+        :param poll_interval: Seconds between checks when inotify is not available
+        """
+        self.path = os.path.abspath(path)
+        self.poll_interval = poll_interval
+        self.fd = None
+        libc = _inotify()
+        if libc and os.path.isdir(os.path.dirname(self.path)):
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+            if fd >= 0 and libc.inotify_add_watch(fd, os.path.dirname(self.path).encode(), mask) >= 0:
+                self.fd = fd
+            elif fd >= 0:
+                os.close(fd)
+        self._signature = self._stat()
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+            return stat.st_mtime_ns, stat.st_size
+        except FileNotFoundError:
+            return None
+
+    def _drain(self):
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def changed(self) -> bool:
+        """ Check without waiting if the file was created or modified since the last call """
+        if self.fd is not None:
+            self._drain()
+        signature = self._stat()
+        if signature == self._signature:
+            return False
+        self._signature = signature
+        return signature is not None
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Block until the file is created or modified.
+        :param timeout: Seconds, wait forever if omitted
+        :return: False if the timeout expired first
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.changed():
+            pause = self.poll_interval if deadline is None else min(self.poll_interval, deadline - time.monotonic())
+            if pause <= 0:
+                return False
+            if self.fd is not None:
+                select.select([self.fd], [], [], pause)
+            else:
+                time.sleep(pause)
+        return True
+
+    async def wait_async(self):
+        """ Same as wait without a timeout, for coroutines. inotify events wake the event loop directly. """
+        loop = asyncio.get_event_loop()
+        wake = asyncio.Event()
+        if self.fd is not None:
+            loop.add_reader(self.fd, wake.set)
+        try:
+            while not self.changed():
+                try:
+                    await asyncio.wait_for(wake.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                wake.clear()
+        finally:
+            if self.fd is not None:
+                loop.remove_reader(self.fd)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def wait_for_file(path: str, poll_interval: float = 3):
+    """ Return as soon as the file exists """
+    if os.path.exists(path):
+        return
+    watcher = FileWatcher(path, poll_interval)
+    try:
+        while not os.path.exists(path):
+            watcher.wait()
+    finally:
+        watcher.close()
@@ -0,0 +1,161 @@
+import asyncio
+from copy import deepcopy
+
+import tasks.database.dao as dao
+from tasks.metrics import REGISTRY
+
+MAILBOX_DEPTH = REGISTRY.gauge('actor_mailbox_depth', 'Messages waiting in all the actors mailboxes.')
+
+# Mailbox message replacing the state, see ActorDAO.update
+_REPLACE = object()
+
+
+class Actor:
+    """
+    Owns one object. Its handlers run one at a time in the order they were sent, readers get a copy of the object
+    made at most once per change.
+    """
+
+    def __init__(self, state: dao.Model):
+        self._state = state
+        self._mailbox = asyncio.Queue()
+        self._version = 0
+        self._snapshot = (None, None)
+        self._task = asyncio.ensure_future(self._run())
+
+    def send(self, handler, *args) -> asyncio.Future:
+        """
+        :param handler: Called with the state and args, it must not await, so nothing else sees the state half changed
+        :return: Future of the handler result
+        """
+        future = asyncio.get_event_loop().create_future()
+        self._mailbox.put_nowait((handler, args, future))
+        return future
+
+    def snapshot(self) -> dao.Model:
+        """ Copy of the state, shared by the readers until the next change, do not change it """
+        version, snapshot = self._snapshot
+        if version != self._version:
+            snapshot = deepcopy(self._state)
+            self._snapshot = (self._version, snapshot)
+        return snapshot
+
+    def stop(self):
+        """ Stop once the messages already sent are handled """
+        self._mailbox.put_nowait((None, (), None))
+
+    async def _run(self):
+        while True:
+            handler, args, future = await self._mailbox.get()
+            if handler is None:
+                return
+            try:
+                if handler is _REPLACE:
+                    self._state = args[0]
+                    result = None
+                else:
+                    result = handler(self._state, *args)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self._version += 1
+
+
+class ActorDAO(dao.DAO):
+    """
+    Keep each object in memory owned by an actor, instead of copying it in and out of a store on every change.
+    Writers send handlers to the object actor with tell or ask, the DAO reads return snapshots.
+    """
+
+    def __init__(self):
+        dao.DAO.register(ActorDAO)
+        self._actors = {}
+        MAILBOX_DEPTH.set_function(lambda: sum(actor._mailbox.qsize() for actor in self._actors.values()))
+
+    def __contains__(self, reg_id):
+        return reg_id in self._actors
+
+    def _actor(self, reg_id) -> Actor:
+        if reg_id not in self._actors:
+            raise FileNotFoundError
+        return self._actors[reg_id]
+
+    def create(self, obj):
+        """ The actor takes the object over, the caller must not change it afterwards """
+        if obj.reg_id in self._actors:
+            self._actors[obj.reg_id].stop()
+        self._actors[obj.reg_id] = Actor(obj)
+
+    def retrieve(self, reg_id):
+        return self._actor(reg_id).snapshot()
+
+    def retrieve_all(self):
+        return [actor.snapshot() for actor in self._actors.values()]
+
+    def version(self, reg_id) -> int:
+        """ Number of handlers the object actor ran, it changes whenever the object may have """
+        return self._actor(reg_id)._version
+
+    def peek(self, reg_id):
+        """ The object itself, see peek_all """
+        return self._actor(reg_id)._state
+
+    def peek_all(self) -> list:
+        """
+        The objects themselves, without copying, for synchronous scans of a few attributes.
+        Do not change them nor keep them across an await.
+        """
+        return [actor._state for actor in self._actors.values()]
+
+    def update(self, obj):
+        """ Replace the object once the handlers already sent to its actor are done """
+        self._actor(obj.reg_id).send(_REPLACE, obj)
+
+    def delete(self, obj):
+        self._actors.pop(obj.reg_id).stop()
+
+    async def remove(self, reg_id):
+        """
+        Stop the object actor once the handlers already sent to it are done, later ones raise FileNotFoundError
+        :return: The object in its final state
+        """
+        actor = self._actors.pop(reg_id)
+        actor.stop()
+        await actor._task
+        return actor._state
+
+    def find_by(self, attributes: dict):
+        result = [actor.snapshot() for actor in self._actors.values()
+                  if all(getattr(actor._state, k, None) == v for k, v in attributes.items())]
+        if len(result) < 1:
+            raise FileNotFoundError
+        return result
+
+    def tell(self, reg_id, handler, *args) -> asyncio.Future:
+        """
+        Send a handler to the object actor without waiting for it.
+        :param handler: Called with the object and args
+        :return: Future of the handler result
+        """
+        return self._actor(reg_id).send(handler, *args)
+
+    async def ask(self, reg_id, handler, *args):
+        """ Send a handler to the object actor and wait for its result """
+        return await self._actor(reg_id).send(handler, *args)
+
+
+class ActorDAOFactory(dao.DAOFactory):
+
+    def __init__(self):
+        super().__init__()
+        self.__instances = {}
+
+    def get_instance(self, cls) -> ActorDAO:
+        if id(cls) in list(self.__instances.keys()):
+            return self.__instances[id(cls)]
+        self.__instances[id(cls)] = ActorDAO()
+        return self.__instances[id(cls)]
@@ -0,0 +1,119 @@
+"""
+Read-through cache of Elasticsearch documents and search hits, so polling the same unchanged documents does not reach
+the cluster. Writes made by this process drop what they change, writes of other processes are seen once the entries
+expire.
+"""
+import collections
+import copy
+import json
+import threading
+import time
+
+from tasks.metrics import REGISTRY
+
+CACHE_ITEMS = REGISTRY.gauge('es_cache_items', 'Reads kept in the Elasticsearch cache.')
+CACHE_REQUESTS = REGISTRY.counter('es_cache_requests_total', 'Cacheable Elasticsearch reads per index and result.',
+                                  ('index', 'result'))
+CACHE_EVICTIONS = REGISTRY.counter('es_cache_evictions_total', 'Reads dropped from the Elasticsearch cache.',
+                                   ('reason',))
+
+
+class DocumentCache:
+    """
+    Least recently used reads keyed by index, kind and key: ('get', document id) or ('search', request body
+    fingerprint). Values are copied in and out, callers are free to change the documents they get.
+    """
+
+    def __init__(self, size: int = 4096, ttl: float = 5, ttls: dict = None):
+        """
+        :param size: Reads kept at most
+        :param ttl: Seconds a read is served from the cache
+        :param ttls: {index: seconds} overriding ttl, 0 not to cache the index, i.e. documents written by other apps
+        """
+        self.size = size
+        self.ttl = ttl
+        self.ttls = ttls if ttls else {}
+        # (index, kind, key) -> (expiry, value), least recently used first
+        self._entries = collections.OrderedDict()
+        # index -> keys of its searches, any write to the index may change them
+        self._searches = {}
+        # DAOs are also used from executor threads
+        self._lock = threading.Lock()
+        CACHE_ITEMS.set_function(self.__len__)
+
+    @staticmethod
+    def from_config(cache_config: dict):
+        """
+        :param cache_config: Keyword arguments of DocumentCache, None to disable it
+        """
+        if not cache_config:
+            return None
+        return DocumentCache(**cache_config)
+
+    @staticmethod
+    def fingerprint(body: dict) -> str:
+        return json.dumps(body, sort_keys=True, default=str)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, index: str, kind: str, key: str):
+        """
+        :return: Copy of the value read before, None if missing or expired
+        """
+        entry_key = (index, kind, key)
+        with self._lock:
+            entry = self._entries.get(entry_key)
+            if entry is not None and entry[0] <= time.monotonic():
+                self._drop(entry_key)
+                CACHE_EVICTIONS.inc(reason='ttl')
+                entry = None
+            if entry is None:
+                CACHE_REQUESTS.inc(index=index, result='miss')
+                return None
+            self._entries.move_to_end(entry_key)
+        CACHE_REQUESTS.inc(index=index, result='hit')
+        return copy.deepcopy(entry[1])
+
+    def put(self, index: str, kind: str, key: str, value):
+        ttl = self.ttls.get(index, self.ttl)
+        if not ttl:
+            return
+        entry_key = (index, kind, key)
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._entries[entry_key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(entry_key)
+            if kind == 'search':
+                self._searches.setdefault(index, set()).add(entry_key)
+            while len(self._entries) > self.size:
+                self._drop(next(iter(self._entries)))
+                CACHE_EVICTIONS.inc(reason='size')
+
+    def invalidate(self, index: str, doc_id: str = None):
+        """
+        Drop the reads a write may have changed
+        :param doc_id: Document written, None if any document of the index may have changed
+        """
+        with self._lock:
+            if doc_id is None:
+                dropped = [key for key in self._entries if key[0] == index]
+            else:
+                dropped = [(index, 'get', str(doc_id))] + list(self._searches.get(index, ()))
+            dropped = [key for key in dropped if key in self._entries]
+            [self._drop(key) for key in dropped]
+        if dropped:
+            CACHE_EVICTIONS.inc(len(dropped), reason='write')
+
+    def clear(self):
+        with self._lock:
+            dropped = len(self._entries)
+            self._entries.clear()
+            self._searches.clear()
+        if dropped:
+            CACHE_EVICTIONS.inc(dropped, reason='write')
+
+    def _drop(self, entry_key: tuple):
+        del self._entries[entry_key]
+        if entry_key[1] == 'search':
+            self._searches.get(entry_key[0], set()).discard(entry_key)
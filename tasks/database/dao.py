@@ -7,6 +7,14 @@ import energyweb
 
 class Model(energyweb.Serializable):
     """ MVC Concrete Model """
+    # Dataclass models do not call __init__, they are not in the database until reg_id is set
+    reg_id = None
+    # Hash of the class, combined with the reg_id hash of each instance
+    _class_hash = 0
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._class_hash = hash(f'{cls.__module__}.{cls.__qualname__}')
 
     def __init__(self, reg_id=None):
         """
@@ -24,7 +32,7 @@ class Model(energyweb.Serializable):
     def __hash__(self):
         if self.reg_id is None:
             raise AssertionError('Object is not in sync with the object in db session.')
-        return hash(''.join(dir(self))) ^ hash(self.reg_id)
+        return self._class_hash ^ hash(self.reg_id)
 
     def __repr__(self):
         return '%s(%s)' % (self.__class__.__name__, self.reg_id)
@@ -1,12 +1,50 @@
+import functools
 import logging
+import time
 
 import elasticsearch as es
 
 from tasks.database import dao
+from tasks.database.mappings import index_body
+from tasks.metrics import REGISTRY
 from tasks.ocpp16.protocol import ChargingStation
 
+CALL_SECONDS = REGISTRY.histogram('elasticsearch_call_seconds', 'Latency of ElasticSearchDAO calls.',
+                                  ('index', 'method'))
+CALL_ERRORS = REGISTRY.counter('elasticsearch_call_errors_total', 'Failed ElasticSearchDAO calls.',
+                               ('index', 'method'))
+
+
+def instrumented(method):
+    """ Measure latency and errors of a DAO method per index """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        except Exception:
+            CALL_ERRORS.inc(index=self._index, method=method.__name__)
+            raise
+        finally:
+            CALL_SECONDS.observe(time.perf_counter() - start, index=self._index, method=method.__name__)
+
+    return wrapper
+
+
+# (service_urls, index) -> {field: name to filter on}, indices are prepared once per process
+_PREPARED = {}
+# (service_urls, index) -> monotonic time to try preparing it again after a failure
+_RETRY_AT = {}
+# Seconds between attempts to prepare an index while elastic search is unreachable
+PREPARE_RETRY = 30
+
 
 class ElasticSearchDAO(dao.DAO):
+    # tasks.database.spool.WriteSpool keeping the writes made while elastic search is unreachable, they raise if None
+    spool = None
+    # tasks.database.cache.DocumentCache of the reads, every read reaches elastic search if None
+    cache = None
 
     def __init__(self, id_att_name: str, cls, *service_urls: str):
         """
@@ -21,70 +59,227 @@ class ElasticSearchDAO(dao.DAO):
         # suppress warnings
         es_logger = logging.getLogger('elasticsearch')
         es_logger.setLevel(logging.ERROR)
+        self._fields = self._prepare_index(service_urls)
+
+    def _prepare_index(self, service_urls: tuple) -> dict:
+        """
+        Create the index with its explicit mapping if missing. Indices created before by dynamic mapping keep it, their
+        analyzed identifiers are filtered on the .keyword sub field instead.
+        :return: {field: field name for term filters}
+        """
+        key = (tuple(service_urls), self._index)
+        if key in _PREPARED:
+            return _PREPARED[key]
+        if time.monotonic() < _RETRY_AT.get(key, 0):
+            return {}
+        try:
+            try:
+                # The mapping is nested under the DAO type, Elasticsearch 7 refuses it unless told so
+                self._db.indices.create(self._index, body=index_body(self._index, self._doc_type),
+                                        include_type_name=True)
+            except es.RequestError as e:
+                if e.error != 'resource_already_exists_exception':
+                    # The index keeps its dynamic mapping
+                    logging.getLogger(__name__).error(f'Mapping of index {self._index} refused: {e.info}')
+            mapping = self._db.indices.get_mapping(self._index)[self._index]['mappings']
+            properties = mapping.get(self._doc_type, mapping).get('properties', {})
+        except es.ElasticsearchException:
+            # Not reachable yet, filter on the field names and try again with a DAO made after PREPARE_RETRY
+            _RETRY_AT[key] = time.monotonic() + PREPARE_RETRY
+            return {}
+        analyzed = [name for name, prop in properties.items()
+                    if prop.get('type') == 'text' and 'keyword' in prop.get('fields', {})]
+        _PREPARED[key] = {name: f'{name}.keyword' for name in analyzed}
+        return _PREPARED[key]
+
+    def filter_query(self, attributes: dict = None, exists: tuple = (), missing: tuple = ()) -> dict:
+        """
+        Bool query in filter context, it is not scored and elastic search caches it between polls.
+        :param attributes: {field: value} exact match, {field: [values]} any of or {field: {'gte': ..., 'lt': ...}} range
+        :param exists: Fields that must be set
+        :param missing: Fields that must not be set, as well as attributes with a None value
+        """
+        filters, must_not = [], [{'exists': {'field': field}} for field in missing]
+        for name, value in (attributes if attributes else {}).items():
+            field = self._fields.get(name, name)
+            if value is None:
+                must_not.append({'exists': {'field': name}})
+            elif isinstance(value, dict):
+                filters.append({'range': {name: value}})
+            elif isinstance(value, (list, tuple, set)):
+                filters.append({'terms': {field: list(value)}})
+            else:
+                filters.append({'term': {field: value}})
+        filters += [{'exists': {'field': field}} for field in exists]
+        query = {'filter': filters}
+        if must_not:
+            query['must_not'] = must_not
+        return {'bool': query}
+
+    def _cached(self, kind: str, key: str, read):
+        """
+        :param kind: 'get' for a document id, 'search' for a request body fingerprint
+        :param read: Function reading from elastic search on a miss
+        """
+        if self.cache is None:
+            return read()
+        value = self.cache.get(self._index, kind, key)
+        if value is None:
+            value = read()
+            self.cache.put(self._index, kind, key, value)
+        return value
+
+    def _search(self, body: dict, refresh: bool = False) -> list:
+        """ Hits of a search request, cached by its fingerprint """
+
+        def read():
+            if refresh:
+                self._db.indices.refresh(self._index)
+            return self._db.search(self._index, body=body)['hits']['hits']
 
+        fingerprint = self.cache.fingerprint(body) if self.cache is not None else None
+        return self._cached('search', fingerprint, read)
+
+    def _invalidate(self, doc_id: str = None):
+        if self.cache is not None:
+            self.cache.invalidate(self._index, doc_id)
+
+    def _objects(self, hits: list) -> list:
+        """ Instantiate search hits, the versions still waiting in the spool replace the stale ones """
+        objs = []
+        for hit in hits:
+            pending = self.spool.get(self._index, hit['_id']) if self.spool is not None else None
+            obj = self._cls.from_dict(pending if pending else hit['_source'])
+            obj.reg_id = hit['_id']
+            objs.append(obj)
+        return objs
+
+    @instrumented
     def create(self, obj: dao.Model):
-        res = self._db.index(index=self._index, doc_type=self._doc_type, body=obj.to_dict(), id=obj.reg_id,
-                             refresh=True)
+        body = obj.to_dict()
+        try:
+            res = self._db.index(index=self._index, doc_type=self._doc_type, body=body, id=obj.reg_id, refresh=True)
+        except es.ConnectionError:
+            if self.spool is None or obj.reg_id is None:
+                raise
+            self.spool.put(self._index, self._doc_type, obj.reg_id, body)
+            self._invalidate(obj.reg_id)
+            return
+        # New documents get their id from elastic search, only searches may have them
+        self._invalidate(obj.reg_id if obj.reg_id is not None else res['_id'])
         if not res['result'] in ('created', 'updated'):
             raise es.ElasticsearchException('Fail creating or updating the object in the database')
+        if self.spool is not None and len(self.spool):
+            # Replaying an older pending version would overwrite this one
+            self.spool.discard(self._index, obj.reg_id)
+            # Elastic search is back, processes without ElasticSyncTask replay as they write
+            self.replay_spool(max_batches=1)
+
+    def replay_spool(self, max_batches: int = 10) -> int:
+        """
+        Deliver spooled writes of any index, see WriteSpool.replay
+        :return: Documents delivered
+        """
+        delivered = self.spool.replay(self._db, max_batches) if self.spool is not None else 0
+        if delivered and self.cache is not None:
+            # Cached reads of the delivered documents predate them, the spool no longer overrides them
+            self.cache.clear()
+        return delivered
 
+    @instrumented
     def retrieve(self, _id):
-        self._db.indices.refresh(self._index)
-        res = self._db.get(self._index, self._doc_type, id=_id)
+        # Get is real time, no refresh needed
+        res = self._cached('get', str(_id), lambda: self._db.get(index=self._index, id=_id, doc_type=self._doc_type))
         if not res['found']:
-            raise es.ElasticsearchException('Object not found.')
-        obj = self._cls.from_dict(res['_source'])
-        obj.reg_id = res['_id']
-        return obj
+            raise es.NotFoundError(404, 'Object not found.')
+        return self._objects([res])[0]
 
-    def retrieve_all(self):
-        self._db.indices.refresh(self._index)
-        res = self._db.search(self._index, body={"query": {"match_all": {}}})
-        objs = []
-        for hit in res['hits']['hits']:
-            obj = self._cls.from_dict(hit['_source'])
-            obj.reg_id = hit['_id']
-            objs.append(obj)
-        return objs
+    @instrumented
+    def retrieve_all(self, size: int = None):
+        """
+        :param size: Maximum number of documents, elastic search returns 10 if omitted
+        """
+        body = {"query": {"match_all": {}}}
+        if size:
+            body['size'] = size
+        return self._objects(self._search(body, refresh=True))
 
     def update(self, obj: dao.Model):
         self.create(obj)
 
+    @instrumented
     def delete(self, obj: dao.Model):
         response = self._db.delete(index=self._index, doc_type=self._doc_type, id=obj.reg_id)
+        self._invalidate(obj.reg_id)
         if not response['result'] == 'deleted':
             raise es.ElasticsearchException('Object not found.')
 
+    @instrumented
     def find_by(self, attributes: [dict]) -> [dict]:
-        self._db.indices.refresh(self._index)
-        query = {"query": {"bool": {"must": [{"match": {k: attributes[k]}} for k in attributes]}}}
-        res = self._db.search(self._index, body=query)
-        objs = []
-        for hit in res['hits']['hits']:
-            obj = self._cls.from_dict(hit['_source'])
-            obj.reg_id = hit['_id']
-            objs.append(obj)
-        return objs
+        # Own writes refresh the index, refreshing again on every poll would also invalidate the filter cache
+        return self._objects(self._search({"query": self.filter_query(attributes)}))
 
+    @instrumented
+    def update_all(self, objs: [dao.Model]):
+        """ Write several objects in one bulk request, see create """
+        if not objs:
+            return
+        lines, bodies = [], []
+        for obj in objs:
+            action = {'_index': self._index, '_type': self._doc_type}
+            if obj.reg_id is not None:
+                action['_id'] = obj.reg_id
+            bodies.append(obj.to_dict())
+            lines += [{'index': action}, bodies[-1]]
+        try:
+            res = self._db.bulk(body=lines, refresh=True)
+        except es.ConnectionError:
+            if self.spool is None or any(obj.reg_id is None for obj in objs):
+                raise
+            for obj, body in zip(objs, bodies):
+                self.spool.put(self._index, self._doc_type, obj.reg_id, body)
+                self._invalidate(obj.reg_id)
+            return
+        for item in res['items']:
+            self._invalidate(item['index'].get('_id'))
+        failed = [item for item in res['items'] if item['index'].get('status', 500) >= 300]
+        if failed:
+            raise es.ElasticsearchException(f'Fail creating or updating {len(failed)} objects in the database')
+        if self.spool is not None and len(self.spool):
+            [self.spool.discard(self._index, obj.reg_id) for obj in objs]
+            self.replay_spool(max_batches=1)
+
+    @instrumented
     def delete_all(self):
         self._db.delete_by_query(self._index, body={"query": {"match_all": {}}})
+        self._invalidate()
 
+    @instrumented
     def delete_all_blank(self, field: str):
-        self._db.delete_by_query(self._index, body={"bool": {"must_not": {"exists": {"field": field}}}})
+        self._db.delete_by_query(self._index, body={"query": self.filter_query(missing=(field,))})
+        self._invalidate()
 
+    @instrumented
     def query(self, query: dict) -> [dict]:
         """
         :param query: https://www.elastic.co/guide/en/elasticsearch/reference/5.6/query-filter-context.html
+        see filter_query
         :return: dict
         """
-        self._db.indices.refresh(self._index)
-        res = self._db.search(self._index, body={"query": query})
-        objs = []
-        for hit in res['hits']['hits']:
-            obj = self._cls.from_dict(hit['_source'])
-            obj.reg_id = hit['_id']
-            objs.append(obj)
-        return objs
+        return self._objects(self._search({"query": query}))
+
+    @instrumented
+    def multi_query(self, queries: [dict]) -> list:
+        """
+        Run several queries in one multi search request, see query
+        :return: Objects of each query in order, or the ElasticsearchException of the queries that failed
+        """
+        lines = []
+        for query in queries:
+            lines += [{'index': self._index}, {'query': query}]
+        res = self._db.msearch(body=lines)
+        return [es.ElasticsearchException(response['error']) if 'error' in response
+                else self._objects(response['hits']['hits']) for response in res['responses']]
 
 
 class ElasticSearchDAOFactory(dao.DAOFactory):
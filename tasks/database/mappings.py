@@ -0,0 +1,72 @@
+"""
+Explicit Elasticsearch mappings of the indices used by the tasks. Identifiers are keywords so they are matched
+exactly in filter context, dates and numbers get their own types instead of whatever dynamic mapping guesses first.
+"""
+
+KEYWORD = {'type': 'keyword'}
+DATE = {'type': 'date'}
+INTEGER = {'type': 'integer'}
+LONG = {'type': 'long'}
+DOUBLE = {'type': 'double'}
+BOOLEAN = {'type': 'boolean'}
+# Free form metadata sent by the chargers, kept in the document but not indexed
+OPAQUE = {'type': 'object', 'enabled': False}
+
+# Fields not listed are still mapped dynamically, strings as keywords
+DYNAMIC_TEMPLATES = [{'strings_as_keywords': {'match_mapping_type': 'string', 'mapping': KEYWORD}}]
+
+MAPPINGS = {
+    'charging-stations': {
+        'reg_id': KEYWORD,
+        'host': KEYWORD,
+        'port': INTEGER,
+        'serial_number': KEYWORD,
+        'last_seen': DATE,
+        'last_tx_id': LONG,
+        'metadata': OPAQUE,
+        'connectors': OPAQUE,
+        'last_heartbeat': OPAQUE,
+    },
+    'transactions': {
+        'tx_id': LONG,
+        'tag_id': KEYWORD,
+        'connector_id': INTEGER,
+        'cs_reg_id': KEYWORD,
+        'time_start': DATE,
+        'time_stop': DATE,
+        'meter_start': LONG,
+        'meter_stop': LONG,
+        'co2_saved': DOUBLE,
+        'meter_curve': OPAQUE,
+    },
+    'tags': {
+        'tag_id': KEYWORD,
+        'expiry_date': DATE,
+        'last_used_in': KEYWORD,
+    },
+    'energy-rollups': {
+        'granularity': KEYWORD,
+        'dimension': KEYWORD,
+        'key': KEYWORD,
+        'start': DATE,
+        'energy': DOUBLE,
+        'sessions': INTEGER,
+        'source': KEYWORD,
+    },
+    'charging-control': {
+        'command': KEYWORD,
+        'cs_id': KEYWORD,
+        'tag_id': KEYWORD,
+        'received': BOOLEAN,
+    },
+}
+
+
+def index_body(index: str, doc_type: str) -> dict:
+    """
+    :param index: Index name, indices without explicit mapping only get the dynamic templates
+    :param doc_type: Mapping type, the DAO class name
+    :return: Body of the create index request
+    """
+    return {'mappings': {doc_type: {'dynamic_templates': DYNAMIC_TEMPLATES,
+                                    'properties': MAPPINGS.get(index, {})}}}
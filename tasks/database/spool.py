@@ -0,0 +1,139 @@
+"""
+Store and forward spool of Elasticsearch writes made while the cluster is unreachable
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import elasticsearch as es
+
+from tasks.backpressure import TokenBucket
+from tasks.metrics import REGISTRY
+
+SPOOL_ITEMS = REGISTRY.gauge('es_spool_items', 'Writes waiting in the spool.')
+SPOOL_AGE = REGISTRY.gauge('es_spool_oldest_seconds', 'Age of the oldest write waiting in the spool.')
+SPOOL_REPLAYED = REGISTRY.counter('es_spool_replayed_total', 'Spooled writes delivered to Elasticsearch.')
+SPOOL_DROPPED = REGISTRY.counter('es_spool_dropped_total', 'Spooled writes given up.', ('reason',))
+
+
+class WriteSpool:
+    """
+    Pending documents in a SQLite file keyed by index and document id, so writing the same document again replaces
+    the pending version and replaying twice is harmless. Full spools drop their oldest documents.
+    """
+
+    def __init__(self, path: str, max_items: int = 100000, batch_size: int = 500, rate: float = 2):
+        """
+        :param path: SQLite file, its directory is created if missing
+        :param max_items: Documents kept at most
+        :param batch_size: Documents per bulk request on replay
+        :param rate: Bulk requests per second on replay
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_items = max_items
+        self.batch_size = batch_size
+        self._bucket = TokenBucket(rate, 1)
+        # DAOs also read the spool from executor threads
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._db.execute('CREATE TABLE IF NOT EXISTS pending (idx TEXT, doc_id TEXT, doc_type TEXT, body TEXT, '
+                         'spooled REAL, PRIMARY KEY (idx, doc_id))')
+        self._db.commit()
+        self._count = self._db.execute('SELECT COUNT(*) FROM pending').fetchone()[0]
+        SPOOL_ITEMS.set_function(self.__len__)
+        SPOOL_AGE.set_function(self.oldest_age)
+
+    @staticmethod
+    def from_config(spool_config: dict, suffix: str = ''):
+        """
+        :param spool_config: Keyword arguments of WriteSpool, None to disable it
+        :param suffix: Appended to the path, processes must not share a spool
+        """
+        if not spool_config:
+            return None
+        return WriteSpool(**dict(spool_config, path=spool_config['path'] + suffix))
+
+    def __len__(self):
+        return self._count
+
+    def oldest_age(self) -> float:
+        if not self._count:
+            return 0
+        with self._lock:
+            oldest = self._db.execute('SELECT MIN(spooled) FROM pending').fetchone()[0]
+        return time.time() - oldest if oldest is not None else 0
+
+    def put(self, index: str, doc_type: str, doc_id: str, body: dict):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO pending VALUES (?, ?, ?, ?, ?)',
+                             (index, str(doc_id), doc_type, json.dumps(body, default=str), time.time()))
+            overflow = self._db.execute('SELECT COUNT(*) FROM pending').fetchone()[0] - self.max_items
+            if overflow > 0:
+                self._db.execute('DELETE FROM pending WHERE rowid IN '
+                                 '(SELECT rowid FROM pending ORDER BY spooled LIMIT ?)', (overflow,))
+            self._db.commit()
+            self._count = self._db.execute('SELECT COUNT(*) FROM pending').fetchone()[0]
+        if overflow > 0:
+            SPOOL_DROPPED.inc(overflow, reason='full')
+
+    def get(self, index: str, doc_id: str) -> dict or None:
+        """ Pending version of a document, readers use it over the stale one in Elasticsearch """
+        if not self._count:
+            return None
+        with self._lock:
+            row = self._db.execute('SELECT body FROM pending WHERE idx = ? AND doc_id = ?',
+                                   (index, str(doc_id))).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def discard(self, index: str, doc_id: str):
+        """ Forget the pending version of a document written directly since """
+        if not self._count:
+            return
+        with self._lock:
+            self._db.execute('DELETE FROM pending WHERE idx = ? AND doc_id = ?', (index, str(doc_id)))
+            self._db.commit()
+            self._count = self._db.execute('SELECT COUNT(*) FROM pending').fetchone()[0]
+
+    def replay(self, client: es.Elasticsearch, max_batches: int = 10) -> int:
+        """
+        Deliver the oldest documents in bulk, at most rate batches per second. Stops at the first failed request.
+        :return: Documents delivered
+        """
+        delivered = 0
+        for _ in range(max_batches):
+            if not self._count or not self._bucket.consume():
+                break
+            with self._lock:
+                rows = self._db.execute('SELECT idx, doc_id, doc_type, body FROM pending ORDER BY spooled LIMIT ?',
+                                        (self.batch_size,)).fetchall()
+            lines = []
+            for index, doc_id, doc_type, body in rows:
+                lines.append(json.dumps({'index': {'_index': index, '_type': doc_type, '_id': doc_id}}))
+                lines.append(body)
+            try:
+                res = client.bulk(body='\n'.join(lines) + '\n', refresh=True)
+            except es.TransportError:
+                # Unreachable or overloaded, try again on the next replay
+                break
+            done, rejected = [], 0
+            for (index, doc_id, _, _), item in zip(rows, res['items']):
+                status = item['index'].get('status', 500)
+                # Mapping and validation errors would fail forever, throttling and server errors are retried
+                if status < 300 or (400 <= status < 500 and status != 429):
+                    done.append((index, doc_id))
+                    rejected += status >= 300
+            with self._lock:
+                self._db.executemany('DELETE FROM pending WHERE idx = ? AND doc_id = ?', done)
+                self._db.commit()
+                self._count = self._db.execute('SELECT COUNT(*) FROM pending').fetchone()[0]
+            SPOOL_REPLAYED.inc(len(done) - rejected)
+            if rejected:
+                SPOOL_DROPPED.inc(rejected, reason='rejected')
+            delivered += len(done) - rejected
+            if len(done) < len(rows):
+                break
+        return delivered
@@ -5,15 +5,21 @@ import energyweb
 
 from tasks.database.dao import Model
 from tasks.database.elasticdao import ElasticSearchDAO
-from tasks.database.memorydao import MemoryDAOFactory, MemoryDAO
-from tasks.ocpp16.protocol import ChargingStation
+from tasks.scheduling import AdaptiveSchedule
 
 
 class DbListenTask(energyweb.Task, energyweb.Logger):
 
-    def __init__(self, queue: dict, interval: datetime.timedelta, service_urls: tuple):
+    def __init__(self, queue: dict, interval: datetime.timedelta, service_urls: tuple, schedule_config: dict = None):
+        """
+        :param interval: Wait after a check finding commands, checks back off up to 30 seconds while there are none
+        :param schedule_config: tasks.scheduling.AdaptiveSchedule options, a change of the available stations starts a
+        check right away
+        """
         self.service_urls = service_urls
         self.available_stations = {}
+        self.schedule = AdaptiveSchedule.from_config(schedule_config, min_interval=interval.total_seconds(),
+                                                     max_interval=30, events=('stations_available',))
         energyweb.Task.__init__(self, queue=queue, polling_interval=interval, eager=False, run_forever=True)
         energyweb.Logger.__init__(self, 'DbListenTask')
 
@@ -34,20 +40,17 @@ class DbListenTask(energyweb.Task, energyweb.Logger):
         pass
 
     async def _main(self, *args):
+        """
+        :return: False if there were no commands or it failed
+        """
 
         def create_message() -> tuple:
             cs_add = self.available_stations[cmd.cs_id]
             if cmd.command == 'start_transaction':
                 payload = {'tag_id': cmd.tag_id}
             elif cmd.command == 'stop_transaction':
-                cs: ChargingStation = mem_dao.retrieve(cs_add)
-                txs = [tx for k, tx in cs.transactions.items() if not tx.meter_stop]
-                if len(txs) > 0:
-                    txs.sort(key=lambda tx: tx.time_start)
-                    tx: ChargingStation.Transaction = txs.pop()
-                    payload = {'tx_id': tx.tx_id}
-                else:
-                    return None
+                # The station resolves its open transaction, it may live in an Ocpp16 worker process
+                return cs_add, 'stop_last_transaction', {}
             elif cmd.command == 'unlock_connector':
                 # TODO: Hardcoded value
                 payload = {'connector_id': 1}
@@ -62,24 +65,28 @@ class DbListenTask(energyweb.Task, energyweb.Logger):
             self.available_stations.update(self.queue['ev_chargers_available'].get_nowait())
 
         cmd_dao = ElasticSearchDAO('charging-control', DbListenTask.Command, *self.service_urls)
-        mem_dao: MemoryDAO = MemoryDAOFactory().get_instance(ChargingStation)
 
         try:
-            for cmd in cmd_dao.query({"bool": {"must": [{"exists": {"field": 'command'}},
-                                                        {"match": {"received": False}}]}}):
+            sent = 0
+            for cmd in cmd_dao.query(cmd_dao.filter_query({'received': False}, exists=('command',))):
                 if cmd.cs_id not in self.available_stations:
-                    return
+                    # Checked again once the station is available
+                    return sent > 0
                 message = create_message()
                 if message:
                     self.console.debug(f'DbListen sent msg: {message}')
                     await self.queue['ev_charger_command'].put(message)
                     cmd.received = True
                     cmd_dao.delete(cmd)
+                    sent += 1
+            return sent > 0
 
         except elasticsearch.ElasticsearchException as e1:
-            pass
+            # Cluster unreachable, back off
+            return False
         except Exception as e2:
             self._handle_exception(e2)
+            return False
 
     async def _finish(self):
         pass
@@ -1,18 +1,35 @@
+import asyncio
+import copy
 import datetime
-import uuid
 
 import elasticsearch
 import energyweb
 
 from tasks.database.elasticdao import ElasticSearchDAO
-from tasks.database.memorydao import MemoryDAO, MemoryDAOFactory
+from tasks.database.actordao import ActorDAO, ActorDAOFactory
 from tasks.ocpp16.protocol import ChargingStation
+from tasks.ocpp16.rollups import EnergyRollups
+from tasks.scheduling import WAKEUPS, AdaptiveSchedule
 
 
 class ElasticSyncTask(energyweb.Task, energyweb.Logger):
 
-    def __init__(self, queue: dict, interval: datetime.timedelta, service_urls: tuple):
+    def __init__(self, queue: dict, interval: datetime.timedelta, service_urls: tuple,
+                 max_closed_transactions: int = 20, max_tags: int = 50, schedule_config: dict = None):
+        """
+        :param interval: Wait after a sync with changes, syncs back off up to a minute while no station changes
+        :param max_closed_transactions: Closed transactions kept in memory per station once synced
+        :param max_tags: Tags kept in memory per station once synced
+        :param schedule_config: tasks.scheduling.AdaptiveSchedule options, stations booting and transactions closing
+        start a sync right away
+        """
         self.service_urls = service_urls
+        self.max_closed_transactions = max_closed_transactions
+        self.max_tags = max_tags
+        self.schedule = AdaptiveSchedule.from_config(schedule_config, min_interval=interval.total_seconds(),
+                                                     max_interval=60, events=('station_booted', 'transaction_closed'))
+        # cs_id -> actor version of the station last written, unchanged stations are not written again
+        self._synced_versions = {}
         energyweb.Task.__init__(self, queue=queue, polling_interval=interval, eager=False, run_forever=True)
         energyweb.Logger.__init__(self, 'ElasticSync')
 
@@ -20,62 +37,136 @@ class ElasticSyncTask(energyweb.Task, energyweb.Logger):
         pass
 
     async def _main(self, *args):
+        """
+        :return: False if there was nothing to sync or it failed
+        """
 
-        def merge_reconnected_stations():
-            merged_css = []
-            cs_index = {csk.serial_number: [cs for cs in mem_dao.retrieve_all() if csk.serial_number]
-                        for csk in mem_dao.retrieve_all() if csk.serial_number}
-            for css in cs_index.values():
-                css.sort(key=lambda cs: cs.last_seen, reverse=True)
-                if len(css) > 0:
-                    oldest: ChargingStation = css.pop()
-                    for cs in css:
-                        oldest.host = cs.host
-                        oldest.port = cs.port
-                        oldest.tags.update(cs.tags)
-                        oldest.transactions.update(cs.transactions)
-                        oldest.connectors.update(cs.connectors)
-                        oldest.last_heartbeat = cs.last_heartbeat
-                        mem_dao.delete(cs)
-                    mem_dao.update(oldest)
-                    merged_css.append(oldest)
-            return merged_css
+        async def merge_reconnected_stations() -> int:
+            """ Fold the history of the previous sessions of a station into its latest one """
+            merged = 0
+            sessions = {}
+            for cs in actors.peek_all():
+                if cs.serial_number:
+                    sessions.setdefault(cs.serial_number, []).append((cs.last_seen, cs.reg_id))
+            for ids in sessions.values():
+                if len(ids) < 2:
+                    continue
+                ids.sort()
+                latest = ids.pop()[1]
+                for _, cs_id in ids:
+                    # Timeouts, acks and syncs still in its mailbox are handled before the state is absorbed
+                    previous = await actors.remove(cs_id)
+                    await actors.ask(latest, ChargingStation.absorb, previous)
+                    merged += 1
+            return merged
 
         def remove_unknown_stations():
             try:
-                result = mem_dao.find_by({'serial_number': None})
-                [mem_dao.delete(cs) for cs in result]
+                result = actors.find_by({'serial_number': None})
+                [actors.delete(cs) for cs in result]
             except Exception as e:
                 pass
 
-        def update_elastic():
-            for cs in merged:
-                cs.reg_id = cs.serial_number
-                for tag in cs.tags.values():
-                    tag.reg_id = tag.tag_id
-                    tag.last_used_in = cs.reg_id
-                    els_tg_dao.update(tag)
-                cs.tags = {}
+        def write(els_dao: ElasticSearchDAO, obj, reg_id: str, **attributes):
+            doc = copy.copy(obj)
+            doc.reg_id = reg_id
+            for name, value in attributes.items():
+                setattr(doc, name, value)
+            els_dao.update(doc)
+
+        def update_rollups() -> int:
+            rollups = ChargingStation.rollups
+            if not rollups or not rollups.mirror:
+                return 0
+            changed = rollups.changed()
+            written = len(changed)
+            try:
+                while changed:
+                    write(els_ru_dao, changed[-1], changed[-1].doc_id())
+                    changed.pop()
+            finally:
+                rollups.retry(changed)
+            return written
+
+        async def update_elastic() -> (int, int):
+            """
+            :return: Documents written, transactions among them
+            """
+            written, closed = 0, 0
+            authorization = ChargingStation.authorization
+            if authorization:
+                for tag in authorization.unsynced():
+                    write(els_tg_dao, tag, tag.tag_id)
+                    authorization.mark_synced(tag.tag_id)
+                    written += 1
+            for cs_id in list(self._synced_versions):
+                if cs_id not in actors:
+                    del self._synced_versions[cs_id]
+            for cs_id in [cs.reg_id for cs in actors.peek_all()]:
+                if cs_id not in actors or self._synced_versions.get(cs_id) == actors.version(cs_id):
+                    continue
+                # The snapshot is written while the station keeps changing, only the history written is marked
+                cs = actors.retrieve(cs_id)
+                tags, transactions = [], {}
+                for tag in [tag for tag in cs.tags.values() if not tag.reg_id]:
+                    write(els_tg_dao, tag, tag.tag_id, last_used_in=cs.serial_number)
+                    tags.append(tag.tag_id)
                 for tx in [tx for tx in cs.transactions.values() if not tx.reg_id]:
-                    if tx.meter_start and tx.meter_stop:
-                        tx.reg_id = uuid.uuid4()
-                        tx.cs_reg_id = cs.reg_id
-                        els_tx_dao.update(tx)
-                cs.transactions = {}
-                els_cs_dao.update(cs)
+                    if tx.meter_start is not None and tx.meter_stop is not None:
+                        doc_id = self.transaction_id(cs, tx)
+                        write(els_tx_dao, tx, doc_id, cs_reg_id=cs.serial_number)
+                        transactions[tx.tx_id] = doc_id
+                if cs_id not in actors:
+                    continue
+                await actors.ask(cs_id, ChargingStation.mark_synced, transactions, tags)
+                await actors.ask(cs_id, ChargingStation.apply_retention, self.max_closed_transactions, self.max_tags)
+                write(els_cs_dao, actors.retrieve(cs_id), cs.serial_number)
+                self._synced_versions[cs_id] = actors.version(cs_id)
+                written += len(tags) + len(transactions) + 1
+                closed += len(transactions)
+            return written, closed
 
         els_cs_dao = ElasticSearchDAO('charging-stations', ChargingStation, *self.service_urls)
         els_tx_dao = ElasticSearchDAO('transactions', ChargingStation.Transaction, *self.service_urls)
         els_tg_dao = ElasticSearchDAO('tags', ChargingStation.Tag, *self.service_urls)
-        mem_dao: MemoryDAO = MemoryDAOFactory().get_instance(ChargingStation)
+        els_ru_dao = ElasticSearchDAO('energy-rollups', EnergyRollups.Bucket, *self.service_urls)
+        actors: ActorDAO = ActorDAOFactory().get_instance(ChargingStation)
         try:
-            merged = merge_reconnected_stations()
+            els_cs_dao.replay_spool()
+            merged = await merge_reconnected_stations()
             remove_unknown_stations()
-            update_elastic()
+            written, closed = await update_elastic()
+            written += update_rollups()
+            if closed:
+                # Producers reading transactions have new energy
+                WAKEUPS.signal('transactions_synced')
+            return bool(merged or written)
         except elasticsearch.ElasticsearchException as e1:
             self._handle_exception(e1)
+            # Cluster unreachable, back off
+            return False
         except Exception as e2:
             self._handle_exception(e2)
+            return False
+
+    @staticmethod
+    def transaction_id(cs: ChargingStation, tx: ChargingStation.Transaction) -> str:
+        """ Document id stable across syncs, writing the same transaction twice overwrites it """
+        return f'{cs.serial_number}-{tx.tx_id}-{tx.time_start.strftime("%Y%m%dT%H%M%S")}'
+
+    def reload_history(self, cs_id: str) -> asyncio.Future:
+        """
+        Load the evicted transactions and tags of a station back in memory, i.e. to answer a report request.
+        :param cs_id: Station id in memory
+        :return: Future done once the station has them
+        """
+        actors: ActorDAO = ActorDAOFactory().get_instance(ChargingStation)
+        serial_number = actors.peek(cs_id).serial_number
+        els_tx_dao = ElasticSearchDAO('transactions', ChargingStation.Transaction, *self.service_urls)
+        els_tg_dao = ElasticSearchDAO('tags', ChargingStation.Tag, *self.service_urls)
+        transactions = {tx.tx_id: tx for tx in els_tx_dao.find_by({'cs_reg_id': serial_number})}
+        tags = {tag.tag_id: tag for tag in els_tg_dao.find_by({'last_used_in': serial_number})}
+        return actors.tell(cs_id, ChargingStation.restore_history, transactions, tags)
 
     async def _finish(self):
         pass
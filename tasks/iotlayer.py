@@ -1,19 +1,40 @@
+import asyncio
+import collections
 import datetime
+import json
+import os
+import time
 from copy import deepcopy
 
 import energyweb
 
+from tasks.metrics import REGISTRY
+
+EVENTS = REGISTRY.counter('iotlayer_events_total', 'Rental events handled.', ('event',))
+BLOCKS_BEHIND = REGISTRY.gauge('iotlayer_blocks_behind', 'Blocks between the last one scanned and the latest one.')
+
 
 class IotLayerEventsTask(energyweb.Task, energyweb.Logger):
 
     def __init__(self, queue: dict, interval: datetime.timedelta, client_url: str, contract_add: str, device_id: str,
                  wallet_add: str = None, wallet_pwd: str = None, max_retries: int = 2, retry_pause: int = 3,
-                 block_sync: int = 1):
-        """ Wallet data is not needed once no tx is sent to the blockchain """
+                 block_sync: int = 1, checkpoint: str = '/tmp/iotlayer/checkpoint.json', batch_size: int = 100,
+                 max_batch_size: int = 5000, confirmations: int = 0, catch_up_seconds: float = 10):
+        """
+        Wallet data is not needed once no tx is sent to the blockchain.
+        LogRented and LogReturned are fetched over block ranges with eth_getLogs. The range grows while the logs are
+        few and shrinks when the client fails to answer, the last block scanned is saved after each range.
+        :param block_sync: Blocks scanned back from the latest one when there is no checkpoint yet
+        :param checkpoint: File keeping the last block scanned and the recent transactions handled across restarts
+        :param batch_size: Blocks per eth_getLogs to start with
+        :param max_batch_size: Most blocks per eth_getLogs
+        :param confirmations: Blocks left unscanned at the top of the chain until they are this deep
+        :param catch_up_seconds: Longest scan per tick, the rest is scanned on the next ones
+        """
         self.device_id = device_id
         self.block_sync = block_sync
         self.contract_name = 'rental'
-        contract_abi = deepcopy(energyweb.iotlayer)
+        contract_abi = deepcopy(energyweb.iotlayer.contract)
         contract_abi['address'] = contract_add
         smart_contract = {
             "client_url": client_url,
@@ -23,52 +44,120 @@ class IotLayerEventsTask(energyweb.Task, energyweb.Logger):
             "retry_pause": retry_pause
         }
         self.client = energyweb.EVMSmartContractClient(**smart_contract)
-        self.rented_filter = None
-        self.returned_filter = None
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.max_batch_size = max_batch_size
+        self.confirmations = confirmations
+        self.catch_up_seconds = catch_up_seconds
+        # topic -> event name
+        self.topics = {}
+        self.last_block = None
+        self.handled = collections.deque(maxlen=1000)
         self.available_stations = {}
         energyweb.Task.__init__(self, queue=queue, polling_interval=interval, eager=False, run_forever=True)
         energyweb.Logger.__init__(self, 'IotLayerEvents')
 
     async def _prepare(self):
-        if not self.rented_filter or not self.returned_filter:
-            filter_params = {
-                "contract_name": self.contract_name,
-                "event_name": 'LogRented',
-                "block_count": 1
-            }
-            self.rented_filter = self.client.create_event_filter(**filter_params)
-            filter_params['event_name'] = 'LogReturned'
-            self.returned_filter = self.client.create_event_filter(**filter_params)
+        if not self.topics:
+            from eth_utils import event_abi_to_log_topic
+            from web3 import Web3
+            for abi in self.client.contracts[self.contract_name]['abi']:
+                if abi.get('type') == 'event' and abi['name'] in ('LogRented', 'LogReturned'):
+                    self.topics[Web3.toHex(event_abi_to_log_topic(abi))] = abi['name']
+        if self.last_block is None:
+            self._load_checkpoint()
 
-    async def _main(self, *args):
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint) as file:
+                state = json.load(file)
+            self.last_block = state['last_block']
+            self.handled.extend(state['handled'])
+        except (OSError, ValueError, KeyError):
+            self.last_block = None
+
+    def _save_checkpoint(self):
+        if os.path.dirname(self.checkpoint):
+            os.makedirs(os.path.dirname(self.checkpoint), exist_ok=True)
+        temporary = f'{self.checkpoint}.tmp'
+        with open(temporary, 'w') as file:
+            json.dump({'last_block': self.last_block, 'handled': list(self.handled)}, file)
+        os.replace(temporary, self.checkpoint)
+
+    def _filter(self, from_block: int, to_block: int) -> dict:
+        topics = [list(self.topics)]
+        # The rented or returned id is the second indexed argument, filter on it when it is a bytes32
+        if self.device_id.startswith('0x') and len(self.device_id) == 66:
+            topics += [None, self.device_id.lower()]
+        address = self.client.contracts[self.contract_name]['address']
+        return {'fromBlock': from_block, 'toBlock': to_block, 'address': self.client.w3.toChecksumAddress(address),
+                'topics': topics}
 
-        def check_start_events():
-            for event in self.rented_filter.get_new_entries():
-                # session_id = Web3.toHex(event['transactionHash'])
-                if self.device_id in self.available_stations:
-                    cs_id = self.available_stations[self.device_id]
-                    await self.queue['ev_charger_command'].put((cs_id, 'start_transaction', {'tag_id': 1}))
-                else:
-                    self.console.error(f'IotLayerEventsTask failed to START charging because {cs_sn} is not available.')
-
-        def check_stop_events():
-            for event in self.returned_filter.get_new_entries():
-                if self.device_id in self.available_stations:
-                    cs_id = self.available_stations[self.device_id]
-                    await self.queue['ev_charger_command'].put((cs_id, 'stop_transaction', {'tx_id': 1}))
-                else:
-                    self.console.error(f'IotLayerEventsTask failed to STOP charging because {cs_sn} is not available.')
+    async def _scan(self):
+        """ Handle the events of the blocks after the checkpoint, range by range, until the latest or out of time """
+        loop = asyncio.get_event_loop()
+        latest = await loop.run_in_executor(None, lambda: self.client.w3.eth.blockNumber) - self.confirmations
+        if self.last_block is None:
+            self.last_block = max(latest - self.block_sync, -1)
+        deadline = time.monotonic() + self.catch_up_seconds
+        while self.last_block < latest and time.monotonic() < deadline:
+            to_block = min(self.last_block + self.batch_size, latest)
+            try:
+                logs = await loop.run_in_executor(None, self.client.w3.eth.getLogs,
+                                                  self._filter(self.last_block + 1, to_block))
+            except Exception:
+                if self.batch_size == 1:
+                    raise
+                # Too many logs or a slow client, ask for less
+                self.batch_size = max(1, self.batch_size // 2)
+                continue
+            for log in sorted(logs, key=lambda log: (log['blockNumber'], log['logIndex'])):
+                if not await self._handle(log):
+                    # Scanned again from this block on the next ticks, until the station is available
+                    self.last_block = log['blockNumber'] - 1
+                    self._save_checkpoint()
+                    BLOCKS_BEHIND.set(latest - self.last_block)
+                    return
+            self.last_block = to_block
+            self._save_checkpoint()
+            if len(logs) < 100:
+                self.batch_size = min(self.batch_size * 2, self.max_batch_size)
+        BLOCKS_BEHIND.set(latest - self.last_block)
 
+    async def _handle(self, log) -> bool:
+        """
+        :return: False if the station is not available yet, i.e. after a restart before it reconnects, the event is
+        then left for a later scan
+        """
+        from web3 import Web3
+        tx_hash = Web3.toHex(log['transactionHash'])
+        if tx_hash in self.handled:
+            return True
+        event = self.topics.get(Web3.toHex(log['topics'][0]))
+        if self.device_id not in self.available_stations:
+            action = 'START' if event == 'LogRented' else 'STOP'
+            self.console.warning(f'IotLayerEventsTask waits to {action} charging until {self.device_id} is '
+                                 f'available.')
+            return False
+        if event == 'LogRented':
+            cs_id = self.available_stations[self.device_id]
+            await self.queue['ev_charger_command'].put((cs_id, 'start_transaction', {'tag_id': 1}))
+        elif event == 'LogReturned':
+            cs_id = self.available_stations[self.device_id]
+            # The station resolves its open transaction, it may live in an Ocpp16 worker process
+            await self.queue['ev_charger_command'].put((cs_id, 'stop_last_transaction', {}))
+        EVENTS.inc(event=event)
+        self.handled.append(tx_hash)
+        # Saved before the range is done, a restart must not start or stop the charging twice
+        self._save_checkpoint()
+        return True
+
+    async def _main(self, *args):
         while not self.queue['ev_chargers_available'].empty():
             self.available_stations.update(self.queue['ev_chargers_available'].get_nowait())
 
         try:
-            check_start_events()
-        except Exception as e:
-            self._handle_exception(e)
-
-        try:
-            check_stop_events()
+            await self._scan()
         except Exception as e:
             self._handle_exception(e)
 
@@ -76,4 +165,4 @@ class IotLayerEventsTask(energyweb.Task, energyweb.Logger):
         self.console.error('IotLayerEventsTask filters failed. Rebooting.')
 
     def _handle_exception(self, e: Exception):
-        pass
+        self.console.error(f'IotLayerEventsTask failed to scan events because {e.with_traceback(e.__traceback__)}')
@@ -0,0 +1,148 @@
+"""
+Event loop stall detector. A heartbeat on the loop measures how late it is scheduled, a watchdog thread captures the
+stack of the loop thread when the heartbeat is overdue, so each stall is attributed to the task blocking the loop.
+"""
+import asyncio
+import collections
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+
+import energyweb
+
+from tasks.metrics import REGISTRY, ROUTES, TASK_NAMES
+
+LOOP_LAG = REGISTRY.histogram('event_loop_lag_seconds', 'Delay of the loop heartbeat past its schedule.',
+                              buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+LOOP_STALLS = REGISTRY.counter('event_loop_stalls_total', 'Heartbeats delayed past the threshold per task.', ('task',))
+LOOP_STALL_SECONDS = REGISTRY.counter('event_loop_stall_seconds_total', 'Seconds the loop was blocked per task.',
+                                      ('task',))
+
+# Frames of the app, stalls are located at the innermost one
+APP_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULE_PATH = os.path.abspath(__file__)
+
+
+class LoopMonitorTask(energyweb.Task, energyweb.Logger):
+
+    def __init__(self, queue: dict, threshold: float = 0.25, interval: float = 0.05, recent: int = 50,
+                 path: str = '/stalls'):
+        """
+        Stalls are logged and served as JSON on the metrics server, see http_route.
+        :param threshold: Seconds the loop may be blocked before it is a stall
+        :param interval: Seconds between heartbeats
+        :param recent: Stalls kept with their stack
+        :param path: Route of the summary on the metrics server
+        """
+        self.threshold = threshold
+        self.interval = interval
+        self.path = path
+        self.recent = collections.deque(maxlen=recent)
+        # task -> {'stalls': count, 'seconds': total, 'max_seconds': longest}
+        self.totals = {}
+        self._loop = None
+        self._loop_thread = None
+        # Monotonic time the heartbeat is due at
+        self._due = None
+        # (due, task, location, stack) captured by the watchdog while the heartbeat was overdue
+        self._captured = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+        energyweb.Task.__init__(self, queue=queue, polling_interval=None, eager=True, run_forever=True)
+        energyweb.Logger.__init__(self, 'LoopMonitor')
+
+    @staticmethod
+    def _task_name(task: asyncio.Task) -> str:
+        """ Name of the energyweb.Task running in an asyncio task, else the name of its coroutine """
+        if task is None:
+            return 'callback'
+        name = TASK_NAMES.get(task)
+        if name:
+            return name
+        coro = task.get_coro() if hasattr(task, 'get_coro') else task._coro
+        return getattr(coro, '__qualname__', repr(coro))
+
+    @staticmethod
+    def _location(frame) -> str:
+        """ Innermost app frame of the stack, the blocking call is made there """
+        innermost = frame
+        while frame:
+            if frame.f_code.co_filename.startswith(APP_PATH) and frame.f_code.co_filename != MODULE_PATH:
+                break
+            frame = frame.f_back
+        if frame:
+            file_name = os.path.relpath(frame.f_code.co_filename, APP_PATH)
+        else:
+            frame = innermost
+            file_name = frame.f_code.co_filename
+        return f'{file_name}:{frame.f_lineno} in {frame.f_code.co_name}'
+
+    def _watch(self):
+        check = min(self.interval, self.threshold) / 2
+        while not self._stopped.wait(check):
+            due = self._due
+            if due is None or time.monotonic() - due < self.threshold:
+                continue
+            if self._captured and self._captured[0] == due:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            task = self._task_name(asyncio.current_task(self._loop))
+            self._captured = (due, task, self._location(frame), ''.join(traceback.format_stack(frame)))
+
+    def _record(self, due: float, lag: float):
+        captured = self._captured
+        if captured and captured[0] == due:
+            _, task, location, stack = captured
+        else:
+            # Over before the watchdog looked
+            task, location, stack = 'unknown', 'unknown', ''
+        LOOP_STALLS.inc(task=task)
+        LOOP_STALL_SECONDS.inc(lag, task=task)
+        totals = self.totals.setdefault(task, {'stalls': 0, 'seconds': 0., 'max_seconds': 0.})
+        totals['stalls'] += 1
+        totals['seconds'] += lag
+        totals['max_seconds'] = max(totals['max_seconds'], lag)
+        self.recent.append({'time': datetime.datetime.now().isoformat(), 'seconds': round(lag, 3), 'task': task,
+                            'location': location, 'stack': stack})
+        self.console.warning(f'Event loop blocked {lag:.3f} s by {task} at {location}\n{stack}')
+
+    def http_route(self, limit: str = '10') -> tuple:
+        """ GET /stalls?limit=10, stalls per task and the latest ones with their stack """
+        recent = list(self.recent)[-int(limit):] if int(limit) > 0 else []
+        totals = {task: dict(t, seconds=round(t['seconds'], 3), max_seconds=round(t['max_seconds'], 3))
+                  for task, t in sorted(self.totals.items(), key=lambda item: -item[1]['seconds'])}
+        body = {'threshold': self.threshold, 'tasks': totals, 'recent': recent[::-1]}
+        return 'application/json', json.dumps(body)
+
+    async def _prepare(self):
+        self._loop = asyncio.get_event_loop()
+        self._loop_thread = threading.get_ident()
+        ROUTES[self.path] = self.http_route
+        if not self._watchdog or not self._watchdog.is_alive():
+            self._stopped.clear()
+            self._watchdog = threading.Thread(target=self._watch, name='LoopMonitor', daemon=True)
+            self._watchdog.start()
+        self.console.info(f'Event loop monitored, stalls over {self.threshold} s are reported.')
+
+    async def _main(self, *args):
+        while True:
+            self._due = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(time.monotonic() - self._due, 0.)
+            LOOP_LAG.observe(lag)
+            if lag >= self.threshold:
+                self._record(self._due, lag)
+
+    async def _finish(self):
+        self._due = None
+        if not self.run_forever:
+            self._stopped.set()
+
+    def _handle_exception(self, e: Exception):
+        self.console.error(f'Loop monitor failed because {e.with_traceback(e.__traceback__)}')
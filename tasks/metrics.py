@@ -0,0 +1,280 @@
+"""
+In-process metrics registry exposed in Prometheus text format
+"""
+import asyncio
+import bisect
+import contextlib
+import functools
+import threading
+import time
+import urllib.parse
+import weakref
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def _format_labels(names: tuple, values: tuple, extra: tuple = ()) -> str:
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    """ Base of all metric families. Values are kept per label values tuple. """
+    typ = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        """
+        :param name: Metric family name, i.e. 'ocpp16_messages_total'
+        :param documentation: Help text
+        :param labels: Label names every sample of this family must carry
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f'{self.name} expects labels {self.label_names}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self) -> [tuple]:
+        """
+        :return: [(suffix, label values, extra labels, value)]
+        """
+        raise NotImplementedError
+
+    def expose(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.typ}']
+        for suffix, values, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(self.label_names, values, extra)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    typ = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        if amount < 0:
+            raise ValueError('Counters can only increase.')
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [('', k, (), v) for k, v in self._values.items()]
+
+
+class Gauge(Metric):
+    typ = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        super().__init__(name, documentation, labels)
+        self._functions = {}
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function, **labels):
+        """
+        Evaluate the gauge lazily on every scrape, i.e. the size of a queue.
+        :param function: Callable without arguments returning a number
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._functions[key] = function
+
+    def value(self, **labels) -> float:
+        key = self._key(labels)
+        if key in self._functions:
+            return self._functions[key]()
+        return self._values.get(key, 0)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for key, function in functions.items():
+            try:
+                values[key] = function()
+            except Exception:
+                continue
+        return [('', k, (), v) for k, v in values.items()]
+
+
+class Histogram(Metric):
+    typ = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts, _ = self._values[key]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key][1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """ Observe the wall time spent inside the with block """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        key = self._key(labels)
+        return sum(self._values[key][0]) if key in self._values else 0
+
+    def samples(self):
+        result = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    result.append(('_bucket', key, (('le', _format_value(bound)),), cumulative))
+                result.append(('_sum', key, (), total))
+                result.append(('_count', key, (), cumulative))
+        return result
+
+
+class Registry:
+    """ Holds every metric family of the process. Getters are idempotent so modules can declare at import time. """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name: str, documentation: str, labels: tuple, **kwargs) -> Metric:
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, documentation, labels, **kwargs)
+            metric = self._metrics[name]
+        if not isinstance(metric, cls):
+            raise ValueError(f'Metric {name} already registered as {metric.typ}.')
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: tuple = ()) -> Counter:
+        return self._get_or_create(Counter, name, documentation, labels)
+
+    def gauge(self, name: str, documentation: str, labels: tuple = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, documentation, labels)
+
+    def histogram(self, name: str, documentation: str, labels: tuple = (),
+                  buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, labels, buckets=buckets)
+
+    def expose(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.expose() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+TASK_TICK_SECONDS = REGISTRY.histogram('task_tick_seconds', 'Duration of one _main run per task.', ('task',))
+TASK_TICK_ERRORS = REGISTRY.counter('task_tick_errors_total', 'Exceptions escaping _main per task.', ('task',))
+# asyncio.Task -> name of the energyweb.Task whose _main it runs, see tasks.loopmonitor
+TASK_NAMES = weakref.WeakKeyDictionary()
+
+
+def task_name(task) -> str:
+    """ Name used to label a task: its logger name when it has one, i.e. 'ElasticSync', else its class name """
+    console = getattr(task, 'console', None)
+    return getattr(console, 'name', None) or task.__class__.__name__
+
+
+def time_ticks(task):
+    """
+    Wrap the _main coroutine of an energyweb.Task instance to measure every tick.
+    :param task: energyweb.Task
+    :return: The same task
+    """
+    if getattr(task, '_metrics_timed', False):
+        return task
+    main = task._main
+
+    @functools.wraps(main)
+    async def timed_main(*args):
+        name = task_name(task)
+        TASK_NAMES[asyncio.current_task()] = name
+        start = time.perf_counter()
+        try:
+            return await main(*args)
+        except Exception:
+            TASK_TICK_ERRORS.inc(task=name)
+            raise
+        finally:
+            TASK_TICK_SECONDS.observe(time.perf_counter() - start, task=name)
+
+    task._main = timed_main
+    task._metrics_timed = True
+    return task
+
+
+# Extra GET endpoints of the metrics server: path -> callable(**query parameters) returning (content_type, body)
+ROUTES = {}
+
+
+class MetricsServer:
+    """ Minimal HTTP/1.0 endpoint serving the registry on GET /metrics and the ROUTES registered by other modules """
+
+    def __init__(self, registry: Registry = REGISTRY):
+        self.registry = registry
+        self.routes = {'/metrics': lambda **_: ('text/plain; version=0.0.4; charset=utf-8', self.registry.expose())}
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            url = urllib.parse.urlsplit(request_line[1]) if len(request_line) > 1 else None
+            route = self.routes.get(url.path, ROUTES.get(url.path)) if url else None
+            if not route or request_line[0] != 'GET':
+                status, content_type, body = '404 Not Found', 'text/plain', 'Not found\n'
+            else:
+                try:
+                    status = '200 OK'
+                    content_type, body = route(**dict(urllib.parse.parse_qsl(url.query)))
+                except (TypeError, ValueError) as e:
+                    status, content_type, body = '400 Bad Request', 'text/plain', f'{e}\n'
+
+            payload = body.encode()
+            writer.write(f'HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\n'
+                         f'Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n'.encode() + payload)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    def get_server(self, host: str, port: int):
+        return asyncio.start_server(self._handle, host=host, port=port)
@@ -0,0 +1,35 @@
+import datetime
+
+import energyweb
+
+from tasks.metrics import MetricsServer, REGISTRY
+
+APP_QUEUE_DEPTH = REGISTRY.gauge('app_queue_depth', 'Messages waiting on each app queue.', ('queue',))
+
+
+class MetricsServerTask(energyweb.Task, energyweb.Logger):
+
+    def __init__(self, queue: dict, interval: datetime.timedelta, host: str, port: int):
+        """ Serves the process metrics registry on http://host:port/metrics """
+        self.server_address = (host, port)
+        self._server = None
+        energyweb.Task.__init__(self, queue=queue, polling_interval=interval, eager=True, run_forever=True)
+        energyweb.Logger.__init__(self, 'Metrics')
+
+    async def _prepare(self):
+        for name, app_queue in self.queue.items():
+            APP_QUEUE_DEPTH.set_function(app_queue.qsize, queue=name)
+
+    async def _main(self, *args):
+        if not self._server:
+            self._server = await MetricsServer().get_server(*self.server_address)
+            self.console.info(f'Metrics exposed on http://{self.server_address[0]}:{self.server_address[1]}/metrics')
+
+    async def _finish(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def _handle_exception(self, e: Exception):
+        self.console.error(f'Metrics server failed because {e.with_traceback(e.__traceback__)}')
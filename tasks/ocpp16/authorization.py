@@ -0,0 +1,161 @@
+"""
+Fleet-wide id tag authorization cache
+"""
+import asyncio
+import datetime
+import logging
+import time
+
+from tasks.metrics import REGISTRY
+from tasks.ocpp16.protocol import Ocpp16
+
+AUTHORIZATIONS = REGISTRY.counter('ocpp16_authorizations_total', 'Authorization cache lookups.', ('result',))
+
+
+class AuthorizationCache:
+    """
+    Answers Authorize and StartTransaction from memory. Known tags are prefetched in bulk, misses and stale entries
+    are refreshed in the background with one lookup per tag at a time, and unknown tags are remembered for a while
+    so they do not hit the database again.
+    """
+
+    def __init__(self, lookup=None, bulk_lookup=None, ttl: float = 3600, negative_ttl: float = 300,
+                 accept_unknown: bool = True, local_list: bool = False, expiry_days: int = 360,
+                 send_local_list_max_length: int = 100, local_auth_list_max_length: int = None):
+        """
+        :param lookup: Callable(tag_id) returning the Tag or raising KeyError when it is not registered
+        :param bulk_lookup: Callable() returning all registered Tags
+        :param ttl: Seconds before a known tag is refreshed
+        :param negative_ttl: Seconds an unknown tag is remembered as unknown
+        :param accept_unknown: Accept and register tags that are not known yet, as chargers did before this cache
+        :param local_list: Push the known tags to chargers with SendLocalList when they boot
+        :param expiry_days: Validity of tags registered by accept_unknown
+        :param send_local_list_max_length: Tags pushed at most, the SendLocalListMaxLength of the chargers
+        :param local_auth_list_max_length: Tags pushed at most, the LocalAuthListMaxLength of the chargers, None for all
+        """
+        self.lookup = lookup
+        self.bulk_lookup = bulk_lookup
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.accept_unknown = accept_unknown
+        self.local_list = local_list
+        self.expiry_days = expiry_days
+        self.send_local_list_max_length = send_local_list_max_length
+        self.local_auth_list_max_length = local_auth_list_max_length
+        self.version = 0
+        self._tags = {}
+        self._unknown = {}
+        self._in_flight = {}
+        self._unsynced = {}
+
+    @staticmethod
+    def from_config(auth_config: dict, service_urls: tuple = None):
+        """
+        :param auth_config: Keyword arguments of AuthorizationCache besides the lookups
+        :param service_urls: Elastic search urls of the 'tags' index, the cache is memory only if omitted
+        """
+        if auth_config is None:
+            return None
+        if not service_urls:
+            return AuthorizationCache(**auth_config)
+        import elasticsearch as es
+        from tasks.database.elasticdao import ElasticSearchDAO
+        tags_dao = ElasticSearchDAO('tags', Ocpp16.Tag, *service_urls)
+
+        def lookup(tag_id: str) -> Ocpp16.Tag:
+            try:
+                return tags_dao.retrieve(tag_id)
+            except es.NotFoundError:
+                raise KeyError(tag_id)
+
+        return AuthorizationCache(lookup=lookup, bulk_lookup=lambda: tags_dao.retrieve_all(size=10000),
+                                  **auth_config)
+
+    def _store(self, tag: Ocpp16.Tag):
+        self._tags[tag.tag_id] = (tag, time.monotonic() + self.ttl)
+        self._unknown.pop(tag.tag_id, None)
+
+    def prefetch(self) -> int:
+        """
+        Load every registered tag, call once at startup.
+        :return: Number of tags loaded
+        """
+        if not self.bulk_lookup:
+            return 0
+        tags = self.bulk_lookup()
+        [self._store(tag) for tag in tags]
+        self.version += 1
+        return len(tags)
+
+    async def _refresh(self, tag_id: str):
+        loop = asyncio.get_event_loop()
+        try:
+            tag = await loop.run_in_executor(None, self.lookup, tag_id)
+            self._store(tag)
+            self._unsynced.pop(tag_id, None)
+            self.version += 1
+        except KeyError:
+            if tag_id not in self._tags:
+                self._unknown[tag_id] = time.monotonic() + self.negative_ttl
+        except Exception as e:
+            # Not remembered as unknown, looked up again the next time the tag is presented
+            logging.getLogger(__name__).error(f'Lookup of tag {tag_id} failed: {e}')
+        finally:
+            del self._in_flight[tag_id]
+
+    def _schedule_refresh(self, tag_id: str):
+        if not self.lookup or tag_id in self._in_flight:
+            return
+        try:
+            self._in_flight[tag_id] = asyncio.ensure_future(self._refresh(tag_id))
+        except RuntimeError:
+            # No event loop running, i.e. a script or test calling the protocol directly
+            pass
+
+    def authorize(self, tag_id: str, station: str = None) -> Ocpp16.Tag or None:
+        """
+        Never waits on the database, misses are answered by the accept_unknown policy and looked up in background.
+        :param tag_id: idTag presented to the charger
+        :param station: Serial number of the charger, recorded on tags registered here
+        :return: Tag if accepted else None
+        """
+        now = time.monotonic()
+        if tag_id in self._tags:
+            tag, refresh_at = self._tags[tag_id]
+            if refresh_at < now:
+                self._schedule_refresh(tag_id)
+            if tag.expiry_date and tag.expiry_date < datetime.datetime.utcnow():
+                AUTHORIZATIONS.inc(result='expired')
+                return None
+            AUTHORIZATIONS.inc(result='hit')
+            return tag
+        if self._unknown.get(tag_id, 0) < now:
+            self._unknown.pop(tag_id, None)
+            self._schedule_refresh(tag_id)
+        if not self.accept_unknown:
+            AUTHORIZATIONS.inc(result='rejected')
+            return None
+        AUTHORIZATIONS.inc(result='registered')
+        tag = Ocpp16.Tag(tag_id, datetime.datetime.utcnow() + datetime.timedelta(days=self.expiry_days), station)
+        self._store(tag)
+        self._unsynced[tag_id] = tag
+        self.version += 1
+        return tag
+
+    def unsynced(self) -> [Ocpp16.Tag]:
+        """ Tags registered locally and not yet written to the database """
+        return list(self._unsynced.values())
+
+    def mark_synced(self, tag_id: str):
+        self._unsynced.pop(tag_id, None)
+
+    def local_authorization_list(self) -> [dict]:
+        """
+        Known valid tags in SendLocalList format, as many as one message and the charger list hold. Differential
+        updates need a newer version each, so the list is sent in one full update.
+        """
+        now = datetime.datetime.utcnow()
+        tags = [{'idTag': tag.tag_id, 'idTagInfo': {'status': 'Accepted', 'expiryDate': tag.expiry_date.isoformat()}}
+                for tag, _ in self._tags.values() if not tag.expiry_date or tag.expiry_date > now]
+        limits = [limit for limit in (self.send_local_list_max_length, self.local_auth_list_max_length) if limit]
+        return tags[:min(limits)] if limits else tags
@@ -0,0 +1,83 @@
+"""
+OCPP-J frame codecs. The fastest installed JSON library is used unless one is configured.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+class Codec:
+    """ Turns websocket text frames into OCPP-J arrays and back """
+    name = None
+
+    def decode(self, frame: str or bytes) -> list:
+        raise NotImplementedError
+
+    def encode(self, message: list) -> str:
+        raise NotImplementedError
+
+
+class StdlibCodec(Codec):
+    name = 'json'
+
+    def decode(self, frame: str or bytes) -> list:
+        return json.loads(frame)
+
+    def encode(self, message: list) -> str:
+        return json.dumps(message, default=str)
+
+
+class OrjsonCodec(Codec):
+    name = 'orjson'
+
+    def __init__(self):
+        if not orjson:
+            raise ImportError('Please install orjson to use the orjson codec.')
+
+    def decode(self, frame: str or bytes) -> list:
+        return orjson.loads(frame)
+
+    def encode(self, message: list) -> str:
+        # OCPP-J requires text frames, orjson produces bytes
+        return orjson.dumps(message, default=str).decode()
+
+
+class UjsonCodec(Codec):
+    name = 'ujson'
+
+    def __init__(self):
+        if not ujson:
+            raise ImportError('Please install ujson to use the ujson codec.')
+
+    def decode(self, frame: str or bytes) -> list:
+        return ujson.loads(frame)
+
+    def encode(self, message: list) -> str:
+        return ujson.dumps(message, default=str)
+
+
+CODECS = {codec.name: codec for codec in (OrjsonCodec, UjsonCodec, StdlibCodec)}
+
+
+def get_codec(name: str = None) -> Codec:
+    """
+    :param name: One of CODECS keys. If omitted the first importable codec in CODECS order is used.
+    :return: Codec instance
+    """
+    if name:
+        if name not in CODECS:
+            raise ValueError(f'Unknown codec {name}, choose from {list(CODECS)}.')
+        return CODECS[name]()
+    for codec in CODECS.values():
+        try:
+            return codec()
+        except ImportError:
+            continue
@@ -0,0 +1,110 @@
+"""
+Fleet-wide commands: one charging station method fanned out to many stations, their answers gathered in one result
+"""
+import asyncio
+import uuid
+from dataclasses import dataclass, field
+
+
+class StationSelector:
+    """ Selects all stations, a list of serial numbers and/or the stations with a connector in a given status """
+
+    def __init__(self, serials: [str] = None, status: str = None):
+        """
+        :param serials: Serial numbers, every station if omitted
+        :param status: Connector status, i.e. 'Available' or 'Charging'
+        """
+        self.serials = set(serials) if serials else None
+        self.status = status
+
+    @staticmethod
+    def from_config(selector: str or dict = 'all'):
+        """
+        :param selector: 'all', {'serials': [...]} or {'status': 'Available'}
+        """
+        if not selector or selector == 'all':
+            return StationSelector()
+        return StationSelector(selector.get('serials'), selector.get('status'))
+
+    def matches(self, cs) -> bool:
+        if not cs.serial_number:
+            return False
+        if self.serials is not None and cs.serial_number not in self.serials:
+            return False
+        if self.status and not any(c.last_status == self.status for c in cs.connectors.values()):
+            return False
+        return True
+
+
+@dataclass
+class FleetCommand:
+    """
+    Put on 'ev_charger_command' instead of a (cs_id, method, kwargs) tuple, see fan_out.
+    """
+    method: str
+    kwargs: dict = field(default_factory=dict)
+    selector: StationSelector = field(default_factory=StationSelector)
+    concurrency: int = 50
+    timeout: float = 30
+    command_id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    # Future of the FleetResult, local to the process that awaits it
+    result: object = None
+
+    def __getstate__(self):
+        # Futures do not cross process boundaries, workers attach their own
+        return dict(self.__dict__, result=None)
+
+
+@dataclass
+class FleetResult:
+    method: str
+    outcomes: dict = field(default_factory=dict)
+    elapsed: float = 0
+
+    @staticmethod
+    def outcome_of(answer) -> str:
+        """
+        :param answer: Response or CallError of the charging station
+        :return: Answered status, i.e. 'Accepted', 'Rejected' or 'Unlocked', or the CALLERROR code
+        """
+        if hasattr(answer, 'error_code'):
+            return answer.error_code
+        return answer.body.get('status', 'Accepted') if isinstance(answer.body, dict) else 'Accepted'
+
+    def merge(self, other):
+        self.outcomes.update(other.outcomes)
+        self.elapsed = max(self.elapsed, other.elapsed)
+        return self
+
+    def summary(self) -> dict:
+        """ {outcome: number of stations} """
+        counts = {}
+        for outcome in self.outcomes.values():
+            counts[outcome] = counts.get(outcome, 0) + 1
+        return counts
+
+
+async def fan_out(queue: dict, method: str, kwargs: dict = None, selector: StationSelector = None,
+                  concurrency: int = 50, timeout: float = 30, deadline: float = 300) -> FleetResult:
+    """
+    Call a ChargingStation method on every selected station and wait for all of them to answer.
+    :param queue: App queues, the command goes through 'ev_charger_command'
+    :param method: ChargingStation method, i.e. 'request_meter_values' or 'request_cs_id'
+    :param kwargs: Method arguments
+    :param selector: Target stations, all if omitted
+    :param concurrency: Stations waiting on an answer at the same time
+    :param timeout: Seconds each station has to answer
+    :param deadline: Seconds to wait for the whole command, i.e. while no server consumes it
+    :return: Outcome per station serial number: the answered status, the CALLERROR code, 'timeout', 'sent' when the
+    method sends nothing to wait for, or 'error: ...' when the method failed. No outcome past the deadline.
+    """
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    command = FleetCommand(method, kwargs if kwargs else {}, selector if selector else StationSelector(),
+                           concurrency, timeout)
+    command.result = loop.create_future()
+    try:
+        await asyncio.wait_for(queue['ev_charger_command'].put(command), deadline)
+        return await asyncio.wait_for(command.result, max(deadline - (loop.time() - start), 0))
+    except asyncio.TimeoutError:
+        return FleetResult(method, elapsed=loop.time() - start)
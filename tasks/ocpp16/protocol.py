@@ -1,10 +1,61 @@
 # Based on OCPP 1.6-JSON
+import array
+import calendar
 import datetime
 import uuid
 from dataclasses import dataclass, field
 
 from tasks.database import dao
 
+# Actions a charge point may initiate according to OCPP 1.6-JSON
+OCPP16_ACTIONS = frozenset({'Authorize', 'BootNotification', 'DataTransfer', 'DiagnosticsStatusNotification',
+                            'FirmwareStatusNotification', 'Heartbeat', 'MeterValues', 'StartTransaction',
+                            'StatusNotification', 'StopTransaction'})
+# Meter samples kept per transaction, one a minute for a day
+MAX_CURVE_POINTS = 1440
+
+
+class MeterCurve:
+    """
+    [[epoch seconds, Wh]] samples of a transaction packed in one array of doubles, 16 bytes a point instead of about
+    140 for a list of lists. Iterates and serializes as the list of lists.
+    """
+    __slots__ = ('values',)
+
+    def __init__(self, points: list = ()):
+        self.values = array.array('d')
+        for point in points:
+            self.append(point)
+
+    def append(self, point: list):
+        self.values.append(point[0])
+        self.values.append(point[1])
+
+    def halve(self):
+        """ Keep every other point and the last one """
+        values = self.values
+        kept = array.array('d')
+        for i in range(0, len(values) - 2, 4):
+            kept.extend(values[i:i + 2])
+        kept.extend(values[-2:])
+        self.values = kept
+
+    def __len__(self):
+        return len(self.values) // 2
+
+    def __iter__(self):
+        values = self.values
+        return ([int(values[i]), values[i + 1]] for i in range(0, len(values), 2))
+
+    def __eq__(self, other):
+        return isinstance(other, MeterCurve) and self.values == other.values
+
+    def __repr__(self):
+        return f'MeterCurve({len(self)} points)'
+
+    def to_dict(self) -> list:
+        return list(self)
+
 
 @dataclass
 class Ocpp16:
@@ -12,6 +63,32 @@ class Ocpp16:
     req_queue: dict = field(default_factory=dict)
     res_queue: dict = field(default_factory=dict)
     tags: dict = field(default_factory=dict)
+    last_tx_id: int = 0
+    # Version of the local authorization list pushed to the charger, 0 if unknown
+    local_list_version: int = 0
+
+    # Action name -> handler method name or callable(station, request). Extend with register_action.
+    request_handlers = {
+        'Heartbeat': '_on_heartbeat',
+        'BootNotification': '_on_boot_notification',
+        'Authorize': '_on_authorize',
+        'StatusNotification': '_on_status_notification',
+        'MeterValues': '_on_meter_values',
+        'StartTransaction': '_on_start_transaction',
+        'StopTransaction': '_on_stop_transaction',
+    }
+    # Action of the request sent -> handler of the charge point answer
+    response_handlers = {
+        'RemoteStartTransaction': '_on_accepted',
+        'RemoteStopTransaction': '_on_accepted',
+        'TriggerMessage': '_on_accepted',
+        'UnlockConnector': '_on_unlocked',
+        'SendLocalList': '_on_accepted',
+    }
+    # Fleet-wide AuthorizationCache, tags are kept per station when not set
+    authorization = None
+    # EnergyRollups updated with every closed transaction, if set
+    rollups = None
 
     @dataclass
     class Request:
@@ -20,6 +97,7 @@ class Ocpp16:
         typ: str
         body: dict
         is_pending: bool = True
+        attempts: int = 0
 
         def serialize(self):
             msg = [self.msg_type, self.msg_id, self.typ, self.body]
@@ -37,6 +115,46 @@ class Ocpp16:
             msg = [self.msg_type, self.msg_id, self.body]
             return msg
 
+    @dataclass
+    class CallError:
+        msg_type: int
+        msg_id: str
+        error_code: str
+        error_description: str = ''
+        error_details: dict = field(default_factory=dict)
+        is_pending: bool = True
+        req: object = None
+
+        def serialize(self):
+            msg = [self.msg_type, self.msg_id, self.error_code, self.error_description, self.error_details]
+            return msg
+
+    @staticmethod
+    def parse(packet: list):
+        """
+        Build the message from a decoded OCPP-J frame.
+        :param packet: [2, id, action, body], [3, id, body] or [4, id, code, description, details]
+        :return: Request, Response or CallError
+        """
+        if not isinstance(packet, list) or len(packet) < 3:
+            raise ValueError(f'Malformed {packet}')
+        if packet[0] == 2 and len(packet) == 4:
+            return Ocpp16.Request(*packet)
+        if packet[0] == 3 and len(packet) == 3:
+            return Ocpp16.Response(*packet)
+        if packet[0] == 4 and len(packet) in (3, 4, 5):
+            return Ocpp16.CallError(*packet)
+        raise ValueError(f'Malformed {packet}')
+
+    @classmethod
+    def register_action(cls, action: str, handler):
+        """
+        Add or replace the handler of an incoming action without touching the dispatch code.
+        :param action: OCPP action name, i.e. 'DataTransfer'
+        :param handler: Method name or callable(station, request). Must answer the request with _answer.
+        """
+        cls.request_handlers = dict(cls.request_handlers, **{action: handler})
+
     @dataclass
     class Tag(dao.Model):
         tag_id: str
@@ -58,18 +176,25 @@ class Ocpp16:
         time_stop: datetime.datetime = None
         meter_stop: int = None
         cs_reg_id: str = None
-        co2_saved: int = None
+        co2_saved: float = None
+        # [[epoch seconds, Wh]] energy register samples sent during the session
+        meter_curve: MeterCurve = None
 
         @staticmethod
         def from_dict(obj_dict):
             obj_dict['time_start'] = datetime.datetime.fromisoformat(obj_dict['time_start'])
             obj_dict['time_stop'] = datetime.datetime.fromisoformat(obj_dict['time_stop']) \
                 if 'time_stop' in obj_dict and obj_dict['time_stop'] else None
+            if obj_dict.get('meter_curve'):
+                obj_dict['meter_curve'] = MeterCurve(obj_dict['meter_curve'])
             return Ocpp16.Transaction(**obj_dict)
 
     def _answer(self, req: Request, body: dict):
         self.res_queue[req.msg_id] = Ocpp16.Response(3, req.msg_id, body)
 
+    def _answer_error(self, req: Request, error_code: str, description: str = '', details: dict = None):
+        self.res_queue[req.msg_id] = Ocpp16.CallError(4, req.msg_id, error_code, description, details or {})
+
     def _ask(self, typ: str, body: dict):
         msg_id = str(uuid.uuid4())
         self.req_queue[msg_id] = Ocpp16.Request(2, msg_id, typ, body)
@@ -83,33 +208,85 @@ class Ocpp16:
     def stop_transaction(self, tx_id: int):
         self._ask('RemoteStopTransaction', {'transactionId': int(tx_id)})
 
+    def stop_last_transaction(self):
+        txs = [tx for tx in self.transactions.values() if not tx.meter_stop]
+        if len(txs) > 0:
+            tx = max(txs, key=lambda t: t.time_start)
+            self.stop_transaction(tx.tx_id)
+
     def request_meter_values(self):
         self._ask('TriggerMessage', {'requestedMessage': 'MeterValues'})
 
     def request_cs_id(self):
         self._ask('TriggerMessage', {'requestedMessage': 'BootNotification'})
 
+    def send_local_list(self, version: int, tags: [dict], update_type: str = 'Full'):
+        self._ask('SendLocalList', {'listVersion': version, 'updateType': update_type,
+                                    'localAuthorizationList': tags})
+
+    def push_local_list(self):
+        """ Replace the local authorization list of the charger with the known tags of the fleet-wide cache """
+        self.send_local_list(self.authorization.version, self.authorization.local_authorization_list())
+        self.local_list_version = self.authorization.version
+
     def _register_tx_start(self, conn_id: int, tag_id: str, timestamp: str, meter_start: int):
-        tx_id = len(self.transactions) + 1
-        time_start = datetime.datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ')
+        # Transactions may have been evicted, ids must keep growing
+        tx_id = max([self.last_tx_id] + [int(tx.tx_id) for tx in self.transactions.values()]) + 1
+        self.last_tx_id = tx_id
+        time_start = self._timestamp(timestamp)
         self.transactions[tx_id] = Ocpp16.Transaction(tx_id, tag_id, conn_id, time_start, int(meter_start))
         return self.transactions[tx_id]
 
+    @staticmethod
+    def _timestamp(timestamp: str) -> datetime.datetime:
+        """ Naive UTC datetime of an OCPP dateTime, fractions of a second dropped and offsets applied """
+        offset = timestamp[19:].lstrip('.0123456789')
+        if not offset:
+            return datetime.datetime.strptime(timestamp[:19], '%Y-%m-%dT%H:%M:%S')
+        offset = '+00:00' if offset == 'Z' else offset
+        moment = datetime.datetime.strptime(timestamp[:19] + offset.replace(':', ''), '%Y-%m-%dT%H:%M:%S%z')
+        return moment.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+    @staticmethod
+    def _meter_point(timestamp: str, sample: dict) -> [float] or None:
+        """
+        :return: [epoch seconds, Wh] of an energy register sample, None for other measurands
+        """
+        if sample.get('measurand', 'Energy.Active.Import.Register') != 'Energy.Active.Import.Register':
+            return None
+        moment = Ocpp16._timestamp(timestamp)
+        wh = float(sample['value']) * (1000 if sample.get('unit') == 'kWh' else 1)
+        return [calendar.timegm(moment.timetuple()), wh]
+
+    def _record_meter_curve(self, tx: Transaction, meter_values: list):
+        curve = tx.meter_curve if isinstance(tx.meter_curve, MeterCurve) else MeterCurve(tx.meter_curve or ())
+        for value in meter_values:
+            for sample in value['sampledValue']:
+                point = self._meter_point(value['timestamp'], sample)
+                if point:
+                    curve.append(point)
+        if len(curve) > MAX_CURVE_POINTS:
+            # Halve the resolution, keeping the last point
+            curve.halve()
+        tx.meter_curve = curve
+
     def _register_tx_stop(self, tx_id: int, timestamp: str, meter_stop: int, tag_id: str, tx_data: list):
-        time_stop = datetime.datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ')
+        time_stop = self._timestamp(timestamp)
         if tx_id not in self.transactions:
             tx = Ocpp16.Transaction(tx_id, tag_id, 0, datetime.datetime.now(), 0, time_stop, int(meter_stop))
             samples = []
             [samples.extend([(sample, data['timestamp']) for sample in data['sampledValue']]) for data in tx_data]
             for sample, timestamp in samples:
-                if sample['context'] == 'Transaction.Begin':
+                if sample.get('context') == 'Transaction.Begin':
                     tx.meter_start = int(sample['value'])
-                    tx.time_start = datetime.datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ')
+                    tx.time_start = self._timestamp(timestamp)
                     break
             self.transactions[tx_id] = tx
         else:
             self.transactions[tx_id].time_stop = time_stop
             self.transactions[tx_id].meter_stop = meter_stop
+        if tx_data:
+            self._record_meter_curve(self.transactions[tx_id], tx_data)
         return self.transactions[tx_id]
 
     def _handle_charging_station(self, serial_number: str, metadata: dict):
@@ -143,70 +320,107 @@ class Ocpp16:
         """
         raise NotImplementedError
 
-    def follow_protocol(self, message: Request or Response):
+    def _handle_timeout(self, req: Request):
+        """
+        Implement to react to a request the charging station never answered, after all retries.
+        """
+        raise NotImplementedError
+
+    def _on_accepted(self, response: Response):
+        if response.body['status'] != 'Accepted':
+            self._handle_wrong_answer(response)
+
+    def _on_unlocked(self, response: Response):
+        if response.body['status'] != 'Unlocked':
+            self._handle_wrong_answer(response)
+
+    def _on_heartbeat(self, request: Request):
+        self._answer(request, {'currentTime': datetime.datetime.utcnow().isoformat()})
+
+    def _on_boot_notification(self, request: Request):
+        # meterSerialNumber is optional, chargers without a meter are known by their box serial number
+        serial_number = request.body.get('meterSerialNumber') or request.body.get('chargeBoxSerialNumber') \
+            or request.body.get('chargePointSerialNumber')
+        self._handle_charging_station(serial_number, metadata=request.body)
+        self._answer(request, {'status': 'Accepted', 'currentTime': datetime.datetime.utcnow().isoformat(),
+                               'interval': 14400})
+        if self.authorization and self.authorization.local_list \
+                and self.local_list_version != self.authorization.version:
+            # Let the charger authorize offline
+            self.push_local_list()
+
+    def _on_authorize(self, request: Request):
+        tag = self._authorize_tag(request.body['idTag'])
+        if tag:
+            self._answer(request, {'idTagInfo': {'status': 'Accepted', 'expiryDate': tag.expiry_date.isoformat()}})
+        else:
+            self._answer(request, {'idTagInfo': {'status': 'Rejected'}})
+
+    def _on_status_notification(self, request: Request):
+        self._answer(request, {})
+        self._handle_connector(number=request.body['connectorId'], last_status=request.body['status'])
+
+    def _on_meter_values(self, request: Request):
+        self._answer(request, {})
+        for value in request.body['meterValue']:
+            for sample in value['sampledValue']:
+                self._handle_connector(number=request.body['connectorId'], last_status=request.body.get('status'),
+                                       meter_read=sample['value'], meter_unit=sample.get('unit', 'Wh'))
+                break
+            break
+        tx_id = request.body.get('transactionId')
+        if tx_id in self.transactions:
+            self._record_meter_curve(self.transactions[tx_id], request.body['meterValue'])
+
+    def _on_start_transaction(self, request: Request):
+        tx = self._register_tx_start(conn_id=request.body['connectorId'], timestamp=request.body['timestamp'],
+                                     meter_start=request.body['meterStart'], tag_id=request.body['idTag'])
+        tag = self._authorize_tag(request.body['idTag'])
+        if tag:
+            self._answer(request, {"transactionId": tx.tx_id, "idTagInfo": {"status": "Accepted",
+                                                                            "expiryDate": tag.expiry_date.isoformat()}})
+        else:
+            self._answer(request, {"transactionId": tx.tx_id, "idTagInfo": {"status": "Rejected"}})
+
+    def _on_stop_transaction(self, request: Request):
+        tx = self._register_tx_stop(tx_id=request.body['transactionId'], timestamp=request.body['timestamp'],
+                                    meter_stop=request.body['meterStop'], tag_id=request.body.get('idTag'),
+                                    tx_data=request.body.get('transactionData', []))
+        if 'idTag' not in request.body:
+            # Stopped by the charger itself, there is no tag to report on
+            self._answer(request, {"transactionId": tx.tx_id})
+            return
+        tag = self._authorize_tag(request.body['idTag'])
+        if tag:
+            self._answer(request, {"transactionId": tx.tx_id, "idTagInfo": {"status": "Accepted",
+                                                                            "expiryDate": tag.expiry_date.isoformat()}})
+        else:
+            self._answer(request, {"transactionId": tx.tx_id, "idTagInfo": {"status": "Rejected"}})
 
-        if isinstance(message, Ocpp16.Response):
+    def follow_protocol(self, message: Request or Response or CallError):
+
+        if isinstance(message, Ocpp16.CallError):
+            self._handle_wrong_answer(message)
+            del self.req_queue[message.req.msg_id]
+            return
+
+        elif isinstance(message, Ocpp16.Response):
             response = message
-            if response.req.typ in ('RemoteStartTransaction', 'RemoteStopTransaction', 'TriggerMessage'):
-                if response.body['status'] != 'Accepted':
-                    self._handle_wrong_answer(response)
-            elif response.req.typ == 'UnlockConnector':
-                if response.body['status'] != 'Unlocked':
-                    self._handle_wrong_answer(response)
+            handler = self.response_handlers.get(response.req.typ)
+            if handler:
+                getattr(self, handler)(response) if isinstance(handler, str) else handler(self, response)
             del self.req_queue[response.req.msg_id]
             return
 
         elif isinstance(message, Ocpp16.Request):
-
             request = message
-            if request.typ == 'Heartbeat':
-                self._answer(request, {'currentTime': datetime.datetime.utcnow().isoformat()})
-                return
-            elif request.typ == 'BootNotification':
-                self._handle_charging_station(request.body['meterSerialNumber'], metadata=request.body)
-                self._answer(request, {'status': 'Accepted', 'currentTime': datetime.datetime.utcnow().isoformat(),
-                                       'interval': 14400})
-                return
-            elif request.typ == 'Authorize':
-                tag = self._authorize_tag(request.body['idTag'])
-                if tag:
-                    self._answer(request,
-                                 {'idTagInfo': {'status': 'Accepted', 'expiryDate': tag.expiry_date.isoformat()}})
-                else:
-                    self._answer(request, {'idTagInfo': {'status': 'Rejected'}})
-            elif request.typ == 'StatusNotification':
-                self._answer(request, {})
-                self._handle_connector(number=request.body['connectorId'], last_status=request.body['status'])
-            elif request.typ == 'MeterValues':
-                self._answer(request, {})
-                for value in request.body['meterValue']:
-                    for sample in value['sampledValue']:
-                        self._handle_connector(number=request.body['connectorId'], last_status=request.body['status'],
-                                               meter_read=sample['value'], meter_unit=sample['unit'])
-                        break
-                    break
-            elif request.typ == 'StartTransaction':
-                tx = self._register_tx_start(conn_id=request.body['connectorId'], timestamp=request.body['timestamp'],
-                                             meter_start=request.body['meterStart'], tag_id=request.body['idTag'])
-                tag = self._authorize_tag(request.body['idTag'])
-                if tag:
-                    self._answer(request, {"transactionId": tx.tx_id, "idTagInfo": {"status": "Accepted",
-                                                                                    "expiryDate": tag.expiry_date.isoformat()}})
-                else:
-                    self._answer(request, {"transactionId": tx.tx_id, "idTagInfo": {"status": "Rejected"}})
-
-            elif request.typ == 'StopTransaction':
-                tx = self._register_tx_stop(tx_id=request.body['transactionId'], timestamp=request.body['timestamp'],
-                                            meter_stop=request.body['meterStop'], tag_id=request.body['idTag'],
-                                            tx_data=request.body['transactionData'])
-                tag = self._authorize_tag(request.body['idTag'])
-                if tag:
-                    self._answer(request, {"transactionId": tx.tx_id, "idTagInfo": {"status": "Accepted",
-                                                                                    "expiryDate": tag.expiry_date.isoformat()}})
-                else:
-                    self._answer(request, {"transactionId": tx.tx_id, "idTagInfo": {"status": "Rejected"}})
+            handler = self.request_handlers.get(request.typ)
+            if handler:
+                getattr(self, handler)(request) if isinstance(handler, str) else handler(self, request)
+            elif request.typ in OCPP16_ACTIONS:
+                self._answer_error(request, 'NotSupported', f'{request.typ} is not supported.')
             else:
-                print(f"Unknown Request: {request.serialize()}")
+                self._answer_error(request, 'NotImplemented', f'Unknown action {request.typ}.')
 
 
 class ChargingStation(dao.Model, Ocpp16):
@@ -214,7 +428,7 @@ class ChargingStation(dao.Model, Ocpp16):
     def __init__(self, host: str, port: int, reg_id: str, last_seen: datetime.datetime = None, metadata: dict = None,
                  serial_number: str = None, connectors: dict = None, last_heartbeat: dict = None,
                  transactions: dict = None,
-                 tags: dict = None):
+                 tags: dict = None, last_tx_id: int = 0):
         self.host = host
         self.port = port
         self.last_seen: last_seen if last_seen else datetime.datetime = datetime.datetime.now()
@@ -226,6 +440,7 @@ class ChargingStation(dao.Model, Ocpp16):
         Ocpp16.__init__(self)
         self.transactions = transactions if transactions else {}
         self.tags = tags if tags else {}
+        self.last_tx_id = last_tx_id if last_tx_id else 0
 
     @dataclass
     class Connector(dao.Model):
@@ -248,22 +463,106 @@ class ChargingStation(dao.Model, Ocpp16):
             self.connectors[number] = ChargingStation.Connector(number, last_status, meter_read, meter_unit, metadata)
         else:
             connector = self.connectors[number]
-            connector.last_status = last_status
+            if last_status:
+                connector.last_status = last_status
             if meter_read:
                 connector.meter_read = meter_read
                 connector.meter_unit = meter_unit
         return self.connectors[number]
 
     def _authorize_tag(self, tag_id, expiry_date: datetime.datetime = None):
+        if self.authorization:
+            return self.authorization.authorize(str(tag_id), self.serial_number)
         if tag_id not in self.tags:
             if not expiry_date:
                 expiry_date = datetime.datetime.utcnow() + datetime.timedelta(days=360)
             self.tags[tag_id] = ChargingStation.Tag(tag_id, expiry_date)
+        else:
+            # Keep tags in least recently used order for retention
+            self.tags[tag_id] = self.tags.pop(tag_id)
         return self.tags[tag_id]
 
-    def _handle_wrong_answer(self, res: Ocpp16.Response):
+    def apply_retention(self, max_closed_transactions: int, max_tags: int) -> int:
+        """
+        Evict history that is already durable in the database. Open transactions, the most recent closed
+        transactions, the most recently used tags and anything not yet synced stay resident.
+        :param max_closed_transactions: Closed transactions kept in memory
+        :param max_tags: Tags kept in memory
+        :return: Number of evicted transactions and tags
+        """
+        closed = [tx for tx in self.transactions.values() if tx.meter_stop is not None]
+        closed.sort(key=lambda tx: tx.time_stop or tx.time_start)
+        evict_txs = [tx.tx_id for tx in closed[:max(0, len(closed) - max_closed_transactions)] if tx.reg_id]
+        evict_tags = [k for k, tag in list(self.tags.items())[:max(0, len(self.tags) - max_tags)] if tag.reg_id]
+        [self.transactions.pop(tx_id) for tx_id in evict_txs]
+        [self.tags.pop(tag_id) for tag_id in evict_tags]
+        return len(evict_txs) + len(evict_tags)
+
+    def restore_history(self, transactions: dict, tags: dict):
+        """
+        Bring evicted history back in memory, it stays until the next retention pass.
+        :param transactions: {tx_id: Transaction} loaded from the database
+        :param tags: {tag_id: Tag} loaded from the database
+        """
+        for tx_id, tx in (transactions if transactions else {}).items():
+            self.transactions.setdefault(tx_id, tx)
+        for tag_id, tag in (tags if tags else {}).items():
+            self.tags.setdefault(tag_id, tag)
+
+    def mark_synced(self, transactions: dict, tags: list):
+        """
+        Mark history written to the database, it becomes evictable.
+        :param transactions: {tx_id: document id}
+        :param tags: Tag ids
+        """
+        for tx_id, doc_id in transactions.items():
+            if tx_id in self.transactions:
+                self.transactions[tx_id].cs_reg_id = self.serial_number
+                self.transactions[tx_id].reg_id = doc_id
+        for tag_id in tags:
+            if tag_id in self.tags:
+                self.tags[tag_id].last_used_in = self.serial_number
+                self.tags[tag_id].reg_id = tag_id
+
+    def absorb(self, previous):
+        """
+        Take over the history of a previous session of the same station, this session state wins.
+        :param previous: ChargingStation of the previous session
+        """
+        self.tags = {**previous.tags, **self.tags}
+        self.transactions = {**previous.transactions, **self.transactions}
+        self.connectors = {**previous.connectors, **self.connectors}
+        self.last_tx_id = max(previous.last_tx_id, self.last_tx_id)
+        if not self.last_heartbeat:
+            self.last_heartbeat = previous.last_heartbeat
+        if not self.local_list_version:
+            # Chargers keep their local list across connections
+            self.local_list_version = previous.local_list_version
+
+    def _register_tx_stop(self, tx_id: int, timestamp: str, meter_stop: int, tag_id: str, tx_data: list):
+        if tx_id in self.transactions:
+            # Chargers resend StopTransaction when the answer is lost, count each transaction once
+            was_open = self.transactions[tx_id].meter_stop is None
+        else:
+            # Unknown after a restart or eviction, its start is only known from a Transaction.Begin sample
+            was_open = any(sample.get('context') == 'Transaction.Begin'
+                           for data in (tx_data if tx_data else []) for sample in data['sampledValue'])
+        tx = super()._register_tx_stop(tx_id, timestamp, meter_stop, tag_id, tx_data)
+        if self.rollups and was_open:
+            self.rollups.add(self.serial_number, tx)
+        return tx
+
+    def _handle_wrong_answer(self, res: Ocpp16.Response or Ocpp16.CallError):
+        if res.req and res.req.typ == 'SendLocalList':
+            # Not known to be up to date, pushed again on the next boot
+            self.local_list_version = 0
         print(f'Request {res.serialize()} rejected')
 
+    def _handle_timeout(self, req: Ocpp16.Request):
+        if req.typ == 'SendLocalList':
+            self.local_list_version = 0
+        print(f'Request {req.serialize()} unanswered after {req.attempts} attempts')
+
     def to_dict(self):
         dict_obj = super().to_dict()
         dict_obj['reg_id'] = self.reg_id
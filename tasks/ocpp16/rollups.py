@@ -0,0 +1,174 @@
+"""
+Incremental energy rollups: hourly and daily energy and sessions per station, connector and tag
+"""
+import datetime
+import json
+import os
+from dataclasses import dataclass
+
+from tasks.database import dao
+from tasks.metrics import ROUTES
+
+GRANULARITIES = ('hour', 'day')
+DIMENSIONS = ('station', 'connector', 'tag')
+
+
+def floor(moment: datetime.datetime, granularity: str) -> datetime.datetime:
+    if granularity == 'hour':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class EnergyRollups:
+    """
+    Updated once per closed transaction. The energy of a session is spread linearly over the hours it lasted and
+    the session is counted in the bucket it stopped in, so a query costs the number of buckets it returns instead of
+    a scan of the transactions.
+    """
+
+    @dataclass
+    class Bucket(dao.Model):
+        granularity: str
+        dimension: str
+        key: str
+        start: datetime.datetime
+        energy: float = 0
+        sessions: int = 0
+        # Process that counted it, workers keep separate rollups of the stations they own
+        source: str = None
+
+        @staticmethod
+        def from_dict(obj_dict: dict):
+            obj_dict['start'] = datetime.datetime.fromisoformat(obj_dict['start'])
+            return EnergyRollups.Bucket(**obj_dict)
+
+        def doc_id(self) -> str:
+            return f'{self.source}-{self.granularity}-{self.dimension}-{self.key}-{self.start:%Y%m%dT%H}'
+
+    def __init__(self, hourly_days: int = 7, daily_days: int = 400, mirror: bool = False, source: str = None):
+        """
+        :param hourly_days: Days hourly buckets are kept
+        :param daily_days: Days daily buckets are kept
+        :param mirror: Let ElasticSyncTask write changed buckets to the 'energy-rollups' index
+        :param source: Name of this process in the mirrored buckets
+        """
+        self.retention = {'hour': datetime.timedelta(days=hourly_days), 'day': datetime.timedelta(days=daily_days)}
+        self.mirror = mirror
+        self.source = source if source else f'pid{os.getpid()}'
+        # granularity -> dimension -> key -> {bucket start: Bucket}
+        self._buckets = {g: {d: {} for d in DIMENSIONS} for g in GRANULARITIES}
+        self._dirty = {}
+        self._pruned_at = None
+
+    @staticmethod
+    def from_config(rollups_config: dict):
+        return EnergyRollups(**rollups_config) if rollups_config is not None else None
+
+    def _bucket(self, granularity: str, dimension: str, key: str, start: datetime.datetime):
+        buckets = self._buckets[granularity][dimension].setdefault(key, {})
+        if start not in buckets:
+            buckets[start] = EnergyRollups.Bucket(granularity, dimension, key, start, source=self.source)
+        bucket = buckets[start]
+        if self.mirror:
+            self._dirty[bucket.doc_id()] = bucket
+        return bucket
+
+    @staticmethod
+    def _spread(time_start: datetime.datetime, time_stop: datetime.datetime, energy: float) -> [tuple]:
+        """ [(hour, energy)] in proportion to the time the session spent in each hour """
+        hour = floor(time_start, 'hour')
+        if time_stop <= time_start or floor(time_stop, 'hour') == hour:
+            return [(floor(time_stop, 'hour'), energy)]
+        duration = (time_stop - time_start).total_seconds()
+        shares = []
+        while hour < time_stop:
+            following = hour + datetime.timedelta(hours=1)
+            seconds = (min(following, time_stop) - max(hour, time_start)).total_seconds()
+            shares.append((hour, energy * seconds / duration))
+            hour = following
+        return shares
+
+    def add(self, serial_number: str, tx):
+        """
+        Account a closed transaction.
+        :param serial_number: Charging station serial number
+        :param tx: Ocpp16.Transaction with meter_stop and time_stop set
+        """
+        if tx.meter_stop is None or tx.time_stop is None:
+            return
+        energy = max(0, int(tx.meter_stop) - int(tx.meter_start))
+        keys = {'station': str(serial_number), 'connector': f'{serial_number}/{tx.connector_id}',
+                'tag': str(tx.tag_id)}
+        for hour, share in self._spread(tx.time_start, tx.time_stop, energy):
+            for dimension, key in keys.items():
+                self._bucket('hour', dimension, key, hour).energy += share
+                self._bucket('day', dimension, key, floor(hour, 'day')).energy += share
+        for dimension, key in keys.items():
+            self._bucket('hour', dimension, key, floor(tx.time_stop, 'hour')).sessions += 1
+            self._bucket('day', dimension, key, floor(tx.time_stop, 'day')).sessions += 1
+        self.prune()
+
+    def prune(self, now: datetime.datetime = None):
+        """ Drop the buckets past retention, at most once per hour """
+        now = floor(now if now else datetime.datetime.utcnow(), 'hour')
+        if self._pruned_at == now:
+            return
+        self._pruned_at = now
+        for granularity, dimensions in self._buckets.items():
+            oldest = now - self.retention[granularity]
+            for keys in dimensions.values():
+                for key, buckets in list(keys.items()):
+                    for start in [start for start in buckets if start < oldest]:
+                        del buckets[start]
+                    if not buckets:
+                        del keys[key]
+
+    def query(self, dimension: str = 'station', granularity: str = 'day', key: str = None,
+              start: datetime.datetime = None, end: datetime.datetime = None) -> [Bucket]:
+        """
+        :param dimension: 'station', 'connector' ('serial/connector_id') or 'tag'
+        :param granularity: 'hour' or 'day'
+        :param key: One station, connector or tag, all of them if omitted
+        :param start: First bucket included, UTC
+        :param end: Buckets starting before, UTC
+        :return: Buckets sorted by key and start
+        """
+        if granularity not in GRANULARITIES or dimension not in DIMENSIONS:
+            raise ValueError(f'Granularity must be one of {GRANULARITIES} and dimension one of {DIMENSIONS}.')
+        keys = self._buckets[granularity][dimension]
+        selected = [keys.get(key, {})] if key is not None else [keys[k] for k in sorted(keys)]
+        return [bucket for buckets in selected for moment, bucket in sorted(buckets.items())
+                if (start is None or moment >= start) and (end is None or moment < end)]
+
+    def totals(self, dimension: str = 'station', granularity: str = 'day', start: datetime.datetime = None,
+               end: datetime.datetime = None) -> dict:
+        """ {key: (energy, sessions)} summed over the buckets in range """
+        totals = {}
+        for bucket in self.query(dimension, granularity, None, start, end):
+            energy, sessions = totals.get(bucket.key, (0, 0))
+            totals[bucket.key] = (energy + bucket.energy, sessions + bucket.sessions)
+        return totals
+
+    def changed(self) -> [Bucket]:
+        """ Buckets updated since the last call, to be mirrored to the database """
+        changed, self._dirty = list(self._dirty.values()), {}
+        return changed
+
+    def retry(self, buckets: [Bucket]):
+        """ Mark buckets that could not be mirrored as changed again """
+        for bucket in buckets:
+            self._dirty.setdefault(bucket.doc_id(), bucket)
+
+    def http_route(self, dimension: str = 'station', granularity: str = 'day', key: str = None, start: str = None,
+                   end: str = None) -> tuple:
+        """ GET /rollups?dimension=station&granularity=day&key=...&start=2019-05-01&end=2019-06-01 """
+        buckets = self.query(dimension, granularity, key,
+                             datetime.datetime.fromisoformat(start) if start else None,
+                             datetime.datetime.fromisoformat(end) if end else None)
+        body = [{'key': b.key, 'start': b.start.isoformat(), 'energy': round(b.energy, 3), 'sessions': b.sessions}
+                for b in buckets]
+        return 'application/json', json.dumps(body)
+
+    def expose(self, path: str = '/rollups'):
+        """ Serve the rollups on the metrics server """
+        ROUTES[path] = self.http_route
@@ -1,121 +1,365 @@
 import asyncio
 import datetime
-import json
-import pprint
+import functools
+import time
 
 import websockets
 
+from tasks.backpressure import RateLimiter
 from tasks.database.dao import DAOFactory
+from tasks.metrics import REGISTRY
+from tasks.ocpp16.codec import Codec, get_codec
+from tasks.ocpp16.fanout import FleetCommand, FleetResult, fan_out
+from tasks.ocpp16.timeouts import TimerWheel
 from tasks.ocpp16.protocol import ChargingStation, Ocpp16
+from tasks.ocpp16.trace import ProtocolTracer
+from tasks.ocpp16.validation import default_validator
+from tasks.ocpp16.wire import SessionProtocol, compression_options
+from tasks.scheduling import WAKEUPS
+
+HANDLING_SECONDS = REGISTRY.histogram('ocpp16_handling_seconds', 'Time to dispatch one incoming frame per action.',
+                                      ('action',))
+SESSIONS_CONNECTED = REGISTRY.gauge('ocpp16_sessions_connected', 'Websocket sessions currently open.')
+STATION_QUEUE_DEPTH = REGISTRY.gauge('ocpp16_station_queue_depth', 'Entries held in all stations message queues.',
+                                     ('queue',))
+CALL_TIMEOUTS = REGISTRY.counter('ocpp16_call_timeouts_total', 'CALLs left unanswered past the timeout.',
+                                 ('action', 'outcome'))
+FANOUT_SECONDS = REGISTRY.histogram('ocpp16_fanout_seconds', 'Time to get every answer of a fleet command.',
+                                    ('method',))
+# Charge point actions producing work for other tasks -> tasks.scheduling.WAKEUPS event
+WAKEUP_ACTIONS = {'BootNotification': 'station_booted', 'StopTransaction': 'transaction_closed'}
 
 
 class Ocpp16Server:
 
-    def __init__(self, factory: DAOFactory, queue: dict):
+    def __init__(self, factory: DAOFactory, queue: dict, tracer: ProtocolTracer = None, codec: Codec = None,
+                 limiter: RateLimiter = None, call_timeout: float = 30, call_retries: int = 1, validate: bool = True,
+                 compression: dict = None):
+        """
+        :param factory: Actor DAO factory holding the charging stations state, see tasks.database.actordao
+        :param queue: App queues
+        :param tracer: Protocol tracer, frames are not traced if omitted
+        :param codec: Frame codec, defaults to the fastest JSON library installed
+        :param limiter: Per station and action rate limiter, inbound frames are not limited if omitted
+        :param call_timeout: Seconds to wait for the answer of a CALL sent to a charging station
+        :param call_retries: Times an unanswered CALL is sent again before it is given up
+        :param validate: Check the payloads against the OCPP 1.6 schemas of their action before handling them
+        :param compression: permessage-deflate settings, see tasks.ocpp16.wire.compression_options
+        """
         self._queue = queue
         self._factory = factory
-
-    def _dispatcher(self, cs: ChargingStation, msg: Ocpp16.Request or Ocpp16.Response):
+        self._tracer = tracer
+        self._codec = codec if codec else get_codec()
+        self._limiter = limiter
+        self._validator = default_validator() if validate else None
+        self._serve_options = compression_options(compression)
+        self.call_timeout = call_timeout
+        self.call_retries = call_retries
+        self._timeouts = TimerWheel()
+        self._timeouts_task = None
+        self._commands_task = None
+        # (cs_id, msg_id) -> Future of the answer awaited by a fleet command
+        self._waiters = {}
+        # serial_number -> cs_id of its latest session
+        self._directory = {}
+        self._directory_published = 0
+        cs_dao = factory.get_instance(ChargingStation)
+
+        def depth(name: str) -> int:
+            return sum(len(getattr(cs, name)) for cs in cs_dao.peek_all())
+
+        for name in ('req_queue', 'res_queue'):
+            STATION_QUEUE_DEPTH.set_function(functools.partial(depth, name), queue=name)
+
+    async def _dispatcher(self, cs: ChargingStation, msg: Ocpp16.Request or Ocpp16.Response):
         """
-        Manage state and dispatch incoming message to its designated Charging Station
-        :param cs: ChargingStation
+        Dispatch incoming message to its designated Charging Station, the station actor changes its state
+        :param cs: ChargingStation, taken over as the station state if it is new
         :param msg: Message
         """
         cs_dao = self._factory.get_instance(ChargingStation)
-        try:
-            cs = cs_dao.retrieve(cs.reg_id)
-            cs.last_seen = datetime.datetime.now()
-        except:
+        start = time.perf_counter()
+        if cs.reg_id not in cs_dao:
             cs_dao.create(cs)
-        if isinstance(msg, Ocpp16.Response):
+        msg = await cs_dao.ask(cs.reg_id, self._follow_protocol, msg)
+        if not isinstance(msg, Ocpp16.Request):
+            self._resolve((cs.reg_id, msg.msg_id), FleetResult.outcome_of(msg))
+        action = msg.typ if isinstance(msg, Ocpp16.Request) else msg.req.typ
+        HANDLING_SECONDS.observe(time.perf_counter() - start, action=action)
+
+    def _follow_protocol(self, cs: ChargingStation, msg: Ocpp16.Request or Ocpp16.Response):
+        """
+        :return: The message followed, an invalid answer is followed as the CallError it amounts to
+        """
+        cs.last_seen = datetime.datetime.now()
+        if isinstance(msg, (Ocpp16.Response, Ocpp16.CallError)):
             if msg.msg_id not in cs.req_queue:
                 raise ConnectionError('Out-of-sync: Response for an unsent message.')
-            msg.req = cs.req_queue[msg.msg_id]
+            req = cs.req_queue[msg.msg_id]
+            self._timeouts.cancel((cs.reg_id, msg.msg_id))
+            # The answer is traced with the action it answers
+            msg.req = req
+            error = self._validator.validate_response(req.typ, msg.body) \
+                if self._validator and isinstance(msg, Ocpp16.Response) else None
+            if error:
+                msg = Ocpp16.CallError(4, msg.msg_id, *error)
+                msg.req = req
         cs.follow_protocol(message=msg)
-        cs_dao.update(cs)
+        if isinstance(msg, Ocpp16.Request) and msg.typ in WAKEUP_ACTIONS:
+            WAKEUPS.signal(WAKEUP_ACTIONS[msg.typ])
+        return msg
 
-    def _aggregator(self) -> [Ocpp16.Request or Ocpp16.Response]:
+    async def _aggregator(self, cs_id: str) -> [Ocpp16.Request or Ocpp16.Response or Ocpp16.CallError]:
         """
-        Aggregate outgoing messages from all charging stations
+        Collect the outgoing messages of a charging station
         :return: [Messages]
         """
-        messages = []
         cs_dao = self._factory.get_instance(ChargingStation)
+        if cs_id not in cs_dao:
+            return []
+        collected = cs_dao.tell(cs_id, self._collect)
+
+        def requeue(future: asyncio.Future):
+            if not future.cancelled() and not future.exception():
+                self._requeue(cs_id, future.result())
+
+        try:
+            return await asyncio.shield(collected)
+        except asyncio.CancelledError:
+            # The session was interrupted, the messages are sent on the next call
+            collected.add_done_callback(requeue)
+            raise
 
-        def gather(msg: Ocpp16.Request or Ocpp16.Response):
+    def _collect(self, cs: ChargingStation) -> list:
+        messages = []
+
+        def gather(msg: Ocpp16.Request or Ocpp16.Response or Ocpp16.CallError):
             if msg.is_pending:
                 messages.append(msg)
                 msg.is_pending = False
 
-        for cs in cs_dao.retrieve_all():
-            [gather(req) for req in cs.req_queue.values()]
-            [gather(res) for res in cs.res_queue.values()]
-            cs_dao.update(cs)
+        for req in cs.req_queue.values():
+            if req.is_pending:
+                req.attempts += 1
+                self._timeouts.schedule((cs.reg_id, req.msg_id), self.call_timeout,
+                                        functools.partial(self._expire_call, cs.reg_id, req.msg_id))
+            gather(req)
+        [gather(res) for res in cs.res_queue.values()]
+        # Answers are sent once and never referenced again
+        cs.res_queue = {}
         return messages
 
-    def _message_handler(self, msg):
-        pp = pprint.PrettyPrinter(indent=4)
-        print(f">> {pp.pformat(msg.serialize())}\n")
+    def _requeue(self, cs_id: str, messages: list):
+        """ Put messages collected but not sent back in the station queues """
+
+        def uncollect(cs: ChargingStation):
+            for msg in messages:
+                msg.is_pending = True
+                if not isinstance(msg, Ocpp16.Request):
+                    cs.res_queue[msg.msg_id] = msg
+
+        cs_dao = self._factory.get_instance(ChargingStation)
+        if messages and cs_id in cs_dao:
+            cs_dao.tell(cs_id, uncollect)
+
+    def _expire_call(self, cs_id: str, msg_id: str):
+        """
+        Send an unanswered CALL again or give it up once the retries are exhausted.
+        """
+        cs_dao = self._factory.get_instance(ChargingStation)
+        if cs_id in cs_dao:
+            cs_dao.tell(cs_id, self._expire, msg_id).add_done_callback(
+                functools.partial(self._report, 'Error expiring unanswered calls: '))
+
+    def _expire(self, cs: ChargingStation, msg_id: str):
+        if msg_id not in cs.req_queue:
+            return
+        req = cs.req_queue[msg_id]
+        if req.attempts <= self.call_retries:
+            req.is_pending = True
+            CALL_TIMEOUTS.inc(action=req.typ, outcome='retry')
+        else:
+            del cs.req_queue[msg_id]
+            cs._handle_timeout(req)
+            CALL_TIMEOUTS.inc(action=req.typ, outcome='failed')
+            self._resolve((cs.reg_id, msg_id), 'timeout')
+
+    async def _expire_calls(self):
+        while True:
+            await asyncio.sleep(self._timeouts.tick)
+            try:
+                self._timeouts.advance()
+            except Exception as e:
+                self._error_handler('Error expiring unanswered calls: ', e)
+
+    def _resolve(self, key: tuple, outcome: str):
+        waiter = self._waiters.pop(key, None)
+        if waiter and not waiter.done():
+            waiter.set_result(outcome)
+
+    def _execute(self, cs_id: str, method: str, kwargs: dict) -> asyncio.Future:
+        """
+        Call a method on the charging station state.
+        :return: Future of the ids of the requests it queued for the charging station
+        """
+        return self._factory.get_instance(ChargingStation).tell(cs_id, self._call, method, kwargs)
+
+    @staticmethod
+    def _call(cs: ChargingStation, method: str, kwargs: dict) -> [str]:
+        sent = set(cs.req_queue)
+        method = getattr(cs, method)
+        if callable(method):
+            method(**kwargs)
+        return [msg_id for msg_id in cs.req_queue if msg_id not in sent]
+
+    async def _fan_out(self, command: FleetCommand):
+        """
+        Run a fleet command on the selected stations, at most command.concurrency of them waiting at a time.
+        """
+        loop = asyncio.get_event_loop()
+        start = time.perf_counter()
+        semaphore = asyncio.Semaphore(command.concurrency)
+        cs_dao = self._factory.get_instance(ChargingStation)
+        stations = [(cs.reg_id, cs.serial_number) for cs in cs_dao.peek_all() if command.selector.matches(cs)]
+
+        async def dispatch(cs_id: str) -> str:
+            async with semaphore:
+                try:
+                    msg_ids = await self._execute(cs_id, command.method, command.kwargs)
+                except Exception as e:
+                    return f'error: {e}'
+                if not msg_ids:
+                    return 'sent'
+                keys = [(cs_id, msg_id) for msg_id in msg_ids]
+                for key in keys:
+                    self._waiters[key] = loop.create_future()
+                try:
+                    outcomes = await asyncio.wait_for(asyncio.gather(*[self._waiters[key] for key in keys]),
+                                                      command.timeout)
+                    return outcomes[-1]
+                except asyncio.TimeoutError:
+                    return 'timeout'
+                finally:
+                    [self._waiters.pop(key, None) for key in keys]
+
+        outcomes = await asyncio.gather(*[dispatch(cs_id) for cs_id, _ in stations])
+        result = FleetResult(command.method, {serial: outcome for (_, serial), outcome in zip(stations, outcomes)},
+                             time.perf_counter() - start)
+        FANOUT_SECONDS.observe(result.elapsed, method=command.method)
+        if command.result and not command.result.done():
+            command.result.set_result(result)
+
+    def _report(self, text: str, future: asyncio.Future):
+        if not future.cancelled() and future.exception():
+            self._error_handler(text, future.exception())
+
+    async def _consume_commands(self):
+        """ Single consumer of 'ev_charger_command', fleet commands run concurrently with the following commands """
+        while True:
+            command = await self._queue['ev_charger_command'].get()
+            try:
+                if isinstance(command, FleetCommand):
+                    asyncio.ensure_future(self._fan_out(command))
+                else:
+                    self._execute(*command).add_done_callback(
+                        functools.partial(self._report, 'Error processing command messages: '))
+            except Exception as e:
+                self._error_handler('Error processing command messages: ', e)
+
+    def start(self):
+        """ Consume commands and expire unanswered calls, whether stations are connected or not """
+        if not self._timeouts_task:
+            self._timeouts_task = asyncio.ensure_future(self._expire_calls())
+        if not self._commands_task:
+            self._commands_task = asyncio.ensure_future(self._consume_commands())
+
+    async def _notify_available(self, cs_id: str):
+        """ Publish the stations directory when the station got its serial number, or once per second """
+        cs_dao = self._factory.get_instance(ChargingStation)
+        serial_number = cs_dao.peek(cs_id).serial_number if cs_id in cs_dao else None
+        changed = serial_number and self._directory.get(serial_number) != cs_id
+        if changed:
+            self._directory[serial_number] = cs_id
+        if changed or time.monotonic() - self._directory_published > 1:
+            self._directory_published = time.monotonic()
+            await self._queue['ev_chargers_available'].put(dict(self._directory))
+        if changed:
+            WAKEUPS.signal('stations_available')
+
+    def _message_handler(self, direction: str, station: str, msg):
+        if self._tracer:
+            cs_dao = self._factory.get_instance(ChargingStation)
+            serial_number = cs_dao.peek(station).serial_number if station in cs_dao else None
+            self._tracer.trace(direction, station, msg, serial_number)
 
     def _error_handler(self, text, e):
         print(f'{text}{e.with_traceback(e.__traceback__)}')
 
-    def get_server(self, host: str, port: int) -> websockets.serve:
+    def get_server(self, host: str, port: int, **kwargs) -> websockets.serve:
+        """
+        :param host: Interface to listen on
+        :param port: Port to listen on
+        :param kwargs: Passed to loop.create_server, i.e. reuse_port=True to share the port between processes
+        """
 
         clients_connected = set()
 
         async def outgoing(websocket, path):
             """ Send Messages from all charging stations queues """
             await asyncio.sleep(1)
+            station = '%s:%s' % websocket.remote_address[:2]
+            messages = []
             try:
-                for msg in self._aggregator():
-                    await websocket.send(json.dumps(msg.serialize()))
-                    self._message_handler(msg)
+                messages = await self._aggregator(station)
+                # The frames of the station leave in as few segments as possible
+                websocket.cork()
+                while messages:
+                    await websocket.send(self._codec.encode(messages[0].serialize()))
+                    self._message_handler('out', station, messages.pop(0))
 
             except asyncio.CancelledError:
-                pass
+                self._requeue(station, messages)
             except Exception as e:
                 self._error_handler('Error in delegating outgoing messages: ', e)
-
-        async def wait_command():
-            """ check_command_messages """
-            try:
-                cs_dao = self._factory.get_instance(ChargingStation)
-
-                def execute(cs_id: str, method: str, kwargs: dict):
-                    cs = cs_dao.retrieve(cs_id)
-                    method = getattr(cs, method)
-                    if callable(method):
-                        method(**kwargs)
-                    cs_dao.update(cs)
-
-                cs_id, method, kwargs = await self._queue['ev_charger_command'].get()
-                execute(cs_id, method, kwargs)
-
-            except asyncio.CancelledError:
-                pass
-            except Exception as e:
-                self._error_handler('Error processing command messages: ', e)
+            finally:
+                websocket.uncork()
 
         async def incoming(websocket, path):
             """ Listen to new messages and dispatch them """
             try:
-                packet = json.loads(await websocket.recv())
-                if len(packet) < 1 or packet[0] not in (2, 3):
-                    self._error_handler(f'Malformed {packet}', AssertionError('Unknown message format'))
+                packet = self._codec.decode(await websocket.recv())
+                try:
+                    msg = Ocpp16.parse(packet)
+                except ValueError as e:
+                    self._error_handler('Unknown message format: ', e)
                     return None
 
-                msg = Ocpp16.Request(*packet) if packet[0] == 2 else Ocpp16.Response(*packet)
                 host, port = websocket.remote_address[0], websocket.remote_address[1]
                 cs = ChargingStation(host, port, f'{host}:{port}')
 
-                self._message_handler(msg)
-                self._dispatcher(cs=cs, msg=msg)
-
-                # notify_available_charging_stations
-                cs_dao = self._factory.get_instance(ChargingStation)
-                stations = {cs.serial_number: cs.reg_id for cs in cs_dao.retrieve_all() if cs.serial_number}
-                await self._queue['ev_chargers_available'].put(stations)
+                if isinstance(msg, Ocpp16.Request):
+                    self._message_handler('in', cs.reg_id, msg)
+                if self._limiter and isinstance(msg, Ocpp16.Request) and not self._limiter.allow(cs.reg_id, msg.typ):
+                    # Shed before touching the station state, the answer tells the charger to back off
+                    error = Ocpp16.CallError(4, msg.msg_id, 'GenericError', 'Rate limit exceeded, retry later.')
+                    await websocket.send(self._codec.encode(error.serialize()))
+                    return None
+                if self._validator and isinstance(msg, Ocpp16.Request):
+                    # Refused before reaching the station state, handlers may rely on the required fields
+                    invalid = self._validator.validate_request(msg.typ, msg.body)
+                    if invalid:
+                        error = Ocpp16.CallError(4, msg.msg_id, *invalid)
+                        await websocket.send(self._codec.encode(error.serialize()))
+                        self._message_handler('out', cs.reg_id, error)
+                        return None
+                try:
+                    # Handled even if the session is interrupted meanwhile, the charger expects an answer
+                    await asyncio.shield(self._dispatcher(cs=cs, msg=msg))
+                finally:
+                    if not isinstance(msg, Ocpp16.Request):
+                        # Once the request it answers is attached
+                        self._message_handler('in', cs.reg_id, msg)
+                await self._notify_available(cs.reg_id)
 
             except asyncio.CancelledError:
                 pass
@@ -125,6 +369,7 @@ class Ocpp16Server:
         async def router(websocket, path):
             """ Route the messages to the different clients connected"""
             clients_connected.add(websocket)
+            SESSIONS_CONNECTED.set(len(clients_connected))
 
             while True:
                 try:
@@ -132,12 +377,14 @@ class Ocpp16Server:
                     # for ws in clients_connected:
                     if not websocket.closed:
                         tasks.append(asyncio.ensure_future(incoming(websocket, path)))
-                        tasks.append(asyncio.ensure_future(wait_command()))
                         tasks.append(asyncio.ensure_future(outgoing(websocket, path)))
                     else:
                         clients_connected.remove(websocket)
+                        SESSIONS_CONNECTED.set(len(clients_connected))
                         host, port = websocket.remote_address[0], websocket.remote_address[1]
-                        print(f'Client {host}:{port} disconnected.')
+                        if self._limiter:
+                            self._limiter.forget(f'{host}:{port}')
+                        print(f'Client {host}:{port} disconnected, {websocket.report()}.')
                         break
                     if len(tasks) > 1:
                         done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
@@ -148,8 +395,10 @@ class Ocpp16Server:
                     host, port = websocket.remote_address[0], websocket.remote_address[1]
                     self._error_handler(f'Client {host}:{port} disconnected abruptly. ', e)
 
+        self.start()
         # Returns a future
-        return websockets.serve(ws_handler=router, host=host, port=port, subprotocols=['ocpp1.6'])
+        return websockets.serve(ws_handler=router, host=host, port=port, subprotocols=['ocpp1.6'],
+                                create_protocol=SessionProtocol, **dict(self._serve_options, **kwargs))
 
 
 async def command(queue: dict):
@@ -181,20 +430,24 @@ async def command(queue: dict):
         await start(cs_id)
         await asyncio.sleep(10)
         await stop(cs_id)
+    result = await fan_out(queue, 'request_meter_values', timeout=10)
+    print(f'Meter values requested from the fleet: {result.summary()}')
     print('---- end -----')
 
 
 if __name__ == '__main__':
     try:
-        from tasks.database.memorydao import MemoryDAOFactory
+        from tasks.backpressure import BoundedQueue
+        from tasks.database.actordao import ActorDAOFactory
         IP = 'localhost'
         # IP = '192.168.123.220'
         PORT = 8080
-        FACTORY = MemoryDAOFactory()
+        FACTORY = ActorDAOFactory()
+        TRACER = ProtocolTracer('-')
         # FACTORY = ElasticSearchDAOFactory('elocity', 'http://127.0.0.1:9200')
-        QUEUE = {'ev_charger_command': asyncio.Queue(maxsize=10),
-                 'ev_chargers_available': asyncio.Queue(maxsize=5)}
-        server_cls = Ocpp16Server(FACTORY, QUEUE)
+        QUEUE = {'ev_charger_command': BoundedQueue('ev_charger_command', 10),
+                 'ev_chargers_available': BoundedQueue('ev_chargers_available', 1, 'drop_oldest')}
+        server_cls = Ocpp16Server(FACTORY, QUEUE, TRACER)
         future = server_cls.get_server(IP, PORT)
         print(f'Server started at http://{IP}:{PORT}.')
         asyncio.get_event_loop().run_until_complete(future)
@@ -0,0 +1,69 @@
+"""
+Hashed timer wheel for the deadlines of in-flight CALLs
+"""
+import time
+
+
+class TimerWheel:
+    """
+    Timers are hashed into slots by deadline; advancing the wheel only visits the slots whose tick has passed, so
+    scheduling, cancelling and expiring cost O(1) no matter how many CALLs are outstanding.
+    """
+
+    def __init__(self, tick: float = 1.0, slots: int = 64):
+        """
+        :param tick: Resolution in seconds
+        :param slots: Number of slots, deadlines further than tick * slots take extra rounds
+        """
+        self.tick = tick
+        self._slots = [{} for _ in range(slots)]
+        self._where = {}
+        self._cursor = 0
+        self._last = time.monotonic()
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def schedule(self, key, delay: float, callback):
+        """
+        :param key: Hashable timer id, rescheduling an existing key replaces it
+        :param delay: Seconds from now
+        :param callback: Called without arguments once expired
+        """
+        self.cancel(key)
+        ticks = max(1, int(-(-delay // self.tick)))
+        slot = (self._cursor + ticks) % len(self._slots)
+        self._slots[slot][key] = [(ticks - 1) // len(self._slots), callback]
+        self._where[key] = slot
+
+    def cancel(self, key) -> bool:
+        slot = self._where.pop(key, None)
+        if slot is None:
+            return False
+        del self._slots[slot][key]
+        return True
+
+    def advance(self, now: float = None) -> int:
+        """
+        Move the wheel to now and run the callbacks of expired timers.
+        :return: Number of timers fired
+        """
+        now = time.monotonic() if now is None else now
+        expired = []
+        while now - self._last >= self.tick:
+            self._last += self.tick
+            self._cursor = (self._cursor + 1) % len(self._slots)
+            slot = self._slots[self._cursor]
+            for key, timer in list(slot.items()):
+                if timer[0] > 0:
+                    timer[0] -= 1
+                    continue
+                del slot[key]
+                del self._where[key]
+                expired.append(timer[1])
+        for callback in expired:
+            callback()
+        return len(expired)
@@ -0,0 +1,96 @@
+"""
+Structured protocol trace written as JSON lines by a background thread
+"""
+import json
+import queue
+import random
+import sys
+import threading
+import time
+
+from tasks.metrics import REGISTRY
+from tasks.ocpp16.protocol import Ocpp16
+
+TRACE_DROPPED = REGISTRY.counter('ocpp16_trace_dropped_total', 'Trace records dropped because the buffer was full.')
+
+
+class ProtocolTracer:
+    """
+    Samples OCPP frames and hands them to a writer thread through a bounded buffer.
+    The event loop only pays for the sampling decision and one non-blocking put; encoding and disk I/O happen
+    off-loop. When the buffer is full records are dropped and counted instead of slowing frame handling.
+    """
+
+    def __init__(self, path: str = '-', sample_rate: float = 1.0, stations: dict = None, actions: dict = None,
+                 buffer_size: int = 10000):
+        """
+        :param path: File to append JSON lines to. '-' writes to stdout.
+        :param sample_rate: Fraction of frames traced, from 0.0 to 1.0
+        :param stations: Sample rate per station, by serial number or host:port, overriding sample_rate
+        :param actions: Sample rate multiplier per OCPP action, i.e. {'Heartbeat': 0.0}
+        :param buffer_size: Maximum records waiting for the writer
+        """
+        self.path = path
+        self.sample_rate = sample_rate
+        self.stations = stations if stations else {}
+        self.actions = actions if actions else {}
+        self._buffer = queue.Queue(maxsize=buffer_size)
+        self._writer = threading.Thread(target=self._write_forever, name='Ocpp16Trace', daemon=True)
+        self._writer.start()
+
+    @staticmethod
+    def from_config(trace_config: dict):
+        return ProtocolTracer(**trace_config) if trace_config else None
+
+    def _is_sampled(self, station: str, action: str, serial_number: str = None) -> bool:
+        if serial_number in self.stations:
+            rate = self.stations[serial_number]
+        else:
+            rate = self.stations.get(station, self.sample_rate)
+        rate *= self.actions.get(action, 1.0)
+        return rate >= 1.0 or (rate > 0.0 and random.random() < rate)
+
+    def trace(self, direction: str, station: str, msg: Ocpp16.Request or Ocpp16.Response or Ocpp16.CallError,
+              serial_number: str = None):
+        """
+        :param direction: 'in' for frames received from the station, 'out' for frames sent to it
+        :param station: Station host:port
+        :param msg: Frame, answers with the request they answer attached
+        :param serial_number: Station serial number once booted, sampled by it over host:port
+        """
+        if isinstance(msg, Ocpp16.Request):
+            action = msg.typ
+        else:
+            action = msg.req.typ if msg.req else ('CallResult' if msg.msg_type == 3 else 'CallError')
+        if not self._is_sampled(station, action, serial_number):
+            return
+        try:
+            self._buffer.put_nowait((time.time(), direction, station, action, msg.serialize()))
+        except queue.Full:
+            TRACE_DROPPED.inc()
+
+    def _write_forever(self):
+        stream = sys.stdout if self.path == '-' else open(self.path, 'a')
+        while True:
+            record = self._buffer.get()
+            if record is None:
+                break
+            lines = [record]
+            while not self._buffer.empty() and lines[-1] is not None:
+                lines.append(self._buffer.get_nowait())
+            for line in lines:
+                if line is None:
+                    continue
+                ts, direction, station, action, frame = line
+                stream.write(json.dumps({'ts': ts, 'dir': direction, 'station': station, 'action': action,
+                                         'frame': frame}, default=str) + '\n')
+            stream.flush()
+            if lines[-1] is None:
+                break
+        if stream is not sys.stdout:
+            stream.close()
+
+    def close(self):
+        """ Flush pending records and stop the writer """
+        self._buffer.put(None)
+        self._writer.join()
@@ -0,0 +1,173 @@
+"""
+OCPP 1.6-JSON payload validation. The JSON schemas of the actions, in tasks/ocpp16/schemas, are compiled once into
+plain functions checking a payload in a single pass, so a bad frame costs a few dictionary lookups instead of an
+exception raised deep in a handler.
+"""
+import functools
+import json
+import os
+import re
+
+from tasks.metrics import REGISTRY
+
+SCHEMAS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schemas')
+INVALID_FRAMES = REGISTRY.counter('ocpp16_invalid_frames_total', 'Frames refused by the schema of their action.',
+                                  ('action', 'code'))
+
+# RFC 3339 as required by OCPP for dateTime fields
+DATE_TIME = re.compile(r'\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(\.\d+)?(Z|[+-]\d\d:\d\d)?')
+
+
+def _is_integer(value) -> bool:
+    # Some chargers send 1.0 for 1
+    return (isinstance(value, int) and not isinstance(value, bool)) or (isinstance(value, float) and value.is_integer())
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+TYPE_CHECKS = {
+    'object': lambda value: isinstance(value, dict),
+    'array': lambda value: isinstance(value, list),
+    'string': lambda value: isinstance(value, str),
+    'boolean': lambda value: isinstance(value, bool),
+    'integer': _is_integer,
+    'number': _is_number,
+}
+
+
+def _compile_object(schema: dict, path: str):
+    properties = {name: compile_schema(sub, f'{path}.{name}') for name, sub in schema.get('properties', {}).items()}
+    required = tuple(schema.get('required', ()))
+    closed = schema.get('additionalProperties', True) is False
+
+    def validate(value: dict):
+        for name in required:
+            if name not in value:
+                return 'OccurenceConstraintViolation', f'{path}.{name} is required.'
+        for name, item in value.items():
+            check = properties.get(name)
+            if check is None:
+                if closed:
+                    return 'FormationViolation', f'{path}.{name} is not part of the payload.'
+                continue
+            error = check(item)
+            if error:
+                return error
+        return None
+
+    return validate
+
+
+def _compile_array(schema: dict, path: str):
+    check = compile_schema(schema['items'], f'{path}[]') if 'items' in schema else None
+    min_items = schema.get('minItems', 0)
+
+    def validate(value: list):
+        if len(value) < min_items:
+            return 'OccurenceConstraintViolation', f'{path} needs at least {min_items} items.'
+        if check:
+            for item in value:
+                error = check(item)
+                if error:
+                    return error
+        return None
+
+    return validate
+
+
+def _compile_string(schema: dict, path: str):
+    enum = frozenset(schema['enum']) if 'enum' in schema else None
+    max_length = schema.get('maxLength')
+    date_time = schema.get('format') == 'date-time'
+
+    def validate(value: str):
+        if enum is not None and value not in enum:
+            return 'PropertyConstraintViolation', f'{path} {value!r} is not one of {sorted(enum)}.'
+        if max_length is not None and len(value) > max_length:
+            return 'PropertyConstraintViolation', f'{path} is longer than {max_length} characters.'
+        if date_time and not DATE_TIME.fullmatch(value):
+            return 'TypeConstraintViolation', f'{path} {value!r} is not a RFC 3339 date-time.'
+        return None
+
+    return validate
+
+
+def compile_schema(schema: dict, path: str):
+    """
+    Compile a JSON schema, the draft-04 subset used by the OCPP 1.6 schemas.
+    :param path: Name of the validated value in the error descriptions
+    :return: Function of a value returning None if valid, else (OCPP error code, description)
+    """
+    typ = schema.get('type')
+    is_type = TYPE_CHECKS[typ] if typ else None
+    if typ == 'object':
+        check = _compile_object(schema, path)
+    elif typ == 'array':
+        check = _compile_array(schema, path)
+    elif typ == 'string':
+        check = _compile_string(schema, path)
+    else:
+        check = None
+
+    def validate(value):
+        if is_type and not is_type(value):
+            return 'TypeConstraintViolation', f'{path} must be of type {typ}.'
+        return check(value) if check else None
+
+    return validate
+
+
+class PayloadValidator:
+    """
+    Validators of the requests and answers of every action with a schema. Actions without one, i.e. registered
+    vendor actions, are not checked.
+    """
+
+    def __init__(self, path: str = SCHEMAS_PATH):
+        """
+        :param path: Folder of OCPP 1.6-JSON schemas named after their action, i.e. Authorize.json for the request
+        and AuthorizeResponse.json for its answer
+        """
+        self.requests = {}
+        self.responses = {}
+        for file_name in sorted(os.listdir(path)):
+            if not file_name.endswith('.json'):
+                continue
+            with open(os.path.join(path, file_name)) as file:
+                schema = json.load(file)
+            action = file_name[:-len('.json')]
+            if action.endswith('Response'):
+                self.responses[action[:-len('Response')]] = compile_schema(schema, action)
+            else:
+                self.requests[action] = compile_schema(schema, action)
+
+    @staticmethod
+    def _validate(validators: dict, action: str, body) -> (str, str) or None:
+        validate = validators.get(action)
+        if not validate:
+            return None
+        error = validate(body) if isinstance(body, dict) else ('FormationViolation', f'{action} must be an object.')
+        if error:
+            INVALID_FRAMES.inc(action=action, code=error[0])
+        return error
+
+    def validate_request(self, action: str, body) -> (str, str) or None:
+        """
+        :return: None if the payload is valid, else (OCPP error code, description) to answer it with
+        """
+        return self._validate(self.requests, action, body)
+
+    def validate_response(self, action: str, body) -> (str, str) or None:
+        """
+        :param action: Action of the request answered
+        :return: None if the payload is valid, else (OCPP error code, description)
+        """
+        return self._validate(self.responses, action, body)
+
+
+@functools.lru_cache()
+def default_validator() -> PayloadValidator:
+    """ Validator of the bundled schemas, compiled on first use and shared by the servers of the process """
+    return PayloadValidator()
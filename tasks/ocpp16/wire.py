@@ -0,0 +1,138 @@
+"""
+Websocket sessions for chargers on metered links: permessage-deflate negotiated with tunable settings, frames queued
+for a station written to the socket at once, and the bytes on the wire counted per session.
+"""
+import functools
+
+import websockets
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+
+from tasks.metrics import REGISTRY
+
+WIRE_BYTES = REGISTRY.counter('ocpp16_wire_bytes_total', 'Bytes on the websocket connections, after compression.',
+                              ('direction',))
+PAYLOAD_BYTES = REGISTRY.counter('ocpp16_payload_bytes_total', 'Bytes of the OCPP messages, before compression.',
+                                 ('direction',))
+SESSION_WIRE_BYTES = REGISTRY.histogram('ocpp16_session_wire_bytes', 'Bytes on the wire per closed session.',
+                                        ('direction',), buckets=(1e3, 1e4, 1e5, 1e6, 1e7, 1e8))
+SESSION_COMPRESSION = REGISTRY.counter('ocpp16_sessions_compression_total', 'Sessions per negotiated compression.',
+                                       ('compression',))
+COALESCED_FRAMES = REGISTRY.counter('ocpp16_coalesced_frames_total', 'Frames written with the previous one at once.')
+
+
+def compression_options(compression: dict or bool = None) -> dict:
+    """
+    websockets.serve keyword arguments negotiating permessage-deflate.
+    :param compression: False to send frames uncompressed, None or {} for the websockets defaults, else
+    {'server_max_window_bits': 8 to 15, 'client_max_window_bits': 8 to 15, 'level': 1 to 9, 'mem_level': 1 to 9,
+    'no_context_takeover': False}. Smaller windows and memory levels cost less memory per session and compress less,
+    no_context_takeover compresses each frame on its own.
+    """
+    if compression is False:
+        return {'compression': None}
+    options = dict(compression if compression else {})
+    settings = {'level': options.pop('level', None), 'memLevel': options.pop('mem_level', None)}
+    no_context_takeover = options.pop('no_context_takeover', False)
+    unknown = set(options) - {'server_max_window_bits', 'client_max_window_bits'}
+    if unknown:
+        raise TypeError(f'Unknown compression options {sorted(unknown)}')
+    factory = functools.partial(ServerPerMessageDeflateFactory, server_no_context_takeover=no_context_takeover,
+                                client_no_context_takeover=no_context_takeover,
+                                server_max_window_bits=options.get('server_max_window_bits'),
+                                compress_settings={k: v for k, v in settings.items() if v is not None} or None)
+    extensions = [factory(client_max_window_bits=options.get('client_max_window_bits'))]
+    if options.get('client_max_window_bits'):
+        # Clients not offering to shrink their window still compress what the server sends
+        extensions.append(factory())
+    return {'extensions': extensions}
+
+
+class _MeteredWriter:
+    """ asyncio.StreamWriter writing through its session """
+
+    def __init__(self, writer, write):
+        self._writer = writer
+        self._write = write
+
+    def write(self, data: bytes):
+        self._write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._writer, name)
+
+
+class SessionProtocol(websockets.WebSocketServerProtocol):
+    """
+    Server protocol counting the bytes of its session. Between cork and uncork, frames are kept and written to the
+    socket together, so a burst of messages fills segments instead of sending one each.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wire_in = 0
+        self.wire_out = 0
+        self.payload_in = 0
+        self.payload_out = 0
+        self._corked = None
+        self._socket_writer = None
+
+    def client_connected(self, reader, writer):
+        self._socket_writer = writer
+        super().client_connected(reader, _MeteredWriter(writer, self._write))
+
+    def _write(self, data: bytes):
+        if self._corked is not None:
+            self._corked.append(data)
+            return
+        self.wire_out += len(data)
+        WIRE_BYTES.inc(len(data), direction='out')
+        self._socket_writer.write(data)
+
+    def cork(self):
+        if self._corked is None:
+            self._corked = []
+
+    def uncork(self):
+        corked, self._corked = self._corked, None
+        if corked:
+            COALESCED_FRAMES.inc(len(corked) - 1)
+            self._write(b''.join(corked))
+
+    @property
+    def compression(self) -> str:
+        return ','.join(extension.name for extension in self.extensions) if self.extensions else 'none'
+
+    def connection_open(self):
+        super().connection_open()
+        SESSION_COMPRESSION.inc(compression=self.compression)
+
+    def data_received(self, data: bytes):
+        self.wire_in += len(data)
+        WIRE_BYTES.inc(len(data), direction='in')
+        super().data_received(data)
+
+    async def recv(self):
+        data = await super().recv()
+        if data is not None:
+            size = len(data.encode('utf-8')) if isinstance(data, str) else len(data)
+            self.payload_in += size
+            PAYLOAD_BYTES.inc(size, direction='in')
+        return data
+
+    async def send(self, data):
+        size = len(data.encode('utf-8')) if isinstance(data, str) else len(data)
+        self.payload_out += size
+        PAYLOAD_BYTES.inc(size, direction='out')
+        await super().send(data)
+
+    def connection_lost(self, exc):
+        # Nowhere to write what was kept
+        self._corked = None
+        SESSION_WIRE_BYTES.observe(self.wire_in, direction='in')
+        SESSION_WIRE_BYTES.observe(self.wire_out, direction='out')
+        super().connection_lost(exc)
+
+    def report(self) -> str:
+        """ Bytes of the session, on the wire and of the messages """
+        return (f'{self.wire_out} bytes sent for {self.payload_out} of messages, {self.wire_in} received for '
+                f'{self.payload_in}, compression {self.compression}')
@@ -0,0 +1,144 @@
+"""
+Ocpp 1.6 server worker processes sharing one port through SO_REUSEPORT
+"""
+import asyncio
+import datetime
+import multiprocessing
+
+# Workers are spawned, not forked, so they never inherit the parent's event loop, threads or DAO singletons.
+CONTEXT = multiprocessing.get_context('spawn')
+
+
+class Ocpp16Worker(CONTEXT.Process):
+    """
+    Runs its own event loop and Ocpp16Server. The kernel balances new connections between workers listening on the
+    same port, every worker owns the sessions and charging stations state of the connections it accepted.
+    """
+
+    def __init__(self, index: int, host: str, port: int, commands, directory, replies, trace_config: dict = None,
+                 codec_name: str = None, service_urls: tuple = None, rate_limits: dict = None,
+                 server_options: dict = None, auth_config: dict = None, rollups_config: dict = None,
+                 spool_config: dict = None, metrics_config: dict = None, retention: dict = None,
+                 schedule_config: dict = None, cache_config: dict = None):
+        """
+        :param index: Worker number, used to route commands back to it
+        :param host: Interface to listen on
+        :param port: Port shared by all workers
+        :param commands: Inter-process queue of (cs_id, method, kwargs) routed to this worker
+        :param directory: Inter-process queue shared by all workers to publish (index, {serial_number: cs_id})
+        :param replies: Inter-process queue shared by all workers to return (index, command_id, FleetResult)
+        :param trace_config: Protocol trace configuration, the worker index is appended to the file name
+        :param codec_name: Frame codec name
+        :param service_urls: Elastic search urls. When set the worker syncs its own stations to the database.
+        :param rate_limits: Inbound rate limits per station and action
+        :param server_options: Passed to Ocpp16Server, i.e. call_timeout and call_retries
+        :param auth_config: Authorization cache configuration, tags are prefetched by every worker
+        :param rollups_config: Energy rollups configuration, mirror them to the database to see the whole fleet
+        :param spool_config: Elastic search write spool configuration, the worker index is appended to its path
+        :param metrics_config: {'host', 'port'} of the main process metrics, served by the worker on port + index + 1
+        :param retention: {'transactions', 'tags'} kept in memory per station once synced
+        :param schedule_config: tasks.scheduling.AdaptiveSchedule options of the worker ElasticSyncTask
+        :param cache_config: Elastic search read cache configuration, each worker caches its own reads
+        """
+        self.index = index
+        self.server_address = (host, port)
+        self.commands = commands
+        self.directory = directory
+        self.replies = replies
+        self.trace_config = trace_config
+        self.codec_name = codec_name
+        self.service_urls = service_urls
+        self.rate_limits = rate_limits
+        self.server_options = server_options if server_options else {}
+        self.auth_config = auth_config
+        self.rollups_config = rollups_config
+        self.spool_config = spool_config
+        self.metrics_config = metrics_config
+        self.retention = retention if retention else {}
+        self.schedule_config = schedule_config
+        self.cache_config = cache_config
+        super().__init__(name=f'Ocpp16Worker{index}', daemon=True)
+
+    async def _forward_commands(self, queue: dict):
+        from tasks.ocpp16.fanout import FleetCommand
+        loop = asyncio.get_event_loop()
+        while True:
+            command = await loop.run_in_executor(None, self.commands.get)
+            if isinstance(command, FleetCommand):
+                command.result = loop.create_future()
+                loop.create_task(self._reply(command))
+            await queue['ev_charger_command'].put(command)
+
+    async def _reply(self, command):
+        self.replies.put((self.index, command.command_id, await command.result))
+
+    async def _publish_directory(self, queue: dict):
+        while True:
+            stations = await queue['ev_chargers_available'].get()
+            self.directory.put((self.index, stations))
+
+    def run(self):
+        import energyweb
+        from tasks.backpressure import BoundedQueue, RateLimiter
+        from tasks.chargepoint import Ocpp16ServerTask
+        from tasks.database.actordao import ActorDAOFactory
+        from tasks.ocpp16.codec import get_codec
+        from tasks.ocpp16.trace import ProtocolTracer
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        queue = {'ev_charger_command': BoundedQueue('ev_charger_command'),
+                 'ev_chargers_available': BoundedQueue('ev_chargers_available', 1, 'drop_oldest')}
+        tracer = None
+        if self.trace_config:
+            trace_config = dict(self.trace_config)
+            if trace_config.get('path', '-') != '-':
+                trace_config['path'] = f"{trace_config['path']}.{self.index}"
+            tracer = ProtocolTracer.from_config(trace_config)
+        console = energyweb.Logger(self.name).console
+        if self.spool_config:
+            from tasks.database.elasticdao import ElasticSearchDAO
+            from tasks.database.spool import WriteSpool
+            ElasticSearchDAO.spool = WriteSpool.from_config(self.spool_config, f'.{self.index}')
+        if self.cache_config:
+            from tasks.database.cache import DocumentCache
+            from tasks.database.elasticdao import ElasticSearchDAO
+            ElasticSearchDAO.cache = DocumentCache.from_config(self.cache_config)
+        if self.auth_config is not None:
+            from tasks.ocpp16.authorization import AuthorizationCache
+            from tasks.ocpp16.protocol import ChargingStation
+            authorization = AuthorizationCache.from_config(self.auth_config, self.service_urls)
+            try:
+                authorization.prefetch()
+            except Exception as e:
+                console.warning(f'Authorization prefetch failed: {e}')
+            ChargingStation.authorization = authorization
+        if self.rollups_config is not None:
+            from tasks.ocpp16.protocol import ChargingStation
+            from tasks.ocpp16.rollups import EnergyRollups
+            ChargingStation.rollups = EnergyRollups(**dict(self.rollups_config, source=self.name))
+            ChargingStation.rollups.expose()
+        server = Ocpp16ServerTask.Ocpp16ServerLogger(ActorDAOFactory(), queue, console, tracer,
+                                                     get_codec(self.codec_name),
+                                                     RateLimiter.from_config(self.rate_limits),
+                                                     **self.server_options)
+        loop.run_until_complete(server.get_server(*self.server_address, reuse_port=True))
+        console.info(f'{self.name} listening on http://{self.server_address[0]}:{self.server_address[1]}')
+        if self.metrics_config:
+            from tasks.metrics import MetricsServer
+            metrics_address = (self.metrics_config['host'], self.metrics_config['port'] + self.index + 1)
+            loop.run_until_complete(MetricsServer().get_server(*metrics_address))
+            console.info(f'{self.name} metrics exposed on http://{metrics_address[0]}:{metrics_address[1]}/metrics')
+        loop.create_task(self._forward_commands(queue))
+        loop.create_task(self._publish_directory(queue))
+        if self.service_urls:
+            from tasks.elsync import ElasticSyncTask
+            from tasks.metrics import time_ticks
+            from tasks.scheduling import schedule_ticks
+            sync_task = schedule_ticks(time_ticks(ElasticSyncTask(queue, datetime.timedelta(seconds=2),
+                                                                  self.service_urls,
+                                                                  self.retention.get('transactions', 20),
+                                                                  self.retention.get('tags', 50),
+                                                                  self.schedule_config)))
+            loop.create_task(sync_task.run())
+        loop.run_forever()
@@ -1,22 +1,44 @@
 import asyncio
 import datetime
+import time
 
 import energyweb
 
 from energyweb.config import CooV1ConsumerConfiguration, CooV1ProducerConfiguration
 
+from tasks.carbon import emission_series
+from tasks.metrics import REGISTRY
+from tasks.scheduling import AdaptiveSchedule
+
+MINT_SECONDS = REGISTRY.histogram('origin_mint_seconds', 'Time to mint and receive the receipt per asset.', ('asset',),
+                                  buckets=(.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+MINT_FAILURES = REGISTRY.counter('origin_mint_failures_total', 'Mint attempts that failed per asset.', ('asset',))
+
 
 class CooGeneralTask(energyweb.Logger, energyweb.Task):
 
     def __init__(self, task_config: energyweb.config.CooV1ConsumerConfiguration, polling_interval: datetime.timedelta,
-                 queue: asyncio.Queue, store: str = '', enable_debug: bool = False):
+                 queue: asyncio.Queue, store: str = '', enable_debug: bool = False, wallet_options: dict = None,
+                 schedule_config: dict = None, wake_events: tuple = ()):
         """
         :param task_config: Consumer configuration class instance
-        :param polling_interval: Time interval between interrupts check
+        :param polling_interval: Time interval between interrupts check, the shortest one once the meter is idle
         :param store: Path to folder where the log files will be stored in disk. DEFAULT won't store data in-disk.
         :param enable_debug: Enabling debug creates a log for errors. Needs storage. Please manually delete it.
+        :param wallet_options: Mint through the tasks.wallet.WalletClient shared by the tasks using the same wallet,
+        with these options. None mints with the smart-contract client.
+        :param schedule_config: tasks.scheduling.AdaptiveSchedule options, the checks back off up to ten times the
+        polling interval while the meter is down
+        :param wake_events: tasks.scheduling.WAKEUPS events checking the meter right away
         """
         self.task_config = task_config
+        self.schedule = AdaptiveSchedule.from_config(schedule_config, min_interval=polling_interval.total_seconds(),
+                                                     max_interval=10 * polling_interval.total_seconds(),
+                                                     events=wake_events)
+        self.wallet = None
+        if wallet_options is not None and hasattr(task_config.smart_contract, 'credentials'):
+            from tasks.wallet import WalletClient
+            self.wallet = WalletClient.shared(task_config.smart_contract, **wallet_options)
         self.chain_file_name = 'origin.pkl'
         self.msg_success = 'minted %s watts - block # %s'
         self.msg_error = 'energy_meter: %s - stack: %s'
@@ -58,6 +80,7 @@ class CooGeneralTask(energyweb.Logger, energyweb.Task):
         """
         Try to reach the energy_meter and logs the measured energy.
         Wraps the complexity of the data read and the one to be written to the smart-contract
+        :return: False if the meter had nothing to read or minting failed
         """
         try:
             # Get the data by accessing the external energy device
@@ -74,13 +97,30 @@ class CooGeneralTask(energyweb.Logger, energyweb.Task):
                 last_chain_hash = self.task_config.smart_contract.last_hash()
                 energy_data = self._transform(local_file_hash=last_chain_hash)
             # Logging to the blockchain
-            tx_receipt = self.task_config.smart_contract.mint(energy_data)
+            tx_receipt = await self._mint(energy_data)
             block_number = str(tx_receipt['blockNumber'])
             self.console.debug(self.msg_success, energy_data.to_dict(), block_number)
+            return not energy_data.is_meter_down
         except ConnectionError as e:
             self.console.warning('Not minted, Smart-contract is unreachable.')
+            # Back off until the chain is reachable
+            return False
         except Exception as e:
             self._handle_exception(e)
+            return False
+
+    async def _mint(self, energy_data: energyweb.EnergyData) -> dict:
+        start = time.perf_counter()
+        try:
+            if self.wallet:
+                # Other tasks keep submitting while this one waits for its receipt
+                return await self.wallet.mint(self.task_config.smart_contract, energy_data)
+            return self.task_config.smart_contract.mint(energy_data)
+        except Exception:
+            MINT_FAILURES.inc(asset=self.task_config.name)
+            raise
+        finally:
+            MINT_SECONDS.observe(time.perf_counter() - start, asset=self.task_config.name)
 
     async def _finish(self):
         pass
@@ -93,30 +133,44 @@ class CooGeneralTask(energyweb.Logger, energyweb.Task):
 class CooProducerTask(CooGeneralTask):
 
     def __init__(self, task_config: CooV1ProducerConfiguration, polling_interval: datetime.timedelta,
-                 queue: asyncio.Queue, store: str = None, enable_debug: bool = False):
+                 queue: asyncio.Queue, store: str = None, enable_debug: bool = False, wallet_options: dict = None,
+                 schedule_config: dict = None):
         """
         :param task_config: Producer configuration class instance
         :param polling_interval: Time interval between interrupts check
         :param queue: For thread safe messaging between tasks
         :param store: Path to folder where the log files will be stored in disk. DEFAULT won't store data in-disk.
         :param enable_debug: Enabling debug creates a log for errors. Needs storage. Please manually delete it.
+        :param wallet_options: See CooGeneralTask
+        :param schedule_config: See CooGeneralTask, the meter is also checked once new transactions are synced
         """
         super().__init__(task_config=task_config, polling_interval=polling_interval, store=store, queue=queue,
-                         enable_debug=enable_debug)
+                         enable_debug=enable_debug, wallet_options=wallet_options, schedule_config=schedule_config,
+                         wake_events=('transactions_synced',))
 
     def _transform(self, local_file_hash: str) -> energyweb.EnergyData:
         """
         Transforms the raw external energy data into blockchain format. Needs to be implemented for each different
         smart-contract and configuration type.
         """
-        raw_energy, is_meter_down = self._fetch_remote_data(self.task_config.energy_meter)
-        if not is_meter_down and not self.task_config.energy_meter.is_accumulated:
+        raw_carbon_emitted, is_co2_down = self._fetch_remote_data(self.task_config.carbon_emission)
+        energy_meter = self.task_config.energy_meter
+        if hasattr(energy_meter, 'emission_series'):
+            # Meters reading transactions account their CO2 over time instead of at the current intensity
+            energy_meter.emission_series = emission_series(raw_carbon_emitted)
+        raw_energy, is_meter_down = self._fetch_remote_data(energy_meter)
+        new_energy = raw_energy.energy if raw_energy else 0
+        if not is_meter_down and not energy_meter.is_accumulated:
             last_remote_state = self.task_config.smart_contract.last_state()
             raw_energy.energy += last_remote_state[3] # get the fourth element returned from the contract from last_state: uint _lastSmartMeterReadWh
-        raw_carbon_emitted, is_co2_down = self._fetch_remote_data(self.task_config.carbon_emission)
         energy = raw_energy.energy if raw_energy else 0
         accumulated_co2 = raw_carbon_emitted.accumulated_co2 if raw_carbon_emitted else 0
-        calculated_co2 = energy * accumulated_co2
+        new_co2 = raw_energy.raw.get('co2_saved') if raw_energy and isinstance(raw_energy.raw, dict) else None
+        if new_co2 is None:
+            calculated_co2 = energy * accumulated_co2
+        else:
+            # The reading already on chain keeps the current intensity, the new energy gets its time weighted CO2
+            calculated_co2 = (energy - new_energy) * accumulated_co2 + new_co2
         produced = {
             'value': int(energy),
             'is_meter_down': is_meter_down,
@@ -130,16 +184,19 @@ class CooProducerTask(CooGeneralTask):
 class CooConsumerTask(CooGeneralTask):
 
     def __init__(self, task_config: CooV1ConsumerConfiguration, polling_interval: datetime.timedelta,
-                 queue: asyncio.Queue, store: str = None, enable_debug: bool = False):
+                 queue: asyncio.Queue, store: str = None, enable_debug: bool = False, wallet_options: dict = None,
+                 schedule_config: dict = None):
         """
         :param task_config: Consumer configuration class instance
         :param polling_interval: Time interval between interrupts check
         :param queue: For thread safe messaging between tasks
         :param store: Path to folder where the log files will be stored in disk. DEFAULT won't store data in-disk.
         :param enable_debug: Enabling debug creates a log for errors. Needs storage. Please manually delete it.
+        :param wallet_options: See CooGeneralTask
+        :param schedule_config: See CooGeneralTask
         """
         super().__init__(task_config=task_config, polling_interval=polling_interval, store=store, queue=queue,
-                         enable_debug=enable_debug)
+                         enable_debug=enable_debug, wallet_options=wallet_options, schedule_config=schedule_config)
 
     def _transform(self, local_file_hash: str) -> energyweb.EnergyData:
         """
@@ -0,0 +1,136 @@
+"""
+Adaptive task scheduling. A task ticks again soon while it finds work, backs off exponentially while idle, and is woken
+right away by the events it subscribes to. Events signalled while a task ticks or waits are handled by one tick.
+"""
+import asyncio
+import functools
+import weakref
+
+from tasks.metrics import REGISTRY, task_name
+
+TASK_INTERVAL = REGISTRY.gauge('task_interval_seconds', 'Current idle wait between ticks per adaptive task.', ('task',))
+TASK_WAKEUPS = REGISTRY.counter('task_wakeups_total', 'Events handled by a tick per adaptive task.', ('task', 'event'))
+TASK_COALESCED = REGISTRY.counter('task_coalesced_events_total', 'Events folded into a tick already due per task.',
+                                  ('task',))
+
+
+class Wakeups:
+    """ Process wide named events, signalled where work is produced and awaited by the tasks consuming it """
+
+    def __init__(self):
+        # event -> schedules subscribed to it
+        self._subscribers = {}
+
+    def subscribe(self, event: str, schedule):
+        self._subscribers.setdefault(event, weakref.WeakSet()).add(schedule)
+
+    def signal(self, event: str):
+        """ Wake the tasks subscribed to event, i.e. 'transaction_closed' """
+        for schedule in list(self._subscribers.get(event, ())):
+            schedule.wake(event)
+
+
+WAKEUPS = Wakeups()
+
+
+class AdaptiveSchedule:
+
+    def __init__(self, min_interval: float, max_interval: float, backoff: float = 2, events: tuple = ()):
+        """
+        :param min_interval: Seconds from a tick to the next one at the soonest, and the wait after a tick with work
+        :param max_interval: Longest wait between idle ticks
+        :param backoff: Factor the wait grows by after each idle tick
+        :param events: WAKEUPS events starting the next tick right away
+        """
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.backoff = backoff
+        self.interval = min_interval
+        # event -> times signalled since the last tick started
+        self._pending = {}
+        self._woken = None
+        self._last_tick = None
+        for event in events:
+            WAKEUPS.subscribe(event, self)
+
+    @staticmethod
+    def from_config(schedule_config: dict = None, **defaults):
+        """
+        :param schedule_config: AdaptiveSchedule keyword arguments overriding the task defaults
+        :param defaults: AdaptiveSchedule keyword arguments of the task
+        """
+        return AdaptiveSchedule(**dict(defaults, **(schedule_config or {})))
+
+    def wake(self, event: str):
+        self._pending[event] = self._pending.get(event, 0) + 1
+        if self._woken:
+            self._woken.set()
+
+    def done(self, worked: bool):
+        """ Tick again after min_interval if the tick worked, else wait longer """
+        self.interval = self.min_interval if worked else min(self.interval * self.backoff, self.max_interval)
+
+    async def wait(self) -> dict:
+        """
+        Wait for the interval to elapse or an event, and at least min_interval from the last tick start.
+        :return: {event: times signalled} handled by the tick about to start
+        """
+        loop = asyncio.get_event_loop()
+        if self._woken is None:
+            self._woken = asyncio.Event()
+        if not self._pending:
+            try:
+                await asyncio.wait_for(self._woken.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+        if self._last_tick is not None:
+            # A burst of events right after a tick is handled by one tick
+            delay = self._last_tick + self.min_interval - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        return self.tick()
+
+    def tick(self) -> dict:
+        """
+        Start a tick without waiting
+        :return: {event: times signalled} handled by the tick
+        """
+        events, self._pending = self._pending, {}
+        if self._woken:
+            self._woken.clear()
+        self._last_tick = asyncio.get_event_loop().time()
+        return events
+
+
+def schedule_ticks(task):
+    """
+    Run the ticks of an energyweb.Task instance on its schedule attribute, an AdaptiveSchedule, instead of its polling
+    interval. _main returns False when the tick found nothing to do, anything else counts as work.
+    Wrap after metrics.time_ticks, the wait is not part of the tick.
+    :param task: energyweb.Task
+    :return: The same task
+    """
+    schedule = getattr(task, 'schedule', None)
+    if not schedule or getattr(task, '_scheduled', False):
+        return task
+    main = task._main
+    # The schedule waits, energyweb.Task.run must not sleep
+    task.polling_interval = None
+
+    @functools.wraps(main)
+    async def scheduled_main(*args):
+        name = task_name(task)
+        # Eager tasks tick once before waiting
+        events = await schedule.wait() if schedule._last_tick is not None or not task.eager else schedule.tick()
+        for event, count in events.items():
+            TASK_WAKEUPS.inc(task=name, event=event)
+            if count > 1:
+                TASK_COALESCED.inc(count - 1, task=name)
+        worked = await main(*args)
+        schedule.done(worked is not False)
+        TASK_INTERVAL.set(schedule.interval, task=name)
+        return worked
+
+    task._main = scheduled_main
+    task._scheduled = True
+    return task
@@ -0,0 +1,295 @@
+"""
+Shared signing client per wallet: producers and consumers using the same wallet submit their mint transactions
+back to back over one pooled connection, the nonces are counted locally and the receipts are polled for all of them
+at once.
+"""
+import asyncio
+import json
+import threading
+import time
+
+import requests
+from web3 import HTTPProvider, Web3
+from web3.providers.base import JSONBaseProvider
+
+from tasks.metrics import REGISTRY
+
+PENDING_TRANSACTIONS = REGISTRY.gauge('wallet_pending_transactions', 'Transactions sent and waiting for a receipt.',
+                                      ('wallet',))
+NONCE_RESYNCS = REGISTRY.counter('wallet_nonce_resyncs_total', 'Nonces fetched again from the client.', ('wallet',))
+
+
+class PooledHTTPProvider(HTTPProvider):
+    """ HTTPProvider keeping up to pool_size connections to the client open, and sending batches of calls """
+
+    def __init__(self, endpoint_uri: str, pool_size: int = 4, timeout: float = 10):
+        super().__init__(endpoint_uri)
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def make_request(self, method, params):
+        response = self.session.post(self.endpoint_uri, data=self.encode_rpc_request(method, params),
+                                     headers={'Content-Type': 'application/json'}, timeout=self.timeout)
+        response.raise_for_status()
+        return self.decode_rpc_response(response.content)
+
+    def make_batch_request(self, calls: [tuple]) -> [dict]:
+        """
+        :param calls: [(method, params)]
+        :return: Responses in the order of the calls
+        """
+        body = [{'jsonrpc': '2.0', 'method': method, 'params': params, 'id': i} for i, (method, params) in
+                enumerate(calls)]
+        response = self.session.post(self.endpoint_uri, data=json.dumps(body),
+                                     headers={'Content-Type': 'application/json'}, timeout=self.timeout)
+        response.raise_for_status()
+        return sorted(response.json(), key=lambda r: r['id'])
+
+
+class LocalChain(JSONBaseProvider):
+    """
+    In process stand-in of a blockchain client, enough for WalletClient: it checks the nonces of the raw transactions
+    it receives and mines the pending ones into a block every block_time seconds.
+    """
+
+    def __init__(self, block_time: float = 1, chain_id: int = 401697):
+        super().__init__()
+        self.block_time = block_time
+        self.chain_id = chain_id
+        self.block_number = 0
+        self.mined_at = time.monotonic()
+        self.nonces = {}
+        self.pending = []
+        self.receipts = {}
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def _mine(self):
+        if time.monotonic() - self.mined_at < self.block_time:
+            return
+        self.mined_at = time.monotonic()
+        self.block_number += 1
+        for tx_hash in self.pending:
+            self.receipts[tx_hash] = {'transactionHash': tx_hash, 'blockNumber': hex(self.block_number),
+                                      'status': '0x1'}
+        self.pending = []
+
+    def _send_raw_transaction(self, raw: str) -> str:
+        import rlp
+        from eth_account import Account
+        from eth_utils import keccak, to_hex
+        sender = Account.recoverTransaction(raw).lower()
+        nonce = rlp.decode(bytes.fromhex(raw[2:]))[0]
+        nonce = int.from_bytes(nonce, 'big')
+        expected = self.nonces.get(sender, 0)
+        if nonce != expected:
+            raise ValueError(f'Transaction nonce is too {"low" if nonce < expected else "high"}.')
+        self.nonces[sender] = nonce + 1
+        tx_hash = to_hex(keccak(hexstr=raw))
+        self.pending.append(tx_hash)
+        self.sent.append((sender, nonce, tx_hash))
+        return tx_hash
+
+    def _result(self, method: str, params: list):
+        if method == 'net_version':
+            return str(self.chain_id)
+        if method == 'eth_blockNumber':
+            return hex(self.block_number)
+        if method == 'eth_getTransactionCount':
+            return hex(self.nonces.get(params[0].lower(), 0))
+        if method == 'eth_sendRawTransaction':
+            return self._send_raw_transaction(params[0])
+        if method == 'eth_getTransactionReceipt':
+            return self.receipts.get(params[0])
+        raise ValueError(f'Method {method} not supported.')
+
+    def make_request(self, method, params):
+        with self._lock:
+            self._mine()
+            try:
+                return {'jsonrpc': '2.0', 'id': 0, 'result': self._result(method, list(params))}
+            except ValueError as e:
+                return {'jsonrpc': '2.0', 'id': 0, 'error': {'code': -32010, 'message': str(e)}}
+
+    def make_batch_request(self, calls: [tuple]) -> [dict]:
+        return [self.make_request(method, params) for method, params in calls]
+
+
+class _CallRecorder:
+    """ Stands for an OriginV1 client in its own mint method, to get the contract call it would send """
+
+    def __init__(self, asset_id: int):
+        self.asset_id = asset_id
+        self.call = None
+
+    def send_raw(self, contract_name: str, method_name: str, *args):
+        self.call = (contract_name, method_name, args)
+        return self.call
+
+
+class WalletClient:
+    """
+    Signs and sends the transactions of one wallet. Sending only takes the lock for the nonce, the receipts of all
+    pending transactions are fetched with one batch request per poll.
+    """
+    # (client_url, wallet address) -> WalletClient
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, client_url: str, wallet_add: str, private_key: str, pool_size: int = 4,
+                 receipt_poll: float = 2, receipt_timeout: float = 600, gas: int = 400000, provider=None):
+        """
+        :param client_url: Blockchain client json rpc url
+        :param wallet_add: Wallet address
+        :param private_key: Hex private key of the wallet, wallet_pwd in the smart-contract configuration
+        :param pool_size: Connections kept open to the client
+        :param receipt_poll: Seconds between receipt polls
+        :param receipt_timeout: Seconds before a transaction without receipt is given up
+        :param gas: Gas limit of each transaction
+        :param provider: Used instead of a PooledHTTPProvider to client_url, i.e. LocalChain
+        """
+        self.provider = provider if provider else PooledHTTPProvider(client_url, pool_size)
+        self.w3 = Web3(self.provider)
+        self.address = Web3.toChecksumAddress(wallet_add)
+        self.private_key = bytearray.fromhex(private_key[2:] if private_key.startswith('0x') else private_key)
+        self.receipt_poll = receipt_poll
+        self.receipt_timeout = receipt_timeout
+        self.gas = gas
+        self._nonce = None
+        self._chain_id = None
+        self._contracts = {}
+        self._lock = threading.Lock()
+        # tx hash -> (future, deadline)
+        self._receipts = {}
+        self._poller = None
+
+    @staticmethod
+    def shared(smart_contract, **options):
+        """
+        Client of the wallet of a smart-contract client from the configuration, one per wallet and blockchain client.
+        :param smart_contract: energyweb OriginV1 client
+        :param options: WalletClient keyword arguments
+        """
+        client_url = smart_contract.w3.providers[0].endpoint_uri
+        wallet_add, private_key = smart_contract.credentials
+        key = (client_url, wallet_add.lower())
+        with WalletClient._shared_lock:
+            if key not in WalletClient._shared:
+                WalletClient._shared[key] = WalletClient(client_url, wallet_add, private_key, **options)
+            return WalletClient._shared[key]
+
+    def _contract(self, contract: dict):
+        address = Web3.toChecksumAddress(contract['address'])
+        if address not in self._contracts:
+            self._contracts[address] = self.w3.eth.contract(abi=contract['abi'], address=address,
+                                                            bytecode=contract['bytecode'])
+        return self._contracts[address]
+
+    def submit(self, contract: dict, method_name: str, *args) -> str:
+        """
+        Sign and send a contract call without waiting for it to be mined. Thread safe.
+        :param contract: Contract structure with abi, bytecode and address keys
+        :return: Transaction hash
+        """
+        function = getattr(self._contract(contract).functions, method_name)(*args)
+        with self._lock:
+            for attempt in range(2):
+                if self._nonce is None:
+                    self._nonce = self.w3.eth.getTransactionCount(self.address, 'pending')
+                    self._chain_id = int(self.w3.net.version)
+                    NONCE_RESYNCS.inc(wallet=self.address)
+                tx = function.buildTransaction({'from': self.address, 'gas': self.gas,
+                                                'gasPrice': self.w3.toWei('0', 'gwei'), 'nonce': self._nonce,
+                                                'chainId': self._chain_id})
+                signed = self.w3.eth.account.signTransaction(tx, private_key=self.private_key)
+                try:
+                    tx_hash = self.w3.eth.sendRawTransaction(signed.rawTransaction)
+                except ValueError as e:
+                    # Sent by another process or dropped by the client, count again from the client
+                    self._nonce = None
+                    if attempt or 'nonce' not in str(e).lower():
+                        raise
+                    continue
+                except Exception:
+                    self._nonce = None
+                    raise
+                self._nonce += 1
+                return Web3.toHex(tx_hash)
+
+    async def receipt(self, tx_hash: str) -> dict:
+        """ Wait for the transaction to be mined, ConnectionError if it is not within receipt_timeout """
+        loop = asyncio.get_event_loop()
+        if tx_hash not in self._receipts:
+            self._receipts[tx_hash] = (loop.create_future(), time.monotonic() + self.receipt_timeout)
+            PENDING_TRANSACTIONS.set(len(self._receipts), wallet=self.address)
+        if not self._poller or self._poller.done():
+            self._poller = loop.create_task(self._poll_receipts())
+        return await asyncio.shield(self._receipts[tx_hash][0])
+
+    async def _poll_receipts(self):
+        loop = asyncio.get_event_loop()
+        while self._receipts:
+            await asyncio.sleep(self.receipt_poll)
+            hashes = list(self._receipts)
+            try:
+                responses = await loop.run_in_executor(None, self.provider.make_batch_request,
+                                                       [('eth_getTransactionReceipt', [h]) for h in hashes])
+            except Exception:
+                responses = [{} for _ in hashes]
+            for tx_hash, response in zip(hashes, responses):
+                future, deadline = self._receipts[tx_hash]
+                receipt = response.get('result')
+                if receipt and receipt.get('blockNumber'):
+                    receipt = dict(receipt, blockNumber=int(receipt['blockNumber'], 16))
+                    if receipt.get('status') is not None:
+                        receipt['status'] = int(receipt['status'], 16)
+                    if not future.done():
+                        future.set_result(receipt)
+                elif time.monotonic() > deadline:
+                    # Likely dropped, its nonce may have to be reused
+                    with self._lock:
+                        self._nonce = None
+                    if not future.done():
+                        future.set_exception(ConnectionError(f'No receipt for {tx_hash}.'))
+                else:
+                    continue
+                del self._receipts[tx_hash]
+            PENDING_TRANSACTIONS.set(len(self._receipts), wallet=self.address)
+
+    async def mint(self, smart_contract, energy) -> dict:
+        """
+        Mint like smart_contract.mint does, the energy is validated by it, through this wallet.
+        :param smart_contract: energyweb OriginProducer or OriginConsumer client
+        :param energy: ProducedEnergy or ConsumedEnergy
+        :return: Transaction receipt
+        """
+        recorder = _CallRecorder(smart_contract.asset_id)
+        type(smart_contract).mint(recorder, energy)
+        contract_name, method_name, args = recorder.call
+        contract = smart_contract.contracts[contract_name]
+        loop = asyncio.get_event_loop()
+        tx_hash = await loop.run_in_executor(None, lambda: self.submit(contract, method_name, *args))
+        return await self.receipt(tx_hash)
+
+
+if __name__ == '__main__':
+    from energyweb.smart_contract.origin.producer_v1 import contract as producer_v1
+    from eth_account import Account
+
+    account = Account.create()
+    chain = LocalChain(block_time=.5)
+    wallet = WalletClient('', account.address, account.privateKey.hex(), receipt_poll=.2, provider=chain)
+    contract = dict(producer_v1, address='0x' + '11' * 20)
+
+    async def mint_many(count: int):
+        loop = asyncio.get_event_loop()
+        hashes = [await loop.run_in_executor(None, lambda i=i: wallet.submit(
+            contract, 'saveSmartMeterRead', 0, i, False, b'hash', i, False)) for i in range(count)]
+        receipts = await asyncio.gather(*[wallet.receipt(h) for h in hashes])
+        print(f'{count} transactions, nonces {[nonce for _, nonce, _ in chain.sent]}, '
+              f'blocks {sorted(set(r["blockNumber"] for r in receipts))}')
+
+    asyncio.get_event_loop().run_until_complete(mint_many(10))